@@ -12,5 +12,8 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dream_deck.settings')
+# Route the Gemini-backed endpoints to their async views so one worker can
+# hold many in-flight model calls.
+os.environ.setdefault('ASYNC_AI_VIEWS', 'true')
 
 application = get_asgi_application()
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 from dotenv import load_dotenv
 import dj_database_url
 from datetime import timedelta
@@ -50,13 +51,16 @@ INSTALLED_APPS = [
     'rest_framework_simplejwt',
     "dreams",
     "corsheaders",
-    "debug_toolbar",
 ]
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+        'dreams.authentication.ClaimsJWTAuthentication',
+    ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'dreams.metrics.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
 }
 
 MIDDLEWARE = [
@@ -68,9 +72,27 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
-    "debug_toolbar.middleware.DebugToolbarMiddleware",
 ]
 
+# Prometheus metrics at /metrics; scrapers have to send
+# "Authorization: Bearer <METRICS_TOKEN>". Without a token they are only
+# served when DEBUG is on.
+METRICS = {
+    'ENABLED': os.getenv('METRICS_ENABLED', 'true').lower() == 'true',
+    'TOKEN': os.getenv('METRICS_TOKEN', ''),
+}
+if METRICS['ENABLED']:
+    # Outermost, so it times the whole middleware stack.
+    MIDDLEWARE.insert(0, 'dreams.metrics.MetricsMiddleware')
+
+# The toolbar's middleware runs on every request (even with DEBUG off), so it
+# is only loaded when asked for.
+DEBUG_TOOLBAR = DEBUG and os.getenv('DEBUG_TOOLBAR', 'false').lower() == 'true'
+if DEBUG_TOOLBAR:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.append('debug_toolbar.middleware.DebugToolbarMiddleware')
+    INTERNAL_IPS = ['127.0.0.1']
+
 
 CORS_ALLOW_ALL_ORIGINS = False
 CORS_ALLOWED_ORIGINS = [
@@ -115,10 +137,253 @@ DATABASES = {
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
+    # Tokens carry is_staff/is_premium so requests authenticate without a
+    # user query (dreams/authentication.py).
+    'TOKEN_OBTAIN_SERIALIZER': 'dreams.authentication.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'dreams.authentication.ClaimsTokenRefreshSerializer',
+}
+
+AUTH_TOKENS = {
+    'CACHE_ALIAS': 'auth',
+    # Validated access tokens kept per process.
+    'TOKEN_CACHE_SIZE': int(os.getenv('AUTH_TOKEN_CACHE_SIZE', '4096')),
+    # Seconds a user's token version and flags are cached. Changes reach
+    # other workers after this long unless AUTH_CACHE_URL is shared.
+    'STATE_TIMEOUT': int(os.getenv('AUTH_STATE_TIMEOUT', '60')),
 }
 
 AUTH_USER_MODEL = 'dreams.User'
 
+# Shared Gemini client (see dreams/llm.py). Set GEMINI_BACKEND=fake to run
+# without network access, e.g. for load tests; GEMINI_FAKE_LATENCY and
+# GEMINI_FAKE_ERROR_RATE make it slow or flaky to exercise the timeouts and
+# circuit breakers.
+GEMINI_CLIENT = {
+    'BACKEND': os.getenv('GEMINI_BACKEND', 'gemini'),
+    'API_KEY': os.getenv('GEMINI_API_KEY'),
+    'TRANSPORT': os.getenv('GEMINI_TRANSPORT') or None,
+    'TIMEOUT': float(os.getenv('GEMINI_TIMEOUT', '60')),
+    'MAX_CONCURRENCY': int(os.getenv('GEMINI_MAX_CONCURRENCY', '256')),
+    'ACQUIRE_TIMEOUT': float(os.getenv('GEMINI_ACQUIRE_TIMEOUT', '5')),
+    'FAKE_LATENCY': float(os.getenv('GEMINI_FAKE_LATENCY', '0')),
+    'FAKE_ERROR_RATE': float(os.getenv('GEMINI_FAKE_ERROR_RATE', '0')),
+    'BREAKER_FAILURE_THRESHOLD': int(os.getenv('GEMINI_BREAKER_FAILURES', '5')),
+    'BREAKER_RESET_TIMEOUT': float(os.getenv('GEMINI_BREAKER_RESET_TIMEOUT', '30')),
+}
+
+# Suggestion responses are cached by a hash of (endpoint, template version,
+# model, normalized content). LocMemCache evicts least recently used entries
+# once MAX_ENTRIES is reached; point SUGGESTION_CACHE_URL at Redis to share
+# the cache between workers.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'suggestions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'dream-deck-suggestions',
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('SUGGESTION_CACHE_MAX_ENTRIES', '10000')),
+        },
+    },
+}
+if os.getenv('SUGGESTION_CACHE_URL'):
+    CACHES['suggestions'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('SUGGESTION_CACHE_URL'),
+    }
+
+# Token buckets and in-flight counters of dreams/throttling.py. They must be
+# shared by all workers to hold per user, so set THROTTLE_CACHE_URL to a Redis
+# URL in production; the local-memory default is per process.
+CACHES['throttle'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'dream-deck-throttle',
+}
+if os.getenv('THROTTLE_CACHE_URL'):
+    CACHES['throttle'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('THROTTLE_CACHE_URL'),
+    }
+
+# Serialized dream listings, dreams and insight status keyed by their ETag
+# (dreams/conditional.py); entries never go stale, old ones just stop being
+# asked for.
+CACHES['responses'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'dream-deck-responses',
+    'OPTIONS': {
+        'MAX_ENTRIES': int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '5000')),
+    },
+}
+if os.getenv('RESPONSE_CACHE_URL'):
+    CACHES['responses'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('RESPONSE_CACHE_URL'),
+    }
+
+# Per-user token version and flags checked on every authenticated request.
+CACHES['auth'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'dream-deck-auth',
+    'OPTIONS': {
+        'MAX_ENTRIES': int(os.getenv('AUTH_CACHE_MAX_ENTRIES', '50000')),
+    },
+}
+if os.getenv('AUTH_CACHE_URL'):
+    CACHES['auth'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('AUTH_CACHE_URL'),
+    }
+
+SUGGESTION_CACHE_ALIAS = 'suggestions'
+SUGGESTION_STATS_CACHE_ALIAS = 'default'
+SUGGESTION_CACHE_TIMEOUT = int(os.getenv('SUGGESTION_CACHE_TIMEOUT', '86400'))
+RESPONSE_CACHE_ALIAS = 'responses'
+RESPONSE_CACHE_TIMEOUT = int(os.getenv('RESPONSE_CACHE_TIMEOUT', '300'))
+
+# Answer suggest-themes/, suggest-emotions/ and suggest-title/ from the
+# combined suggest/ call (and its cache entry) instead of one prompt each.
+SUGGEST_FROM_COMBINED = os.getenv('SUGGEST_FROM_COMBINED', 'false').lower() == 'true'
+
+# Rows per batch for NDJSON dream import/export.
+DREAM_TRANSFER_BATCH_SIZE = int(os.getenv('DREAM_TRANSFER_BATCH_SIZE', '500'))
+
+# PostgreSQL text search configuration for dream search. "simple" does no
+# language-specific stemming, since dreams are written in many languages.
+# Run `manage.py rebuild_search_index` after changing it.
+DREAM_SEARCH_CONFIG = os.getenv('DREAM_SEARCH_CONFIG', 'simple')
+
+# Embeddings behind the "similar dreams" endpoint and the recurring dreams
+# section of the insight prompt (dreams/embeddings.py).
+DREAM_EMBEDDINGS = {
+    'EMBEDDER': os.getenv('DREAM_EMBEDDER', 'dreams.embeddings.HashingEmbedder'),
+    'DIMENSIONS': int(os.getenv('DREAM_EMBEDDING_DIMENSIONS', '256')),
+    # Build an approximate (IVF) index for cross-user queries once a process
+    # holds this many vectors, and probe this many of its lists per query.
+    'ANN_THRESHOLD': int(os.getenv('DREAM_EMBEDDING_ANN_THRESHOLD', '50000')),
+    'ANN_PROBES': int(os.getenv('DREAM_EMBEDDING_ANN_PROBES', '8')),
+    # Seconds between checks for vectors written by other processes.
+    'REFRESH_INTERVAL': float(os.getenv('DREAM_EMBEDDING_REFRESH_INTERVAL', '5')),
+    'RECURRING_MIN_SCORE': float(os.getenv('DREAM_RECURRING_MIN_SCORE', '0.3')),
+    'RECURRING_MAX_DREAMS': int(os.getenv('DREAM_RECURRING_MAX_DREAMS', '3')),
+}
+
+# Local theme/emotion classifier answering suggest-themes and suggest-emotions
+# before Gemini is asked (dreams/tagger.py). Retrain with
+# "python manage.py train_tagger"; Gemini is only called when no label reaches
+# MIN_CONFIDENCE.
+DREAM_TAGGER = {
+    'ENABLED': os.getenv('DREAM_TAGGER_ENABLED', 'true').lower() == 'true',
+    'MIN_CONFIDENCE': float(os.getenv('DREAM_TAGGER_MIN_CONFIDENCE', '0.8')),
+    'MAX_LABELS': int(os.getenv('DREAM_TAGGER_MAX_LABELS', '3')),
+    # Models trained on fewer tagged dreams are ignored.
+    'MIN_DREAMS': int(os.getenv('DREAM_TAGGER_MIN_DREAMS', '200')),
+    'MIN_DF': int(os.getenv('DREAM_TAGGER_MIN_DF', '2')),
+    'MAX_FEATURES': int(os.getenv('DREAM_TAGGER_MAX_FEATURES', '50000')),
+    'REFRESH_INTERVAL': float(os.getenv('DREAM_TAGGER_REFRESH_INTERVAL', '60')),
+}
+
+# Rate limits of the AI endpoints. "<n>/<period>" is a token bucket holding
+# n requests that refills at n per period, so bursts of up to n are allowed.
+AI_THROTTLES = {
+    'CACHE_ALIAS': 'throttle',
+    'RATES': {
+        'suggest': {
+            'FREE': os.getenv('AI_THROTTLE_SUGGEST_FREE', '20/min'),
+            'PREMIUM': os.getenv('AI_THROTTLE_SUGGEST_PREMIUM', '60/min'),
+        },
+        'insight': {
+            'FREE': os.getenv('AI_THROTTLE_INSIGHT_FREE', '10/hour'),
+            'PREMIUM': os.getenv('AI_THROTTLE_INSIGHT_PREMIUM', '60/hour'),
+        },
+    },
+    # Insight generations (queued jobs plus open streams) a user may have
+    # running at once.
+    'MAX_IN_FLIGHT': {
+        'FREE': int(os.getenv('AI_MAX_IN_FLIGHT_FREE', '1')),
+        'PREMIUM': int(os.getenv('AI_MAX_IN_FLIGHT_PREMIUM', '3')),
+    },
+    # Seconds before a stream slot left behind by a crashed worker expires.
+    'IN_FLIGHT_TIMEOUT': int(os.getenv('AI_IN_FLIGHT_TIMEOUT', '600')),
+    # Retry-After sent when the in-flight cap is reached.
+    'IN_FLIGHT_RETRY_AFTER': int(os.getenv('AI_IN_FLIGHT_RETRY_AFTER', '30')),
+}
+
+# Daily Gemini allowance per user, summed over all AI endpoints. Set a
+# limit to 0 to lift it.
+GEMINI_QUOTAS = {
+    'FREE': {
+        'REQUESTS': int(os.getenv('GEMINI_FREE_DAILY_REQUESTS', '50')) or None,
+        'TOKENS': int(os.getenv('GEMINI_FREE_DAILY_TOKENS', '100000')) or None,
+    },
+    'PREMIUM': {
+        'REQUESTS': int(os.getenv('GEMINI_PREMIUM_DAILY_REQUESTS', '500')) or None,
+        'TOKENS': int(os.getenv('GEMINI_PREMIUM_DAILY_TOKENS', '2000000')) or None,
+    },
+}
+
+# Dream interpretation knowledge base, loaded and indexed once per process
+# (dreams/knowledge.py). Only the best matching entries are sent to Gemini.
+KNOWLEDGE_BASE_PATH = BASE_DIR / 'dreams' / 'dream_interpretation_knowledge.txt'
+KNOWLEDGE_BASE_MAX_ENTRIES = int(os.getenv('KNOWLEDGE_BASE_MAX_ENTRIES', '8'))
+
+# Database-backed job queue processed by `python manage.py run_worker`.
+BACKGROUND_JOBS = {
+    'MAX_ATTEMPTS': int(os.getenv('JOB_MAX_ATTEMPTS', '5')),
+    'RETRY_BASE_DELAY': float(os.getenv('JOB_RETRY_BASE_DELAY', '5')),
+    'RETRY_MAX_DELAY': float(os.getenv('JOB_RETRY_MAX_DELAY', '300')),
+    # Running jobs not finished within this many seconds are picked up again.
+    'LOCK_TIMEOUT': int(os.getenv('JOB_LOCK_TIMEOUT', '600')),
+}
+
+# Uploads are always spooled to a temporary file in chunks and then copied to
+# storage chunk by chunk, never held in memory as a whole.
+FILE_UPLOAD_HANDLERS = ['django.core.files.uploadhandler.TemporaryFileUploadHandler']
+
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', BASE_DIR / 'media')
+MEDIA_URL = os.getenv('MEDIA_URL', 'media/')
+
+# Renditions made by the process_media background job (dreams/media.py).
+MEDIA_PROCESSING = {
+    'ENABLED': os.getenv('MEDIA_PROCESSING_ENABLED', 'true').lower() == 'true',
+    # Without ffmpeg only WAV uploads get a duration and waveform, and no
+    # compressed preview is made.
+    'FFMPEG': os.getenv('FFMPEG_BINARY', 'ffmpeg'),
+    'AUDIO_BITRATE': os.getenv('MEDIA_AUDIO_BITRATE', '64k'),
+    'WAVEFORM_PEAKS': int(os.getenv('MEDIA_WAVEFORM_PEAKS', '100')),
+    'THUMBNAIL_SIZE': int(os.getenv('MEDIA_THUMBNAIL_SIZE', '320')),
+    'THUMBNAIL_QUALITY': int(os.getenv('MEDIA_THUMBNAIL_QUALITY', '80')),
+    # Seconds before ffmpeg is killed.
+    'TIMEOUT': int(os.getenv('MEDIA_PROCESSING_TIMEOUT', '300')),
+}
+
+# Serve the AI endpoints from dreams/async_views.py. Enabled by default when
+# running under ASGI (dream_deck/asgi.py).
+ASYNC_AI_VIEWS = os.getenv('ASYNC_AI_VIEWS', 'false').lower() == 'true'
+
+# Existing pbkdf2_sha256 hashes are verified by the tunable hasher too.
+PASSWORD_HASHERS = [
+    'dreams.passwords.TunablePBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
+# Login and signup hashing pool (dreams/passwords.py). Attempts that find
+# WORKERS + QUEUE hashes in progress wait up to QUEUE_TIMEOUT seconds for a
+# slot and are then answered with 503.
+PASSWORD_HASHING = {
+    # PBKDF2 iterations; 0 keeps Django's default.
+    'ITERATIONS': int(os.getenv('PASSWORD_HASH_ITERATIONS', '0')),
+    # Per process: with N server processes, up to N * WORKERS cores hash at
+    # once, so keep that product at or below the number of cores.
+    'WORKERS': int(os.getenv('PASSWORD_HASH_WORKERS', '1')),
+    'QUEUE': int(os.getenv('PASSWORD_HASH_QUEUE', '32')),
+    'QUEUE_TIMEOUT': float(os.getenv('PASSWORD_HASH_QUEUE_TIMEOUT', '2')),
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -168,13 +433,17 @@ LOGGING = {
             'format': '{asctime} {levelname} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'dreams.log_handlers.JsonFormatter',
+        },
     },
     'handlers': {
         'gemini_file': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            # Written from a background thread, one JSON record per line.
+            'class': 'dreams.log_handlers.QueueFileHandler',
             'filename': os.path.join(BASE_DIR, 'logs/gemini_usage.log'),
-            'formatter': 'verbose',
+            'formatter': 'json',
         },
     },
     'loggers': {
@@ -184,4 +453,7 @@ LOGGING = {
             'propagate': False,
         },
     },
-}
\ No newline at end of file
+}
+if sys.argv[1:2] == ['test']:
+    # Test runs don't write usage records into logs/.
+    LOGGING['handlers']['gemini_file'] = {'class': 'logging.NullHandler'}
@@ -15,10 +15,23 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 
+from dreams import metrics
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/v1/", include("dreams.urls")),
 ]
+
+if settings.METRICS["ENABLED"]:
+    urlpatterns.append(path("metrics", metrics.metrics_view, name="metrics"))
+
+if settings.DEBUG_TOOLBAR:
+    urlpatterns.append(path("__debug__/", include("debug_toolbar.urls")))
+
+# Uploads and their renditions; only served by Django itself while DEBUG is on.
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -4,7 +4,8 @@ from .models import (
     User, Dream, Emotion, DreamEmotion, Theme, DreamTheme, 
     ArtworkGeneration, SoundtrackGeneration, DreamChallenge, 
     UserChallenge, LucidDreamingProgress, CulturalInterpretation, 
-    DailyTask, DreamMeditation, DreamPrompt, CollaborativeDream, DreamInsight
+    DailyTask, DreamMeditation, DreamPrompt, CollaborativeDream, DreamInsight,
+    BackgroundJob, GeminiUsage,
 )
 
 class CustomUserAdmin(UserAdmin):
@@ -29,6 +30,7 @@ class DreamAdmin(admin.ModelAdmin):
     list_display = ['title', 'user', 'date', 'is_lucid']
     list_filter = ['is_lucid', 'date']
     search_fields = ['title', 'content', 'user__username']
+    list_select_related = ['user']
     inlines = [DreamEmotionInline, DreamThemeInline]
 
 class DreamChallengeAdmin(admin.ModelAdmin):
@@ -36,32 +38,52 @@ class DreamChallengeAdmin(admin.ModelAdmin):
 
 class UserChallengeAdmin(admin.ModelAdmin):
     list_display = ['user', 'challenge', 'completed']
+    list_select_related = ['user', 'challenge']
     list_filter = ['completed']
 
 class LucidDreamingProgressAdmin(admin.ModelAdmin):
     list_display = ['user', 'success_rate']
+    list_select_related = ['user']
 
 class CulturalInterpretationAdmin(admin.ModelAdmin):
     list_display = ['dream', 'culture']
+    list_select_related = ['dream__user']
 
 class DailyTaskAdmin(admin.ModelAdmin):
     list_display = ['dream', 'task_description', 'completed']
+    list_select_related = ['dream__user']
     list_filter = ['completed']
 
 class DreamMeditationAdmin(admin.ModelAdmin):
     list_display = ['title', 'user', 'created_at']
+    list_select_related = ['user']
 
 class DreamPromptAdmin(admin.ModelAdmin):
     list_display = ['user', 'prompt_text', 'created_at']
+    list_select_related = ['user']
 
 class CollaborativeDreamAdmin(admin.ModelAdmin):
     list_display = ['prompt', 'user', 'created_at']
+    list_select_related = ['prompt__user', 'user']
     
 class DreamInsightAdmin(admin.ModelAdmin):
     list_display = ['dream', 'created_at', 'updated_at']
     search_fields = ['dream__title', 'summary', 'analysis']
+    list_select_related = ['dream__user']
     readonly_fields = ['created_at', 'updated_at']
 
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'dedupe_key', 'status', 'attempts', 'run_after', 'updated_at']
+    list_filter = ['kind', 'status']
+    search_fields = ['dedupe_key', 'error']
+    readonly_fields = ['created_at', 'updated_at']
+
+class GeminiUsageAdmin(admin.ModelAdmin):
+    list_display = ['user', 'day', 'endpoint', 'requests', 'prompt_tokens', 'response_tokens']
+    list_filter = ['endpoint', 'day']
+    search_fields = ['user__username']
+    list_select_related = ['user']
+
 
 admin.site.register(User, CustomUserAdmin)
 admin.site.register(Dream, DreamAdmin)
@@ -77,4 +99,6 @@ admin.site.register(DailyTask, DailyTaskAdmin)
 admin.site.register(DreamMeditation, DreamMeditationAdmin)
 admin.site.register(DreamPrompt, DreamPromptAdmin)
 admin.site.register(CollaborativeDream, CollaborativeDreamAdmin)
-admin.site.register(DreamInsight, DreamInsightAdmin)
\ No newline at end of file
+admin.site.register(DreamInsight, DreamInsightAdmin)
+admin.site.register(BackgroundJob, BackgroundJobAdmin)
+admin.site.register(GeminiUsage, GeminiUsageAdmin)
@@ -0,0 +1,260 @@
+import functools
+import json
+import logging
+import math
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from rest_framework import exceptions, status
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from . import suggestions, throttling
+from .insights import (
+    astream_insight,
+    enqueue_insight,
+    insight_job_key,
+    insight_slots_left,
+    queued_insights,
+)
+from .jobs import active_job
+from .models import Dream
+from .throttling import InsightThrottle, SuggestThrottle
+from .usage import QuotaExceeded, check_quota
+
+# Async counterparts of the AI views in views.py. Under ASGI (see
+# dream_deck/asgi.py) a single worker can keep many Gemini calls in flight
+# while these coroutines are suspended on the network.
+
+logger = logging.getLogger(__name__)
+
+
+def _authorize(request, permission_classes, throttle_classes):
+    # Runs the DRF authentication/permission/throttle pipeline; touches the
+    # database and cache, so it is always called through sync_to_async.
+    for permission in permission_classes:
+        if not permission().has_permission(request, None):
+            if request.authenticators and not request.successful_authenticator:
+                raise exceptions.NotAuthenticated()
+            raise exceptions.PermissionDenied()
+    for throttle in throttle_classes:
+        throttle = throttle()
+        if not throttle.allow_request(request, None):
+            raise exceptions.Throttled(throttle.wait())
+    # Parse the body while still off the event loop.
+    request.data
+
+
+def _too_many_requests(data, retry_after):
+    response = JsonResponse(data, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    response["Retry-After"] = "%d" % math.ceil(retry_after)
+    return response
+
+
+def async_api_view(methods, permission_classes=(IsAuthenticated,), throttle_classes=()):
+    def decorator(view):
+        @csrf_exempt
+        @require_http_methods(methods)
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            drf_request = Request(
+                request,
+                parsers=[JSONParser(), FormParser(), MultiPartParser()],
+                authenticators=[
+                    auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+                ],
+            )
+            try:
+                await sync_to_async(_authorize)(
+                    drf_request, permission_classes, throttle_classes
+                )
+            except exceptions.Throttled as exc:
+                return _too_many_requests({"detail": exc.detail}, exc.wait)
+            except exceptions.APIException as exc:
+                return JsonResponse({"detail": exc.detail}, status=exc.status_code)
+            return await view(drf_request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+async def _suggestion_response(request, endpoint):
+    content = request.data.get("content")
+    if not content:
+        return JsonResponse(
+            {"error": "No content provided"}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        return JsonResponse(await suggestions.asuggest(endpoint, content, request.user))
+    except QuotaExceeded as e:
+        return JsonResponse(
+            {"error": str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS
+        )
+    except Exception:
+        # Errors without a fallback (a bad API key, a rejected request...).
+        logger.exception("%s failed", endpoint)
+        return JsonResponse(
+            {"error": "aiUnavailable"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+@async_api_view(["POST"], throttle_classes=[SuggestThrottle])
+async def suggest_themes(request):
+    return await _suggestion_response(request, "suggest_themes")
+
+
+@async_api_view(["POST"], throttle_classes=[SuggestThrottle])
+async def suggest_emotions(request):
+    return await _suggestion_response(request, "suggest_emotions")
+
+
+@async_api_view(["POST"], throttle_classes=[SuggestThrottle])
+async def suggest_title(request):
+    return await _suggestion_response(request, "suggest_title")
+
+
+@async_api_view(["POST"], throttle_classes=[SuggestThrottle])
+async def suggest_all(request):
+    content = request.data.get("content")
+    if not content:
+        return JsonResponse(
+            {"error": "No content provided"}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        return JsonResponse(await suggestions.asuggest_all(content, request.user))
+    except QuotaExceeded as e:
+        return JsonResponse(
+            {"error": str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS
+        )
+    except Exception:
+        # Errors without a fallback (a bad API key, a rejected request...).
+        logger.exception("%s failed", suggestions.COMBINED_ENDPOINT)
+        return JsonResponse(
+            {"error": "aiUnavailable"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+@async_api_view(["POST"], throttle_classes=[InsightThrottle])
+async def generate_dream_insight(request):
+    dream_id = request.data.get("dream_id")
+    if not dream_id:
+        return JsonResponse(
+            {"error": "No dream ID provided"}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        dream = await Dream.objects.aget(id=dream_id, user=request.user)
+    except (Dream.DoesNotExist, ValueError):
+        raise Http404
+    try:
+        await sync_to_async(check_quota)(request.user)
+    except QuotaExceeded as e:
+        return JsonResponse(
+            {"error": str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS
+        )
+    if not await sync_to_async(_has_insight_slot)(dream, request.user):
+        return _too_many_requests(
+            {"error": "Too many insights in progress"},
+            settings.AI_THROTTLES["IN_FLIGHT_RETRY_AFTER"],
+        )
+
+    job, created = await sync_to_async(enqueue_insight)(dream)
+    return JsonResponse(
+        {"job_id": job.id, "status": job.status, "created": created},
+        status=status.HTTP_202_ACCEPTED,
+    )
+
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _has_insight_slot(dream, user):
+    return active_job(insight_job_key(dream.id)) is not None or insight_slots_left(user) > 0
+
+
+class _InFlightSlot:
+    # Released by whichever comes first: the end of the stream or the
+    # response being closed, which also covers a stream that never started.
+    def __init__(self, scope, user_id):
+        self.scope = scope
+        self.user_id = user_id
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        throttling.release_in_flight(self.scope, self.user_id)
+
+
+class _SlotStreamingResponse(StreamingHttpResponse):
+    def __init__(self, *args, slot, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slot = slot
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.slot.release()
+
+
+async def _insight_events(dream, slot):
+    try:
+        async for chunk in astream_insight(dream):
+            yield _sse_event("chunk", {"text": chunk})
+    except QuotaExceeded:
+        yield _sse_event("error", {"error": "quotaExceeded"})
+    except Exception:
+        logger.exception("Insight stream for dream %s failed", dream.id)
+        yield _sse_event("error", {"error": "aiUnavailable"})
+    else:
+        yield _sse_event("done", {"saved_to_database": True})
+    finally:
+        await sync_to_async(slot.release)()
+
+
+@async_api_view(["GET"], throttle_classes=[InsightThrottle])
+async def stream_dream_insight(request, dream_id):
+    try:
+        dream = await Dream.objects.select_related("user").aget(
+            id=dream_id, user=request.user
+        )
+    except Dream.DoesNotExist:
+        return JsonResponse({"error": "Dream not found"}, status=404)
+
+    try:
+        await sync_to_async(check_quota)(request.user)
+    except QuotaExceeded as e:
+        return JsonResponse(
+            {"error": str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS
+        )
+    # The stream holds one of the user's in-flight slots until it ends.
+    queued = await sync_to_async(queued_insights)(dream.user_id)
+    limit = throttling.max_in_flight(dream.user) - queued
+    if not await sync_to_async(throttling.acquire_in_flight)("insight", dream.user_id, limit):
+        return _too_many_requests(
+            {"error": "Too many insights in progress"},
+            settings.AI_THROTTLES["IN_FLIGHT_RETRY_AFTER"],
+        )
+
+    slot = _InFlightSlot("insight", dream.user_id)
+    response = _SlotStreamingResponse(
+        _insight_events(dream, slot), content_type="text/event-stream", slot=slot
+    )
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx from buffering the stream.
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -1,17 +1,33 @@
+import logging
+
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import AllowAny
 from rest_framework.views import APIView
-from rest_framework_simplejwt.tokens import RefreshToken
 
 from django.core.exceptions import ValidationError
 from django.contrib.auth.password_validation import validate_password
 from django.db import IntegrityError
-from django.db.models import Q
-from django.contrib.auth import get_user_model, login
+from django.db.models import Case, When
+from django.db.models.functions import Lower
+from django.contrib.auth import get_user_model
+from django.utils import timezone
 
+from . import passwords
+from .authentication import ClaimsRefreshToken
 from .serializers import UserSerializer, LoginSerializer
 
+logger = logging.getLogger(__name__)
+
+
+def _busy():
+    return Response(
+        {"error": "tooManyRequests"},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": "1"},
+    )
+
+
 class SignUpView(APIView):
     permission_classes = [AllowAny]
 
@@ -19,11 +35,16 @@ class SignUpView(APIView):
         serializer = UserSerializer(data=request.data)
         if serializer.is_valid():
             try:
-                # Validate password
-                validate_password(serializer.validated_data['password'])
-                
+                # The only password validation, now that the user's
+                # attributes are known.
+                data = serializer.validated_data
+                validate_password(
+                    data['password'],
+                    user=User(username=data['username'], email=data['email']),
+                )
+
                 user = serializer.save()
-                refresh = RefreshToken.for_user(user)
+                refresh = ClaimsRefreshToken.for_user(user)
                 return Response(
                     {
                         "user": UserSerializer(user).data,
@@ -36,6 +57,8 @@ class SignUpView(APIView):
                 return Response({"error": "weakPassword", "details": e.messages}, status=status.HTTP_400_BAD_REQUEST)
             except IntegrityError:
                 return Response({"error": "userExists"}, status=status.HTTP_400_BAD_REQUEST)
+            except passwords.HashingBusy:
+                return _busy()
             except Exception:
                 return Response({"error": "serverError"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         else:
@@ -48,6 +71,31 @@ class SignUpView(APIView):
 
 User = get_user_model()
 
+
+def find_login_user(username_or_email):
+    # One indexed, case-insensitive lookup: anything with an "@" is looked up
+    # as an email (user_email_lower_idx) and only falls back to the username
+    # (user_username_lower_idx) when no email matches.
+    username_or_email = username_or_email.strip()
+    if "@" in username_or_email:
+        user = (
+            User.objects.annotate(email_lower=Lower("email"))
+            .filter(email_lower=username_or_email.lower())
+            .order_by("id")
+            .first()
+        )
+        if user is not None:
+            return user
+    username = User.normalize_username(username_or_email)
+    return (
+        User.objects.annotate(username_lower=Lower("username"))
+        .filter(username_lower=username.lower())
+        # Usernames that differ only in case can both exist; the exact one wins.
+        .order_by(Case(When(username=username, then=0), default=1), "id")
+        .first()
+    )
+
+
 class LoginView(APIView):
     permission_classes = [AllowAny]
 
@@ -58,13 +106,13 @@ class LoginView(APIView):
             password = serializer.validated_data['password']
 
             try:
-                # Try to fetch the user by username or email
-                user = User.objects.get(Q(username=username_or_email) | Q(email=username_or_email))
-                
-                # Authenticate the user
-                if user.check_password(password):
-                    login(request, user)
-                    refresh = RefreshToken.for_user(user)
+                user = find_login_user(username_or_email)
+
+                # Token clients get no session; unknown users still pay for
+                # a hash so they take as long as wrong passwords.
+                if passwords.check_password(user, password) and user.is_active:
+                    User.objects.filter(pk=user.pk).update(last_login=timezone.now())
+                    refresh = ClaimsRefreshToken.for_user(user)
                     return Response(
                         {
                             "user": UserSerializer(user).data,
@@ -76,16 +124,12 @@ class LoginView(APIView):
                     return Response(
                         {"error": "invalidCredentials"}, status=status.HTTP_401_UNAUTHORIZED
                     )
-            except User.DoesNotExist:
-                # User not found
-                return Response(
-                    {"error": "invalidCredentials"}, status=status.HTTP_401_UNAUTHORIZED
-                )
-            except Exception as e:
-                # Log the exception for debugging
-                print(f"Unexpected error during login: {str(e)}")
+            except passwords.HashingBusy:
+                return _busy()
+            except Exception:
+                logger.exception("Unexpected error during login")
                 return Response(
                     {"error": "serverError"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
                 )
         else:
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
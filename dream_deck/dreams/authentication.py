@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+# Access tokens carry what the views need to know about the user, so
+# authenticating a request costs no database query: the user is built from
+# the claims and checked against a small cached auth state that changes when
+# the user's flags change or their password is reset.
+
+CLAIMS = ("is_staff", "is_premium")
+VERSION_CLAIM = "tv"
+STATE_FIELDS = ("token_version", "is_active") + CLAIMS
+
+
+def _cache():
+    return caches[settings.AUTH_TOKENS["CACHE_ALIAS"]]
+
+
+def _state_key(user_id):
+    return f"auth:state:{user_id}"
+
+
+def load_state(user_id):
+    # (token_version, is_active, is_staff, is_premium) or None for a deleted user.
+    state = get_user_model().objects.filter(pk=user_id).values_list(*STATE_FIELDS).first()
+    _cache().set(_state_key(user_id), state, settings.AUTH_TOKENS["STATE_TIMEOUT"])
+    return state
+
+
+def get_state(user_id):
+    state = _cache().get(_state_key(user_id), default=False)
+    if state is False:
+        return load_state(user_id)
+    return tuple(state) if state is not None else None
+
+
+def user_changed(user):
+    # Called on save/delete of a user; other processes see the new state once
+    # their cache entry expires (immediately with a shared AUTH_CACHE_URL).
+    user_id = user.pk
+    transaction.on_commit(lambda: _cache().delete(_state_key(user_id)))
+
+
+class ClaimsRefreshToken(RefreshToken):
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token[VERSION_CLAIM] = user.token_version
+        for claim in CLAIMS:
+            token[claim] = getattr(user, claim)
+        return token
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = ClaimsRefreshToken
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    # New access tokens get the user's current claims; refresh tokens issued
+    # before a password change stop working.
+    token_class = ClaimsRefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs["refresh"])
+        user_id = refresh.get(api_settings.USER_ID_CLAIM)
+        state = load_state(user_id)
+        if state is None or not state[1]:
+            raise InvalidToken(_("User not found or inactive"))
+        version, _active, *claims = state
+        if refresh.get(VERSION_CLAIM, version) != version:
+            raise InvalidToken(_("Token has been revoked"))
+        refresh[VERSION_CLAIM] = version
+        for claim, value in zip(CLAIMS, claims):
+            refresh[claim] = value
+
+        data = {"access": str(refresh.access_token)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data["refresh"] = str(refresh)
+        return data
+
+
+class TokenCache:
+    # Per-process LRU of raw token -> validated token, so a client sending
+    # the same access token again skips signature verification. Entries are
+    # dropped once the token expires.
+    def __init__(self, size):
+        self.size = size
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, raw_token, now):
+        with self._lock:
+            token = self._tokens.get(raw_token)
+            if token is None:
+                return None
+            if token["exp"] <= now:
+                del self._tokens[raw_token]
+                return None
+            self._tokens.move_to_end(raw_token)
+            return token
+
+    def put(self, raw_token, token):
+        with self._lock:
+            self._tokens[raw_token] = token
+            self._tokens.move_to_end(raw_token)
+            while len(self._tokens) > self.size:
+                self._tokens.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+token_cache = TokenCache(settings.AUTH_TOKENS["TOKEN_CACHE_SIZE"])
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    def get_validated_token(self, raw_token):
+        token = token_cache.get(raw_token, time.time())
+        if token is None:
+            token = super().get_validated_token(raw_token)
+            token_cache.put(raw_token, token)
+        return token
+
+    def get_user(self, validated_token):
+        if VERSION_CLAIM not in validated_token:
+            # Issued before claims were added.
+            return super().get_user(validated_token)
+        user_id = validated_token[api_settings.USER_ID_CLAIM]
+        state = get_state(user_id)
+        if not self._matches(validated_token, state):
+            # The cached state may be the stale one (e.g. the token was just
+            # refreshed through another worker); only the database decides.
+            state = load_state(user_id)
+            if not self._matches(validated_token, state):
+                # Rejected like an expired token, so clients refresh it and
+                # get the current claims.
+                raise InvalidToken(_("Token has been revoked or its claims are out of date"))
+        # Every other field is deferred and loaded on first access. from_db
+        # takes the values in the model's field order.
+        values = {"id": user_id, "is_active": True, **dict(zip(CLAIMS, state[2:]))}
+        names = [f.attname for f in self.user_model._meta.concrete_fields if f.attname in values]
+        return self.user_model.from_db(None, names, [values[name] for name in names])
+
+    @staticmethod
+    def _matches(token, state):
+        if state is None or not state[1]:
+            return False
+        version, _active, *claims = state
+        return token[VERSION_CLAIM] == version and all(
+            token.get(claim) == value for claim, value in zip(CLAIMS, claims)
+        )
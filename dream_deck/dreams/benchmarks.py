@@ -0,0 +1,493 @@
+import json
+import platform
+import random
+import statistics
+import subprocess
+import threading
+import time
+from collections import Counter
+from datetime import date, timedelta
+
+import django
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import caches
+from django.db import close_old_connections, connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import embeddings, llm, search, stats
+from .authentication import ClaimsRefreshToken
+from .models import (
+    Dream,
+    DreamEmotion,
+    DreamInsight,
+    DreamTheme,
+    Emotion,
+    Theme,
+    User,
+)
+from .prompts import INSIGHT_SECTIONS, parse_insight
+
+# Latency benchmarks for every route in dreams/urls.py (manage.py benchmark).
+# A synthetic dataset is seeded into a throwaway test database and each
+# scenario is replayed through the full middleware stack with a real JWT,
+# with Gemini replaced by the in-process fake backend.
+
+PASSWORD = "benchmark-password-1"
+
+WORDS = (
+    "ocean forest house door stairs mother father school teeth falling flying "
+    "water fire snake dog cat car train city night moon sun storm river bridge "
+    "mountain mirror baby wedding exam chase lost late naked shadow stranger "
+    "friend ghost voice light dark garden window key glass rain snow island "
+    "ship tower elevator hospital phone letter money crowd empty endless"
+).split()
+
+
+def _text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def _insight_text(rng):
+    return "\n".join(
+        f"<{section}>{_text(rng, 30)}</{section}>" for section in INSIGHT_SECTIONS
+    )
+
+
+def seed(users=20, dreams_per_user=50, emotions=20, themes=30, insight_ratio=0.5, seed=0):
+    """Create the synthetic dataset; returns the benchmark context.
+
+    The first user is a premium member and owns the dreams the scenarios
+    work on; a separate staff user covers the staff-only routes.
+    """
+    rng = random.Random(seed)
+    encoded = make_password(PASSWORD)
+    owners = [
+        User(username=f"bench-{i}", email=f"bench-{i}@example.com", is_premium=i == 0, password=encoded)
+        for i in range(users)
+    ]
+    staff = User(username="bench-staff", email="bench-staff@example.com", is_staff=True, password=encoded)
+    User.objects.bulk_create(owners + [staff])
+    owners = list(User.objects.filter(username__startswith="bench-", is_staff=False).order_by("id"))
+    staff = User.objects.get(username="bench-staff")
+
+    emotion_rows = Emotion.objects.bulk_create([Emotion(name=f"Emotion {i}") for i in range(emotions)])
+    theme_rows = Theme.objects.bulk_create([Theme(name=f"Theme {i}") for i in range(themes)])
+
+    today = date.today()
+    dreams = Dream.objects.bulk_create(
+        [
+            Dream(
+                user=owner,
+                title=_text(rng, 4)[:-1],
+                content=_text(rng, rng.randint(40, 200)),
+                is_lucid=rng.random() < 0.2,
+            )
+            for owner in owners
+            for _ in range(dreams_per_user)
+        ],
+        batch_size=1000,
+    )
+    dreams = list(Dream.objects.filter(user__in=owners).order_by("id"))
+    for dream in dreams:
+        dream.date = today - timedelta(days=rng.randint(0, 365))
+    Dream.objects.bulk_update(dreams, ["date"], batch_size=1000)
+
+    DreamEmotion.objects.bulk_create(
+        [
+            DreamEmotion(dream=dream, emotion=emotion, intensity=rng.randint(1, 10))
+            for dream in dreams
+            for emotion in rng.sample(emotion_rows, min(3, len(emotion_rows)))
+        ],
+        batch_size=1000,
+    )
+    DreamTheme.objects.bulk_create(
+        [
+            DreamTheme(dream=dream, theme=theme)
+            for dream in dreams
+            for theme in rng.sample(theme_rows, min(2, len(theme_rows)))
+        ],
+        batch_size=1000,
+    )
+    insights = []
+    for dream in dreams:
+        if rng.random() < insight_ratio:
+            analysis, sections = parse_insight(_insight_text(rng))
+            insights.append(
+                DreamInsight(
+                    dream=dream,
+                    summary=sections.get("dream_summary", analysis[:1000]),
+                    analysis=analysis,
+                    sections=sections,
+                )
+            )
+    DreamInsight.objects.bulk_create(insights, batch_size=1000)
+
+    # What the signals skipped by bulk_create would have maintained.
+    ids = [dream.pk for dream in dreams]
+    for start in range(0, len(ids), 1000):
+        search.index_dreams(ids[start : start + 1000])
+        embeddings.embed_dreams(dreams[start : start + 1000])
+    for owner in owners:
+        stats.rebuild_user_stats(owner.pk)
+
+    member = owners[0]
+    own = [dream for dream in dreams if dream.user_id == member.pk]
+    return {
+        "member": member,
+        "staff": staff,
+        "dreams": own,
+        "words": [word for word in WORDS if len(word) > 3],
+        "dataset": {
+            "users": users,
+            "dreams_per_user": dreams_per_user,
+            "emotions": emotions,
+            "themes": themes,
+            "insights": len(insights),
+            "seed": seed,
+        },
+    }
+
+
+class Scenario:
+    # path and body may be callables taking (context, iteration); prepare,
+    # if given, runs once before the scenario with (context, client).
+    def __init__(
+        self,
+        name,
+        method,
+        path,
+        body=None,
+        user="member",
+        content_type="application/json",
+        headers=None,
+        prepare=None,
+        iterations=None,
+    ):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.user = user
+        self.content_type = content_type
+        self.headers = headers
+        self.prepare = prepare
+        self.iterations = iterations
+
+    def resolve(self, value, context, i):
+        return value(context, i) if callable(value) else value
+
+
+def _dream(context, i):
+    return context["dreams"][i % len(context["dreams"])].pk
+
+
+def _content(context, i):
+    # A different text each time, so the suggestion cache misses and the
+    # (fake) model is called.
+    rng = random.Random(i)
+    return {"content": " ".join(rng.choice(context["words"]) for _ in range(60)) + f" {i}"}
+
+
+def _new_dream(context, i):
+    return {
+        "title": f"Benchmark dream {i}",
+        "content": _content(context, i)["content"],
+        "is_lucid": bool(i % 2),
+        "emotions": [{"name": "Emotion 1", "intensity": 5}],
+        "themes": ["Theme 1"],
+    }
+
+
+def _import_body(context, i):
+    return "\n".join(
+        json.dumps({"title": f"Imported {i}-{n}", "content": _content(context, i * 100 + n)["content"]})
+        for n in range(20)
+    )
+
+
+def _remember_etag(context, client):
+    response = client.get("/api/v1/dreams/")
+    context["list_etag"] = response["ETag"]
+
+
+def _create_disposable(context, client):
+    context["disposable"] = [
+        Dream.objects.create(user=context["member"], title=f"Disposable {i}", content="...").pk
+        for i in range(context["iterations"] + context["warmup"])
+    ]
+
+
+def _login(context, i):
+    return {"usernameOrEmail": context["member"].username, "password": PASSWORD}
+
+
+def _signup(context, i):
+    return {
+        "username": f"bench-signup-{i}",
+        "email": f"bench-signup-{i}@example.com",
+        "password": PASSWORD,
+        "confirm_password": PASSWORD,
+    }
+
+
+SCENARIOS = [
+    Scenario("dreams.list", "GET", "/api/v1/dreams/"),
+    Scenario("dreams.list.page_size_100", "GET", "/api/v1/dreams/?page_size=100"),
+    Scenario("dreams.list.sparse_fields", "GET", "/api/v1/dreams/?fields=id,title,date,insight.summary"),
+    Scenario(
+        "dreams.list.not_modified",
+        "GET",
+        "/api/v1/dreams/",
+        headers=lambda context, i: {"HTTP_IF_NONE_MATCH": context["list_etag"]},
+        prepare=_remember_etag,
+    ),
+    Scenario("dreams.my_dreams", "GET", "/api/v1/dreams/my_dreams/"),
+    Scenario("dreams.all_dreams", "GET", "/api/v1/dreams/all_dreams/"),
+    Scenario("dreams.staff_list", "GET", "/api/v1/dreams/", user="staff"),
+    Scenario("dreams.retrieve", "GET", lambda c, i: f"/api/v1/dreams/{_dream(c, i)}/"),
+    Scenario("dreams.create", "POST", "/api/v1/dreams/", body=_new_dream),
+    Scenario(
+        "dreams.partial_update",
+        "PATCH",
+        lambda c, i: f"/api/v1/dreams/{_dream(c, i)}/",
+        body=lambda c, i: {"title": f"Renamed {i}", "themes": ["Theme 2", "Theme 3"]},
+    ),
+    Scenario(
+        "dreams.destroy",
+        "DELETE",
+        lambda c, i: f"/api/v1/dreams/{c['disposable'][i]}/",
+        prepare=_create_disposable,
+    ),
+    Scenario("dreams.search", "GET", lambda c, i: f"/api/v1/dreams/search/?q={c['words'][i % len(c['words'])]}"),
+    Scenario("dreams.similar", "GET", lambda c, i: f"/api/v1/dreams/{_dream(c, i)}/similar/"),
+    Scenario("dreams.similar.all_users", "GET", lambda c, i: f"/api/v1/dreams/{_dream(c, i)}/similar/?scope=all"),
+    Scenario("dreams.import", "POST", "/api/v1/dreams/import/", body=_import_body, content_type="application/x-ndjson"),
+    Scenario("dreams.export", "GET", "/api/v1/dreams/export/"),
+    Scenario("dreams.check_insight", "GET", lambda c, i: f"/api/v1/dreams/{_dream(c, i)}/check-insight/"),
+    Scenario(
+        "dreams.check_insight.sections",
+        "GET",
+        lambda c, i: f"/api/v1/dreams/{_dream(c, i)}/check-insight/?sections=dream_summary,daily_affirmation",
+    ),
+    Scenario("dreams.insight_stream", "GET", lambda c, i: f"/api/v1/dreams/{_dream(c, i)}/insight-stream/"),
+    Scenario("emotions.list", "GET", "/api/v1/emotions/"),
+    Scenario("themes.list", "GET", "/api/v1/themes/"),
+    Scenario("stats", "GET", "/api/v1/stats/"),
+    Scenario("usage", "GET", "/api/v1/usage/"),
+    Scenario("suggest", "POST", "/api/v1/suggest/", body=_content),
+    Scenario("suggest.cached", "POST", "/api/v1/suggest/", body=lambda c, i: _content(c, 0)),
+    Scenario("suggest_themes", "POST", "/api/v1/suggest-themes/", body=_content),
+    Scenario("suggest_emotions", "POST", "/api/v1/suggest-emotions/", body=_content),
+    Scenario("suggest_title", "POST", "/api/v1/suggest-title/", body=_content),
+    Scenario("suggest_cache.stats", "GET", "/api/v1/suggest-cache/stats/", user="staff"),
+    Scenario("ai.health", "GET", "/api/v1/ai/health/", user="staff"),
+    Scenario(
+        "generate_insight",
+        "POST",
+        "/api/v1/generate-dream-insight/",
+        body=lambda c, i: {"dream_id": _dream(c, i)},
+    ),
+    Scenario("signup", "POST", "/api/v1/signup/", body=_signup, user=None, iterations=10),
+    Scenario("login", "POST", "/api/v1/login/", body=_login, user=None, iterations=10),
+    Scenario(
+        "token.obtain",
+        "POST",
+        "/api/v1/token/",
+        body=lambda c, i: {"username": c["member"].username, "password": PASSWORD},
+        user=None,
+        iterations=10,
+    ),
+    Scenario(
+        "token.refresh",
+        "POST",
+        "/api/v1/token/refresh/",
+        body=lambda c, i: {"refresh": c["refresh"]},
+        user=None,
+    ),
+    Scenario(
+        "token.verify",
+        "POST",
+        "/api/v1/token/verify/",
+        body=lambda c, i: {"token": c["access"]},
+        user=None,
+    ),
+]
+
+
+def settings_overrides(fake_latency=0.0):
+    # No rate limits or quotas (every scenario repeats the same user's
+    # requests), the fake Gemini backend, and no media jobs.
+    unlimited = "1000000/sec"
+    return {
+        "DEBUG": False,
+        "GEMINI_CLIENT": {**settings.GEMINI_CLIENT, "BACKEND": "fake", "FAKE_LATENCY": fake_latency},
+        "AI_THROTTLES": {
+            **settings.AI_THROTTLES,
+            "RATES": {
+                scope: {tier: unlimited for tier in rates}
+                for scope, rates in settings.AI_THROTTLES["RATES"].items()
+            },
+            "MAX_IN_FLIGHT": {tier: 1_000_000 for tier in settings.AI_THROTTLES["MAX_IN_FLIGHT"]},
+        },
+        "GEMINI_QUOTAS": {
+            tier: {limit: None for limit in limits} for tier, limits in settings.GEMINI_QUOTAS.items()
+        },
+        "MEDIA_PROCESSING": {**settings.MEDIA_PROCESSING, "ENABLED": False},
+    }
+
+
+def _percentile(values, p):
+    return values[min(int(p * len(values)), len(values) - 1)]
+
+
+async def _drain(content):
+    async for _ in content:
+        pass
+
+
+def _request(client, scenario, context, i, headers):
+    path = scenario.resolve(scenario.path, context, i)
+    body = scenario.resolve(scenario.body, context, i)
+    extra = dict(headers)
+    if scenario.headers is not None:
+        extra.update(scenario.resolve(scenario.headers, context, i))
+    if body is not None and scenario.content_type == "application/json":
+        body = json.dumps(body)
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        response = client.generic(
+            scenario.method, path, body or "", content_type=scenario.content_type, **extra
+        )
+        if response.streaming:
+            if response.is_async:
+                async_to_sync(_drain)(response.streaming_content)
+            else:
+                for _ in response.streaming_content:
+                    pass
+        elapsed = time.perf_counter() - started
+    return elapsed, len(queries), response.status_code
+
+
+def run_scenario(scenario, context, iterations, warmup=2, concurrency=1):
+    iterations = min(iterations, scenario.iterations or iterations)
+    context["iterations"], context["warmup"] = iterations, warmup
+    for alias in ("throttle", settings.SUGGESTION_CACHE_ALIAS):
+        caches[alias].clear()
+    headers = {}
+    if scenario.user is not None:
+        access = context["tokens"][scenario.user]
+        headers["HTTP_AUTHORIZATION"] = f"Bearer {access}"
+    client = Client(**headers)
+    if scenario.prepare is not None:
+        scenario.prepare(context, client)
+    for i in range(warmup):
+        _request(client, scenario, context, i, headers)
+
+    latencies, query_counts, statuses = [], [], Counter()
+    lock = threading.Lock()
+    counter = iter(range(warmup, warmup + iterations))
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                elapsed, queries, status = _request(Client(**headers), scenario, context, i, headers)
+                with lock:
+                    latencies.append(elapsed)
+                    query_counts.append(queries)
+                    statuses[status] += 1
+        finally:
+            if concurrency > 1:
+                close_old_connections()
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        worker()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        "method": scenario.method,
+        "path": scenario.resolve(scenario.path, context, warmup),
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "mean_ms": ms(statistics.mean(latencies)),
+        "p50_ms": ms(_percentile(latencies, 0.50)),
+        "p95_ms": ms(_percentile(latencies, 0.95)),
+        "p99_ms": ms(_percentile(latencies, 0.99)),
+        "max_ms": ms(latencies[-1]),
+        "requests_per_second": round(iterations / wall, 2),
+        "queries_mean": round(statistics.mean(query_counts), 2),
+        "queries_max": max(query_counts),
+    }
+
+
+def issue_tokens(context):
+    refresh = ClaimsRefreshToken.for_user(context["member"])
+    context["refresh"] = str(refresh)
+    context["access"] = str(refresh.access_token)
+    context["tokens"] = {
+        "member": context["access"],
+        "staff": str(ClaimsRefreshToken.for_user(context["staff"]).access_token),
+    }
+
+
+def run(context, scenarios, iterations=50, warmup=2, concurrency=1, progress=None):
+    issue_tokens(context)
+    llm.reset_client()
+    results = {}
+    for scenario in scenarios:
+        results[scenario.name] = run_scenario(scenario, context, iterations, warmup, concurrency)
+        if progress is not None:
+            progress(scenario.name, results[scenario.name])
+    return {"meta": metadata(context), "results": results}
+
+
+def metadata(context):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=settings.BASE_DIR,
+            timeout=5,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {
+        "commit": commit or None,
+        "created_at": timezone.now().isoformat(),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connection.vendor,
+        "dataset": context["dataset"],
+    }
+
+
+def compare(baseline, current, threshold=0.10):
+    # [(scenario, metric, before, after, relative change, regressed)]
+    rows = []
+    for name, result in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if before is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "queries_mean"):
+            old, new = before[metric], result[metric]
+            change = (new - old) / old if old else (0.0 if new == old else float("inf"))
+            rows.append((name, metric, old, new, change, change > threshold))
+    return rows
@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger("gemini_usage")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Numeric form of the state for metrics.
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive failures and rejects calls
+    # for reset_timeout seconds; then lets a single trial call through
+    # (half-open), which closes the circuit again or re-opens it.
+    timer = time.monotonic
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.opened_count = 0
+        self.rejected_count = 0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        logger.warning(
+            f"Circuit {self.name} {self.state} -> {state}",
+            extra={"fields": {"circuit": self.name, "from": self.state, "to": state}},
+        )
+        self.state = state
+
+    def allow(self):
+        with self._lock:
+            if self.state == OPEN and self.timer() - self.opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            self.rejected_count += 1
+            return False
+
+    def retry_after(self):
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(self.reset_timeout - (self.timer() - self.opened_at), 0.0)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.trial_running = False
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.opened_count += 1
+                self.opened_at = self.timer()
+                self._set_state(OPEN)
+
+    def release(self):
+        # The call ended without telling us anything about upstream health
+        # (e.g. it was cancelled); let the next caller run the trial.
+        with self._lock:
+            self.trial_running = False
+
+    def snapshot(self):
+        retry_after = self.retry_after()
+        with self._lock:
+            return {
+                "state": self.state,
+                "state_value": STATE_VALUES[self.state],
+                "consecutive_failures": self.failures,
+                "retry_after": round(retry_after, 3),
+                "opened_total": self.opened_count,
+                "rejected_total": self.rejected_count,
+            }
@@ -0,0 +1,43 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+# Conditional GETs for endpoints clients poll. The caller passes a cheap
+# "state" (versions and timestamps read without loading the resource); if the
+# client already has it the answer is 304, otherwise the serialized data is
+# taken from RESPONSE_CACHE_ALIAS or built once and stored there.
+
+
+def state_digest(request, state):
+    # Covers the full URL (query string included) and the negotiated format,
+    # so every representation gets its own tag.
+    raw = ":".join(
+        str(part)
+        for part in (request.build_absolute_uri(), request.accepted_renderer.format, *state)
+    )
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def conditional_response(request, state, last_modified, build):
+    digest = state_digest(request, state)
+    etag = f'"{digest}"'
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request._request, etag=etag, last_modified=timestamp)
+    if response is None:
+        cache = caches[settings.RESPONSE_CACHE_ALIAS]
+        key = f"response:{digest}"
+        data = cache.get(key)
+        if data is None:
+            data = build()
+            cache.set(key, data, timeout=settings.RESPONSE_CACHE_TIMEOUT)
+        response = Response(data)
+    response["ETag"] = etag
+    if timestamp is not None:
+        response["Last-Modified"] = http_date(timestamp)
+    # Per-user data: clients may keep it but have to revalidate every time.
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
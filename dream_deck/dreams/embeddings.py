@@ -0,0 +1,280 @@
+import hashlib
+import math
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .knowledge import tokenize
+from .models import Dream, DreamEmbedding
+
+# "Similar dreams" support: every dream's title and content is embedded into a
+# unit-length float32 vector stored in DreamEmbedding, and each process keeps
+# all vectors in one NumPy matrix for nearest-neighbour queries.
+
+VECTOR_DTYPE = np.dtype("<f4")
+
+
+def normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class HashingEmbedder:
+    # Deterministic embedder that needs no model or network: unigrams and
+    # bigrams are hashed into signed buckets and weighted by sublinear term
+    # frequency. No IDF, so a dream's vector never changes when others are
+    # added and updates stay incremental.
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+        self.name = f"hashing-{dimensions}"
+
+    def _features(self, text):
+        tokens = tokenize(text)
+        return Counter(tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])])
+
+    def embed(self, texts):
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, count in self._features(text).items():
+                digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                sign = 1.0 if value >> 63 else -1.0
+                matrix[row, value % self.dimensions] += sign * (1 + math.log(count))
+        return normalize(matrix)
+
+
+def dream_text(dream):
+    return f"{dream.title}\n{dream.content}"
+
+
+def to_bytes(vector):
+    return np.asarray(vector, dtype=VECTOR_DTYPE).tobytes()
+
+
+def from_bytes(data):
+    return np.frombuffer(data, dtype=VECTOR_DTYPE)
+
+
+class VectorIndex:
+    # Rows live in preallocated arrays that grow by doubling; deleted rows
+    # become tombstones (id -1) until the next full load.
+    INITIAL_CAPACITY = 1024
+    KMEANS_ITERATIONS = 10
+    KMEANS_SAMPLE = 50_000
+
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+        self.size = 0
+        self.vectors = np.zeros((self.INITIAL_CAPACITY, dimensions), dtype=np.float32)
+        self.ids = np.full(self.INITIAL_CAPACITY, -1, dtype=np.int64)
+        self.users = np.full(self.INITIAL_CAPACITY, -1, dtype=np.int64)
+        self.lists = np.full(self.INITIAL_CAPACITY, -1, dtype=np.int32)
+        self.rows = {}
+        self.centroids = None
+        self.lock = threading.RLock()
+
+    def _grow(self, needed):
+        capacity = len(self.ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        vectors = np.zeros((capacity, self.dimensions), dtype=np.float32)
+        vectors[: self.size] = self.vectors[: self.size]
+        self.vectors = vectors
+        for name, fill in (("ids", -1), ("users", -1), ("lists", -1)):
+            old = getattr(self, name)
+            new = np.full(capacity, fill, dtype=old.dtype)
+            new[: self.size] = old[: self.size]
+            setattr(self, name, new)
+
+    def upsert(self, dream_ids, user_ids, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimensions)
+        with self.lock:
+            self._grow(self.size + len(dream_ids))
+            rows = np.empty(len(dream_ids), dtype=np.int64)
+            for i, dream_id in enumerate(dream_ids):
+                row = self.rows.get(dream_id)
+                if row is None:
+                    row = self.rows[dream_id] = self.size
+                    self.size += 1
+                rows[i] = row
+            self.vectors[rows] = vectors
+            self.ids[rows] = dream_ids
+            self.users[rows] = user_ids
+            if self.centroids is not None:
+                self.lists[rows] = np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def remove(self, dream_ids):
+        with self.lock:
+            for dream_id in dream_ids:
+                row = self.rows.pop(dream_id, None)
+                if row is not None:
+                    self.ids[row] = self.users[row] = self.lists[row] = -1
+                    self.vectors[row] = 0
+
+    def vector(self, dream_id):
+        with self.lock:
+            row = self.rows.get(dream_id)
+            return None if row is None else self.vectors[row].copy()
+
+    def build_ann(self, lists):
+        # Inverted-file index: spherical k-means over a sample, then every
+        # row is assigned to its nearest centroid.
+        with self.lock:
+            live = np.flatnonzero(self.ids[: self.size] >= 0)
+            if len(live) < lists:
+                self.centroids = None
+                return
+            rng = np.random.default_rng(0)
+            sample = self.vectors[rng.choice(live, min(len(live), self.KMEANS_SAMPLE), replace=False)]
+            centroids = sample[rng.choice(len(sample), lists, replace=False)]
+            for _ in range(self.KMEANS_ITERATIONS):
+                assignment = np.argmax(sample @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignment, sample)
+                empty = ~sums.any(axis=1)
+                sums[empty] = centroids[empty]
+                centroids = normalize(sums)
+            self.centroids = centroids
+            self.lists[: self.size] = -1
+            for start in range(0, len(live), self.KMEANS_SAMPLE):
+                rows = live[start:start + self.KMEANS_SAMPLE]
+                self.lists[rows] = np.argmax(self.vectors[rows] @ centroids.T, axis=1)
+
+    def _candidates(self, vector, user_id, probes):
+        if user_id is not None:
+            return np.flatnonzero(self.users[: self.size] == user_id)
+        if self.centroids is None:
+            return np.flatnonzero(self.ids[: self.size] >= 0)
+        probes = min(probes, len(self.centroids))
+        nearest = np.argpartition(-(self.centroids @ vector), probes - 1)[:probes]
+        return np.flatnonzero(np.isin(self.lists[: self.size], nearest))
+
+    def search(self, vector, limit, user_id=None, exclude=None, probes=8):
+        # Brute force over the owner's rows (or every row without an ANN
+        # index); only the global scope probes the nearest IVF lists.
+        with self.lock:
+            rows = self._candidates(vector, user_id, probes)
+            if exclude is not None:
+                rows = rows[self.ids[rows] != exclude]
+            if not len(rows):
+                return []
+            scores = self.vectors[rows] @ vector
+            top = min(limit, len(rows))
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+            return [(int(self.ids[rows[i]]), float(scores[i])) for i in best]
+
+
+_embedder = None
+_index = None
+_synced_at = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def get_embedder():
+    global _embedder
+    if _embedder is None:
+        config = settings.DREAM_EMBEDDINGS
+        _embedder = import_string(config["EMBEDDER"])(dimensions=config["DIMENSIONS"])
+    return _embedder
+
+
+def _load(queryset):
+    global _synced_at
+    dream_ids, user_ids, vectors = [], [], []
+    for dream_id, user_id, vector, updated_at in queryset.values_list(
+        "dream_id", "dream__user_id", "vector", "updated_at"
+    ).iterator(chunk_size=10_000):
+        dream_ids.append(dream_id)
+        user_ids.append(user_id)
+        vectors.append(from_bytes(vector))
+        if _synced_at is None or updated_at > _synced_at:
+            _synced_at = updated_at
+    if dream_ids:
+        _index.upsert(dream_ids, user_ids, np.stack(vectors))
+
+
+def get_index():
+    # Loaded once per process, then kept current: writes in this process
+    # update it directly and rows written by other processes are pulled in
+    # at most every REFRESH_INTERVAL seconds.
+    global _index, _checked_at
+    config = settings.DREAM_EMBEDDINGS
+    embedder = get_embedder()
+    rows = DreamEmbedding.objects.filter(embedder=embedder.name)
+    with _lock:
+        if _index is None:
+            _index = VectorIndex(embedder.dimensions)
+            _load(rows)
+        elif time.monotonic() - _checked_at >= config["REFRESH_INTERVAL"]:
+            if _synced_at is not None:
+                # Overlap the window so rows committed late are not missed.
+                rows = rows.filter(updated_at__gte=_synced_at - timedelta(seconds=60))
+            _load(rows)
+        else:
+            return _index
+        _checked_at = time.monotonic()
+        if _index.centroids is None and _index.size >= config["ANN_THRESHOLD"]:
+            _index.build_ann(int(math.sqrt(_index.size)))
+    return _index
+
+
+def reset_index():
+    global _embedder, _index, _synced_at
+    with _lock:
+        _embedder = _index = _synced_at = None
+
+
+def embed_dreams(dreams):
+    dreams = list(dreams)
+    if not dreams:
+        return
+    embedder = get_embedder()
+    vectors = embedder.embed([dream_text(dream) for dream in dreams])
+    now = timezone.now()
+    DreamEmbedding.objects.bulk_create(
+        [
+            DreamEmbedding(
+                dream_id=dream.pk, embedder=embedder.name, vector=to_bytes(vector), updated_at=now
+            )
+            for dream, vector in zip(dreams, vectors)
+        ],
+        update_conflicts=True,
+        unique_fields=["dream"],
+        update_fields=["embedder", "vector", "updated_at"],
+    )
+    if _index is not None:
+        _index.upsert([d.pk for d in dreams], [d.user_id for d in dreams], vectors)
+
+
+def unindex_dreams(dream_ids):
+    if _index is not None:
+        _index.remove(dream_ids)
+
+
+def similar_dreams(dream, limit, all_users=False, min_score=0.0):
+    index = get_index()
+    vector = index.vector(dream.pk)
+    if vector is None:
+        vector = get_embedder().embed([dream_text(dream)])[0]
+    # Ask for a few extra in case rows deleted elsewhere are still indexed.
+    matches = index.search(
+        vector,
+        limit * 2,
+        user_id=None if all_users else dream.user_id,
+        exclude=dream.pk,
+        probes=settings.DREAM_EMBEDDINGS["ANN_PROBES"],
+    )
+    matches = [(pk, score) for pk, score in matches if score > min_score]
+    dreams = Dream.objects.in_bulk([pk for pk, _ in matches])
+    return [(dreams[pk], score) for pk, score in matches if pk in dreams][:limit]
@@ -0,0 +1,140 @@
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+
+from . import jobs, llm, prompts, throttling
+from .embeddings import similar_dreams
+from .knowledge import get_knowledge_base
+from .models import BackgroundJob, Dream, DreamInsight
+
+
+def recurring_dreams_text(dream):
+    config = settings.DREAM_EMBEDDINGS
+    matches = similar_dreams(
+        dream, config["RECURRING_MAX_DREAMS"], min_score=config["RECURRING_MIN_SCORE"]
+    )
+    return "\n\n".join(
+        f"{match.date} - {match.title}\n{match.content[:500]}" for match, _ in matches
+    )
+
+
+def build_insight_prompt(dream):
+    # Only the knowledge base entries matching this dream go into the prompt.
+    knowledge_base = get_knowledge_base().relevant_text(dream.content)
+    return prompts.INSIGHT_PROMPT.format(
+        content=dream.content,
+        knowledge_base=knowledge_base or "No matching entries.",
+        recurring_dreams=recurring_dreams_text(dream) or "None.",
+    )
+
+
+def insight_defaults(insight):
+    # Parsed once here so readers never see the scratchpad or re-parse the
+    # sections.
+    analysis, sections = prompts.parse_insight(insight)
+    return {
+        "summary": sections.get("dream_summary", analysis[:1000]),
+        "analysis": analysis,
+        "sections": sections,
+    }
+
+
+def generate_insight(dream):
+    prompt = build_insight_prompt(dream)
+    # Using a more capable model for this task
+    result = llm.generate(
+        prompt, model=llm.PRO_MODEL, endpoint="generate_insight", user=dream.user
+    )
+    defaults = insight_defaults(result.text)
+    DreamInsight.objects.update_or_create(dream=dream, defaults=defaults)
+    return defaults["analysis"]
+
+
+class ScratchpadFilter:
+    # Drops <scratchpad>...</scratchpad> from streamed text, holding back
+    # the end of a chunk while it could be the start of a tag.
+    def __init__(self):
+        self.buffer = ""
+        self.hidden = False
+
+    def feed(self, text):
+        self.buffer += text
+        visible = []
+        while True:
+            tag = prompts.SCRATCHPAD_CLOSE if self.hidden else prompts.SCRATCHPAD_OPEN
+            index = self.buffer.find(tag)
+            if index < 0:
+                break
+            if not self.hidden:
+                visible.append(self.buffer[:index])
+            self.buffer = self.buffer[index + len(tag):]
+            self.hidden = not self.hidden
+        keep = next(
+            (size for size in range(len(tag) - 1, 0, -1) if self.buffer.endswith(tag[:size])),
+            0,
+        )
+        if not self.hidden:
+            visible.append(self.buffer[: len(self.buffer) - keep])
+        self.buffer = self.buffer[len(self.buffer) - keep:]
+        return "".join(visible)
+
+    def flush(self):
+        rest = "" if self.hidden else self.buffer
+        self.buffer = ""
+        return rest
+
+
+async def astream_insight(dream):
+    # Yields the analysis as Gemini produces it, minus the scratchpad, and
+    # stores the parsed result once the stream completes. dream.user must
+    # already be loaded.
+    prompt = await sync_to_async(build_insight_prompt)(dream)
+    chunks = []
+    scratchpad = ScratchpadFilter()
+    async for chunk in llm.astream(
+        prompt, model=llm.PRO_MODEL, endpoint="generate_insight", user=dream.user
+    ):
+        chunks.append(chunk)
+        visible = scratchpad.feed(chunk)
+        if visible:
+            yield visible
+    rest = scratchpad.flush()
+    if rest:
+        yield rest
+    await DreamInsight.objects.aupdate_or_create(
+        dream=dream, defaults=insight_defaults("".join(chunks))
+    )
+
+
+def insight_job_key(dream_id):
+    return f"generate_insight:{dream_id}"
+
+
+def enqueue_insight(dream):
+    return jobs.enqueue(
+        "generate_insight",
+        {"dream_id": dream.id, "user_id": dream.user_id},
+        dedupe_key=insight_job_key(dream.id),
+    )
+
+
+def queued_insights(user_id):
+    return BackgroundJob.objects.filter(
+        kind="generate_insight",
+        status__in=BackgroundJob.ACTIVE_STATUSES,
+        payload__user_id=user_id,
+    ).count()
+
+
+def insight_slots_left(user):
+    # Queued jobs and open insight streams share the user's in-flight cap.
+    in_flight = queued_insights(user.pk) + throttling.in_flight("insight", user.pk)
+    return throttling.max_in_flight(user) - in_flight
+
+
+def run_insight_job(payload):
+    dream = Dream.objects.select_related("user").filter(pk=payload["dream_id"]).first()
+    if dream is None:
+        # Deleted while queued; nothing left to analyse.
+        return
+    generate_insight(dream)
@@ -0,0 +1,140 @@
+import logging
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import llm
+from .models import BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+# Job kind -> dotted path of a callable taking the job payload.
+JOB_HANDLERS = {
+    "generate_insight": "dreams.insights.run_insight_job",
+    "process_media": "dreams.media.run_media_job",
+}
+
+
+def enqueue(kind, payload, dedupe_key=None):
+    """Queue a job, returning (job, created).
+
+    If a pending or running job with the same dedupe key exists it is
+    returned instead of queueing a duplicate.
+    """
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    if dedupe_key is not None:
+        existing = active_job(dedupe_key)
+        if existing is not None:
+            return existing, False
+    try:
+        with transaction.atomic():
+            job = BackgroundJob.objects.create(
+                kind=kind,
+                payload=payload,
+                dedupe_key=dedupe_key,
+                max_attempts=settings.BACKGROUND_JOBS["MAX_ATTEMPTS"],
+            )
+    except IntegrityError:
+        # Lost a race with a concurrent request for the same key.
+        return active_job(dedupe_key), False
+    return job, True
+
+
+def active_job(dedupe_key):
+    return BackgroundJob.objects.filter(
+        dedupe_key=dedupe_key, status__in=BackgroundJob.ACTIVE_STATUSES
+    ).first()
+
+
+def latest_job(dedupe_key):
+    return (
+        BackgroundJob.objects.filter(dedupe_key=dedupe_key)
+        .order_by("-created_at")
+        .first()
+    )
+
+
+def _claimable():
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.BACKGROUND_JOBS["LOCK_TIMEOUT"])
+    return BackgroundJob.objects.filter(
+        Q(status=BackgroundJob.PENDING, run_after__lte=now)
+        # Jobs whose worker died mid-run.
+        | Q(status=BackgroundJob.RUNNING, locked_at__lt=stale)
+    )
+
+
+def claim_next(kinds=None):
+    candidates = _claimable()
+    if kinds:
+        candidates = candidates.filter(kind__in=kinds)
+    with transaction.atomic():
+        job = (
+            candidates.select_for_update(skip_locked=True)
+            .order_by("run_after", "id")
+            .first()
+        )
+        if job is None:
+            return None
+        # The conditional update keeps claiming safe on databases without
+        # row locks (SQLite): only one worker can move the row forward.
+        claimed = BackgroundJob.objects.filter(
+            pk=job.pk, status=job.status, attempts=job.attempts
+        ).update(
+            status=BackgroundJob.RUNNING,
+            locked_at=timezone.now(),
+            attempts=F("attempts") + 1,
+            updated_at=timezone.now(),
+        )
+    if not claimed:
+        return None
+    job.refresh_from_db()
+    return job
+
+
+def retry_delay(attempts):
+    config = settings.BACKGROUND_JOBS
+    delay = min(config["RETRY_BASE_DELAY"] * 2 ** (attempts - 1), config["RETRY_MAX_DELAY"])
+    return delay * random.uniform(0.8, 1.2)
+
+
+def run_job(job):
+    handler = import_string(JOB_HANDLERS[job.kind])
+    try:
+        handler(job.payload)
+    except Exception as exc:
+        job.error = f"{type(exc).__name__}: {exc}"
+        if llm.is_transient(exc) and job.attempts < job.max_attempts:
+            job.status = BackgroundJob.PENDING
+            delay = retry_delay(job.attempts)
+            if isinstance(exc, llm.CircuitOpen):
+                # No point trying again before the circuit lets calls through.
+                delay = max(delay, exc.retry_after)
+            job.run_after = timezone.now() + timedelta(seconds=delay)
+            logger.warning("Retrying %s after transient error: %s", job, job.error)
+        else:
+            job.status = BackgroundJob.FAILED
+            logger.exception("%s failed", job)
+    else:
+        job.status = BackgroundJob.DONE
+        job.error = ""
+    job.locked_at = None
+    job.save(update_fields=["status", "error", "run_after", "locked_at", "updated_at"])
+    return job
+
+
+def run_pending(limit=None, kinds=None):
+    processed = 0
+    while limit is None or processed < limit:
+        job = claim_next(kinds)
+        if job is None:
+            break
+        run_job(job)
+        processed += 1
+    return processed
@@ -0,0 +1,99 @@
+import math
+import re
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+
+from django.conf import settings
+
+STOPWORDS = frozenset(
+    """
+    a about after again all also am an and any are as at be been before being
+    but by can could did do does doing down during each for from had has have
+    having he her here hers him his how i if in into is it its itself just me
+    more most my myself no nor not now of off on once only or other our ours
+    out over own same she should so some such than that the their theirs them
+    then there these they this those through to too under until up very was we
+    were what when where which while who whom why will with would you your
+    dream dreams dreamed dreamt dreaming
+    """.split()
+)
+
+_token = re.compile(r"\w+", re.UNICODE)
+_heading = re.compile(r"^\s*(?:#+|[-*]|\d+[.)])?\s*(.*?)\s*:?\s*$")
+
+
+def tokenize(text):
+    tokens = []
+    for token in _token.findall(text.lower()):
+        if len(token) < 3 or token in STOPWORDS or token.isdigit():
+            continue
+        # Cheap plural folding so "snakes" finds the "Snake" entry.
+        if len(token) > 4 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+@dataclass(frozen=True)
+class Entry:
+    symbol: str
+    text: str
+
+
+class KnowledgeBase:
+    # Entries are the blank-line separated blocks of the knowledge file; the
+    # first line of a block names the symbol it describes.
+    SYMBOL_WEIGHT = 3.0
+
+    def __init__(self, text):
+        self.entries = [
+            Entry(symbol=_heading.match(block.split("\n", 1)[0]).group(1), text=block)
+            for block in (b.strip() for b in re.split(r"\n\s*\n", text))
+            if block
+        ]
+        self.index = defaultdict(dict)
+        for entry_id, entry in enumerate(self.entries):
+            postings = defaultdict(float)
+            for token in tokenize(entry.text):
+                postings[token] += 1.0
+            for token in tokenize(entry.symbol):
+                postings[token] += self.SYMBOL_WEIGHT
+            for token, weight in postings.items():
+                self.index[token][entry_id] = weight
+        total = len(self.entries)
+        self.idf = {
+            token: math.log(1 + total / len(postings))
+            for token, postings in self.index.items()
+        }
+
+    def search(self, content, limit):
+        scores = defaultdict(float)
+        for token in set(tokenize(content)):
+            postings = self.index.get(token)
+            if not postings:
+                continue
+            idf = self.idf[token]
+            for entry_id, weight in postings.items():
+                scores[entry_id] += idf * (1 + math.log(weight))
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [self.entries[entry_id] for entry_id, _ in ranked[:limit]]
+
+    def relevant_text(self, content, limit=None):
+        if limit is None:
+            limit = settings.KNOWLEDGE_BASE_MAX_ENTRIES
+        return "\n\n".join(entry.text for entry in self.search(content, limit))
+
+
+_knowledge_base = None
+_lock = threading.Lock()
+
+
+def get_knowledge_base():
+    global _knowledge_base
+    if _knowledge_base is None:
+        with _lock:
+            if _knowledge_base is None:
+                with open(settings.KNOWLEDGE_BASE_PATH, "r") as file:
+                    _knowledge_base = KnowledgeBase(file.read())
+    return _knowledge_base
@@ -0,0 +1,421 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+import google.generativeai as genai
+from asgiref.sync import sync_to_async
+from google.api_core import exceptions as google_exceptions
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import metrics, usage
+from .circuit import CircuitBreaker
+
+gemini_logger = logging.getLogger("gemini_usage")
+
+FLASH_MODEL = "gemini-1.5-flash"
+PRO_MODEL = "gemini-1.5-pro"
+
+DEFAULTS = {
+    "BACKEND": "gemini",
+    "API_KEY": None,
+    "TRANSPORT": None,
+    "TIMEOUT": 60.0,
+    "MAX_CONCURRENCY": 256,
+    "ACQUIRE_TIMEOUT": 5.0,
+    "FAKE_LATENCY": 0.0,
+    "FAKE_ERROR_RATE": 0.0,
+    "BREAKER_FAILURE_THRESHOLD": 5,
+    "BREAKER_RESET_TIMEOUT": 30.0,
+}
+
+
+class LLMError(Exception):
+    pass
+
+
+class LLMBusy(LLMError):
+    pass
+
+
+class CircuitOpen(LLMError):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Errors worth retrying later: upstream overload, timeouts, our own
+# concurrency limit and an open circuit breaker.
+TRANSIENT_ERRORS = (
+    LLMBusy,
+    CircuitOpen,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.InternalServerError,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.TooManyRequests,
+    asyncio.TimeoutError,
+    TimeoutError,
+    ConnectionError,
+)
+
+
+def is_transient(exc):
+    return isinstance(exc, TRANSIENT_ERRORS)
+
+
+@dataclass
+class LLMResponse:
+    text: str
+    # None when the backend reported no usage metadata.
+    prompt_tokens: Optional[int] = None
+    response_tokens: Optional[int] = None
+
+
+def log_gemini_usage(function_name, prompt_tokens, response_tokens, **fields):
+    gemini_logger.info(
+        f"{function_name}, Prompt tokens: {prompt_tokens}, Response tokens: {response_tokens}",
+        extra={
+            "fields": {
+                "endpoint": function_name,
+                "prompt_tokens": prompt_tokens,
+                "response_tokens": response_tokens,
+                **fields,
+            }
+        },
+    )
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, "GEMINI_CLIENT", {})}
+
+
+def estimate_tokens(text):
+    return len(text) // 4
+
+
+class GeminiBackend:
+    # genai.configure() builds fresh gRPC channels, so it is called once per
+    # process and GenerativeModel instances (which hold on to their client)
+    # are shared between requests.
+    def __init__(self, config):
+        self.config = config
+        options = {"api_key": config["API_KEY"]}
+        if config["TRANSPORT"]:
+            options["transport"] = config["TRANSPORT"]
+        genai.configure(**options)
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get_model(self, name):
+        model = self._models.get(name)
+        if model is None:
+            with self._lock:
+                model = self._models.setdefault(name, genai.GenerativeModel(name))
+        return model
+
+    def _request_options(self):
+        return {"timeout": self.config["TIMEOUT"]}
+
+    def _to_response(self, response, text):
+        # Counted by Gemini itself; a streamed response reports running
+        # totals on every chunk.
+        metadata = getattr(response, "usage_metadata", None)
+        if not metadata or not metadata.total_token_count:
+            return LLMResponse(text=text)
+        return LLMResponse(
+            text=text,
+            prompt_tokens=metadata.prompt_token_count,
+            response_tokens=metadata.candidates_token_count,
+        )
+
+    def generate(self, prompt, *, model, endpoint):
+        response = self.get_model(model).generate_content(
+            prompt, request_options=self._request_options()
+        )
+        return self._to_response(response, response.text)
+
+    async def agenerate(self, prompt, *, model, endpoint):
+        response = await self.get_model(model).generate_content_async(
+            prompt, request_options=self._request_options()
+        )
+        return self._to_response(response, response.text)
+
+    async def astream(self, prompt, *, model, endpoint):
+        response = await self.get_model(model).generate_content_async(
+            prompt, stream=True, request_options=self._request_options()
+        )
+        async for chunk in response:
+            yield self._to_response(chunk, chunk.text)
+
+
+FAKE_RESPONSES = {
+    "suggest_themes": "1. Adventure\n2. Mystery\n3. Nature",
+    "suggest_emotions": "1. Joy\n2. Anxiety\n3. Curiosity",
+    "suggest_title": "The Corridor That Kept Unfolding",
+    "suggest_all": (
+        "<title>The Corridor That Kept Unfolding</title>\n"
+        "<themes>\n1. Adventure\n2. Mystery\n3. Nature\n</themes>\n"
+        "<emotions>\n1. Joy\n2. Anxiety\n3. Curiosity\n</emotions>"
+    ),
+    "generate_insight": (
+        "<scratchpad>Offline analysis.</scratchpad>\n"
+        "<dream_summary>A dream generated by the fake Gemini backend.</dream_summary>\n"
+        "<emotional_landscape>Calm curiosity.</emotional_landscape>\n"
+        "<daily_affirmation>I welcome what my dreams show me.</daily_affirmation>"
+    ),
+}
+
+
+class FakeBackend:
+    # Offline stand-in used for local development, load and failure tests.
+    # It answers with canned text per endpoint after an optional artificial
+    # latency, and fails a FAKE_ERROR_RATE fraction of calls the way an
+    # overloaded Gemini would.
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random()
+
+    def _respond(self, prompt, endpoint):
+        return LLMResponse(text=FAKE_RESPONSES.get(endpoint, "1. Dream\n2. Sleep\n3. Night"))
+
+    def _maybe_fail(self):
+        if self.random.random() < self.config["FAKE_ERROR_RATE"]:
+            raise google_exceptions.ServiceUnavailable("Injected fake backend failure")
+
+    def generate(self, prompt, *, model, endpoint):
+        latency = self.config["FAKE_LATENCY"]
+        if latency:
+            # Like the real client, give up once the request timeout passes.
+            time.sleep(min(latency, self.config["TIMEOUT"]))
+            if latency > self.config["TIMEOUT"]:
+                raise google_exceptions.DeadlineExceeded("Fake backend timed out")
+        self._maybe_fail()
+        return self._respond(prompt, endpoint)
+
+    async def agenerate(self, prompt, *, model, endpoint):
+        if self.config["FAKE_LATENCY"]:
+            await asyncio.sleep(self.config["FAKE_LATENCY"])
+        self._maybe_fail()
+        return self._respond(prompt, endpoint)
+
+    async def astream(self, prompt, *, model, endpoint):
+        # Emits the canned response line by line, spreading the latency.
+        self._maybe_fail()
+        lines = self._respond(prompt, endpoint).text.splitlines(keepends=True)
+        for line in lines:
+            if self.config["FAKE_LATENCY"]:
+                await asyncio.sleep(self.config["FAKE_LATENCY"] / len(lines))
+            yield LLMResponse(text=line)
+
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "fake": FakeBackend,
+}
+
+
+class LLMClient:
+    """Process-wide entry point for model calls with bounded concurrency."""
+
+    def __init__(self, config):
+        self.config = config
+        self.backend = BACKENDS[config["BACKEND"]](config)
+        self._sync_slots = threading.BoundedSemaphore(config["MAX_CONCURRENCY"])
+        self._async_slots = weakref.WeakKeyDictionary()
+        self._breakers = {}
+        self._breaker_lock = threading.Lock()
+        for model in (FLASH_MODEL, PRO_MODEL):
+            self.get_breaker(model)
+
+    def get_breaker(self, model):
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            with self._breaker_lock:
+                breaker = self._breakers.setdefault(
+                    model,
+                    CircuitBreaker(
+                        model,
+                        self.config["BREAKER_FAILURE_THRESHOLD"],
+                        self.config["BREAKER_RESET_TIMEOUT"],
+                    ),
+                )
+        return breaker
+
+    def breaker_states(self):
+        return {model: breaker.snapshot() for model, breaker in self._breakers.items()}
+
+    @contextmanager
+    def _circuit(self, model):
+        # Fails fast while the model's circuit is open. Only upstream
+        # timeouts and overload count as failures; our own LLMBusy and
+        # non-transient errors (bad request, bad key) leave it untouched.
+        breaker = self.get_breaker(model)
+        if not breaker.allow():
+            raise CircuitOpen(f"{model} is temporarily unavailable", breaker.retry_after())
+        try:
+            yield
+        except Exception as exc:
+            if is_transient(exc) and not isinstance(exc, LLMError):
+                breaker.record_failure()
+            else:
+                breaker.release()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+
+    def _async_semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_slots.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.config["MAX_CONCURRENCY"])
+            self._async_slots[loop] = semaphore
+        return semaphore
+
+    def _record_usage(self, prompt, result, *, model, endpoint, user):
+        estimated = result.prompt_tokens is None
+        if estimated:
+            result.prompt_tokens = estimate_tokens(prompt)
+            result.response_tokens = estimate_tokens(result.text)
+        log_gemini_usage(
+            endpoint,
+            result.prompt_tokens,
+            result.response_tokens,
+            model=model,
+            user_id=user.pk if user is not None else None,
+            estimated=estimated,
+        )
+        metrics.count_gemini_tokens(model, endpoint, result.prompt_tokens, result.response_tokens)
+        if user is not None:
+            usage.record_usage(
+                user.pk, endpoint, result.prompt_tokens, result.response_tokens
+            )
+
+    def generate(self, prompt, *, model, endpoint, user=None):
+        if user is not None:
+            usage.check_quota(user)
+        # The deadline is enforced by the backend's request timeout.
+        with self._circuit(model):
+            if not self._sync_slots.acquire(timeout=self.config["ACQUIRE_TIMEOUT"]):
+                raise LLMBusy("Too many concurrent Gemini requests")
+            try:
+                with metrics.gemini_call(model, endpoint):
+                    result = self.backend.generate(prompt, model=model, endpoint=endpoint)
+            finally:
+                self._sync_slots.release()
+        self._record_usage(prompt, result, model=model, endpoint=endpoint, user=user)
+        return result
+
+    async def _acquire_async(self):
+        semaphore = self._async_semaphore()
+        try:
+            await asyncio.wait_for(
+                semaphore.acquire(), timeout=self.config["ACQUIRE_TIMEOUT"]
+            )
+        except asyncio.TimeoutError:
+            raise LLMBusy("Too many concurrent Gemini requests")
+        return semaphore
+
+    async def agenerate(self, prompt, *, model, endpoint, user=None):
+        if user is not None:
+            await sync_to_async(usage.check_quota)(user)
+        with self._circuit(model):
+            semaphore = await self._acquire_async()
+            try:
+                # Backstop for the request timeout, which does not cover
+                # every stage of an async call.
+                with metrics.gemini_call(model, endpoint):
+                    result = await asyncio.wait_for(
+                        self.backend.agenerate(prompt, model=model, endpoint=endpoint),
+                        timeout=self.config["TIMEOUT"],
+                    )
+            finally:
+                semaphore.release()
+        await sync_to_async(self._record_usage)(
+            prompt, result, model=model, endpoint=endpoint, user=user
+        )
+        return result
+
+    async def astream(self, prompt, *, model, endpoint, user=None):
+        if user is not None:
+            await sync_to_async(usage.check_quota)(user)
+        chunks = []
+        result = LLMResponse(text="")
+        with self._circuit(model):
+            semaphore = await self._acquire_async()
+            stream = self.backend.astream(prompt, model=model, endpoint=endpoint)
+            try:
+                with metrics.gemini_call(model, endpoint):
+                    while True:
+                        # A stream that stalls for TIMEOUT seconds is dead.
+                        try:
+                            chunk = await asyncio.wait_for(
+                                anext(stream), timeout=self.config["TIMEOUT"]
+                            )
+                        except StopAsyncIteration:
+                            break
+                        chunks.append(chunk.text)
+                        if chunk.prompt_tokens is not None:
+                            result = chunk
+                        yield chunk.text
+            finally:
+                semaphore.release()
+                await stream.aclose()
+        result = LLMResponse("".join(chunks), result.prompt_tokens, result.response_tokens)
+        await sync_to_async(self._record_usage)(
+            prompt, result, model=model, endpoint=endpoint, user=user
+        )
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = LLMClient(get_config())
+    return _client
+
+
+def reset_client():
+    global _client
+    with _client_lock:
+        _client = None
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(setting, **kwargs):
+    if setting == "GEMINI_CLIENT":
+        reset_client()
+
+
+def generate(prompt, *, model, endpoint, user=None):
+    return get_client().generate(prompt, model=model, endpoint=endpoint, user=user)
+
+
+async def agenerate(prompt, *, model, endpoint, user=None):
+    return await get_client().agenerate(prompt, model=model, endpoint=endpoint, user=user)
+
+
+async def astream(prompt, *, model, endpoint, user=None):
+    async for chunk in get_client().astream(
+        prompt, model=model, endpoint=endpoint, user=user
+    ):
+        yield chunk
+
+
+def breaker_states():
+    return get_client().breaker_states()
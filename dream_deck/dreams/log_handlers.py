@@ -0,0 +1,59 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; structured data is passed as
+    # extra={"fields": {...}}.
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class QueueFileHandler(QueueHandler):
+    # Logging calls only enqueue the record; a listener thread formats it and
+    # does the file I/O, so a slow disk never holds up a request.
+    def __init__(self, filename, encoding="utf-8"):
+        super().__init__(queue.SimpleQueue())
+        self.file_handler = logging.FileHandler(filename, encoding=encoding, delay=True)
+        self.listener = QueueListener(self.queue, self.file_handler)
+        self.listener.start()
+        atexit.register(self._stop_listener)
+
+    def _stop_listener(self):
+        # Flushes whatever is still queued.
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def setFormatter(self, fmt):
+        self.file_handler.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Unlike QueueHandler.prepare(), keep extras for the formatter and
+        # leave formatting to the listener thread.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def close(self):
+        self._stop_listener()
+        self.file_handler.close()
+        super().close()
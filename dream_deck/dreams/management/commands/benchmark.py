@@ -0,0 +1,141 @@
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (
+    override_settings,
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+    teardown_test_environment,
+)
+
+from dreams import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a synthetic dataset into a throwaway test database and measure the "
+        "latency and queries of every API route (Gemini is faked in-process)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20)
+        parser.add_argument("--dreams-per-user", type=int, default=50)
+        parser.add_argument("--emotions", type=int, default=20)
+        parser.add_argument("--themes", type=int, default=30)
+        parser.add_argument("--insight-ratio", type=float, default=0.5)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--iterations", type=int, default=50, help="Measured requests per scenario.")
+        parser.add_argument("--warmup", type=int, default=2)
+        parser.add_argument(
+            "--concurrency", type=int, default=1, help="Client threads per scenario (load test)."
+        )
+        parser.add_argument(
+            "--fake-latency", type=float, default=0.0, help="Seconds per fake Gemini call."
+        )
+        parser.add_argument(
+            "--scenario",
+            action="append",
+            dest="scenarios",
+            help="Only run scenarios whose name starts with this (repeatable).",
+        )
+        parser.add_argument("--list", action="store_true", help="List the scenarios and exit.")
+        parser.add_argument("--output", help="Write the results as JSON to this file.")
+        parser.add_argument("--compare", help="Results JSON of an earlier run to compare against.")
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=0.10,
+            help="Relative slowdown reported as a regression with --compare.",
+        )
+        parser.add_argument(
+            "--fail-on-regression",
+            action="store_true",
+            help="Exit with an error if --compare finds a regression.",
+        )
+
+    def handle(self, *args, **options):
+        scenarios = benchmarks.SCENARIOS
+        if options["scenarios"]:
+            prefixes = tuple(options["scenarios"])
+            scenarios = [s for s in scenarios if s.name.startswith(prefixes)]
+            if not scenarios:
+                raise CommandError("No scenario matches.")
+        if options["list"]:
+            for scenario in scenarios:
+                self.stdout.write(f"{scenario.name:32} {scenario.method:6} {scenario.path if isinstance(scenario.path, str) else '(per request)'}")
+            return
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = json.load(f)
+
+        report = self._run(scenarios, options)
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Wrote {options['output']}")
+        if baseline is not None:
+            self._compare(baseline, report, options)
+
+    def _run(self, scenarios, options):
+        sqlite_file = None
+        if connection.vendor == "sqlite" and options["concurrency"] > 1:
+            # An in-memory test database is private to one connection.
+            sqlite_file = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False).name
+            connection.settings_dict.setdefault("TEST", {})["NAME"] = sqlite_file
+        setup_test_environment()
+        databases = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+        try:
+            with override_settings(**benchmarks.settings_overrides(options["fake_latency"])):
+                self.stdout.write("Seeding...")
+                context = benchmarks.seed(
+                    users=options["users"],
+                    dreams_per_user=options["dreams_per_user"],
+                    emotions=options["emotions"],
+                    themes=options["themes"],
+                    insight_ratio=options["insight_ratio"],
+                    seed=options["seed"],
+                )
+                self.stdout.write(
+                    f"{'scenario':32} {'status':>12} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9} {'queries':>8}"
+                )
+                return benchmarks.run(
+                    context,
+                    scenarios,
+                    iterations=options["iterations"],
+                    warmup=options["warmup"],
+                    concurrency=options["concurrency"],
+                    progress=self._progress,
+                )
+        finally:
+            teardown_databases(databases, verbosity=0)
+            teardown_test_environment()
+            if sqlite_file is not None and os.path.exists(sqlite_file):
+                os.remove(sqlite_file)
+
+    def _progress(self, name, result):
+        statuses = ",".join(result["statuses"])
+        self.stdout.write(
+            f"{name:32} {statuses:>12} {result['p50_ms']:9.2f} {result['p95_ms']:9.2f} "
+            f"{result['p99_ms']:9.2f} {result['requests_per_second']:9.1f} {result['queries_mean']:8.1f}"
+        )
+
+    def _compare(self, baseline, report, options):
+        rows = benchmarks.compare(baseline, report, options["threshold"])
+        self.stdout.write(
+            f"\nCompared with {baseline['meta'].get('commit') or options['compare']}:"
+        )
+        regressions = 0
+        for name, metric, before, after, change, regressed in rows:
+            if abs(change) < 0.005:
+                continue
+            marker = "  REGRESSION" if regressed else ""
+            regressions += regressed
+            self.stdout.write(f"{name:32} {metric:13} {before:10.2f} -> {after:10.2f} {change:+8.1%}{marker}")
+        if regressions and options["fail_on_regression"]:
+            raise CommandError(f"{regressions} regression(s) above {options['threshold']:.0%}")
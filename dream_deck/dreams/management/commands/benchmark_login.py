@@ -0,0 +1,112 @@
+import os
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from django.test import Client
+from django.test.utils import (
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+    teardown_test_environment,
+)
+
+from dreams.models import User
+
+PASSWORD = "benchmark-password-1"
+
+
+class Command(BaseCommand):
+    help = "Measure login throughput and latency with concurrent clients, in a throwaway test database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--host", default="localhost", help="Host header (must be allowed).")
+        parser.add_argument(
+            "--wrong-password-ratio",
+            type=float,
+            default=0.1,
+            help="Fraction of attempts with a wrong password.",
+        )
+
+    def handle(self, *args, **options):
+        sqlite_file = None
+        if connection.vendor == "sqlite" and options["concurrency"] > 1:
+            # An in-memory test database is private to one connection.
+            sqlite_file = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False).name
+            connection.settings_dict.setdefault("TEST", {})["NAME"] = sqlite_file
+        setup_test_environment()
+        databases = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+        try:
+            encoded = make_password(PASSWORD)
+            User.objects.bulk_create(
+                User(username=f"bench-login-{i}", email=f"bench-login-{i}@example.com", password=encoded)
+                for i in range(options["users"])
+            )
+            self._run(options)
+        finally:
+            teardown_databases(databases, verbosity=0)
+            teardown_test_environment()
+            if sqlite_file is not None and os.path.exists(sqlite_file):
+                os.remove(sqlite_file)
+
+    def _run(self, options):
+        total = options["requests"]
+        counter = iter(range(total))
+        lock = threading.Lock()
+        latencies = []
+        statuses = Counter()
+
+        def attempt(i):
+            user = i % options["users"]
+            # Alternate between usernames and emails.
+            login = f"bench-login-{user}" if i % 2 else f"bench-login-{user}@example.com"
+            wrong = (i * 7919 % 1000) < options["wrong_password_ratio"] * 1000
+            client = Client(HTTP_HOST=options["host"])
+            started = time.perf_counter()
+            response = client.post(
+                "/api/v1/login/",
+                {"usernameOrEmail": login, "password": "wrong" if wrong else PASSWORD},
+                content_type="application/json",
+            )
+            return time.perf_counter() - started, response.status_code
+
+        def worker():
+            try:
+                while True:
+                    with lock:
+                        i = next(counter, None)
+                    if i is None:
+                        return
+                    latency, status = attempt(i)
+                    with lock:
+                        latencies.append(latency)
+                        statuses[status] += 1
+            finally:
+                close_old_connections()
+
+        attempt(0)  # warm up imports and connections
+        threads = [threading.Thread(target=worker) for _ in range(options["concurrency"])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        percentile = lambda p: latencies[min(int(p * len(latencies)), len(latencies) - 1)] * 1000
+        self.stdout.write(
+            f"{total} logins, concurrency {options['concurrency']}: "
+            f"{total / elapsed:.1f} logins/s, "
+            f"mean {statistics.mean(latencies) * 1000:.1f} ms, "
+            f"p50 {percentile(0.5):.1f} ms, p95 {percentile(0.95):.1f} ms, p99 {percentile(0.99):.1f} ms, "
+            f"statuses {dict(sorted(statuses.items()))}"
+        )
@@ -0,0 +1,30 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from dreams import jobs, media
+
+
+class Command(BaseCommand):
+    help = "Queue process_media jobs for uploads that have no renditions yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Also redo uploads that were already processed (e.g. after installing ffmpeg).",
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        for label, (source, _) in media.SOURCES.items():
+            model = apps.get_model(label)
+            _, marker, _ = media.rendition_fields(label)
+            uploads = model.objects.exclude(Q(**{f"{source}__isnull": True}) | Q(**{source: ""}))
+            if options["force"]:
+                uploads.update(**{marker: None})
+            pks = uploads.filter(**{f"{marker}__isnull": True}).values_list("pk", flat=True)
+            for pk in pks.iterator():
+                jobs.enqueue("process_media", {"model": label, "pk": pk})
+                total += 1
+        self.stdout.write(f"Queued {total} upload(s)")
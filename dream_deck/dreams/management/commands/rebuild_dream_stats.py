@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from dreams.models import User
+from dreams.stats import rebuild_user_stats
+
+
+class Command(BaseCommand):
+    help = "Recompute the precomputed dream statistics of every user from scratch."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, action="append", dest="user_ids")
+
+    def handle(self, *args, **options):
+        user_ids = options["user_ids"]
+        if not user_ids:
+            user_ids = User.objects.order_by("id").values_list("id", flat=True).iterator()
+        total = 0
+        for user_id in user_ids:
+            rebuild_user_stats(user_id)
+            total += 1
+        self.stdout.write(f"Rebuilt dream stats for {total} user(s)")
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from dreams.embeddings import embed_dreams
+from dreams.models import Dream
+
+
+class Command(BaseCommand):
+    help = "Compute the similarity embeddings of all dreams with the configured embedder."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        dreams = Dream.objects.only("id", "user_id", "title", "content").order_by("id")
+        batch = []
+        total = 0
+        for dream in dreams.iterator(chunk_size=options["batch_size"]):
+            batch.append(dream)
+            if len(batch) == options["batch_size"]:
+                embed_dreams(batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            embed_dreams(batch)
+            total += len(batch)
+        self.stdout.write(f"Embedded {total} dream(s)")
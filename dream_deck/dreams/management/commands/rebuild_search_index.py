@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from dreams.models import Dream
+from dreams.search import index_dreams
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search documents for all dreams."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        ids = Dream.objects.order_by("id").values_list("id", flat=True)
+        batch = []
+        total = 0
+        for dream_id in ids.iterator(chunk_size=options["batch_size"]):
+            batch.append(dream_id)
+            if len(batch) == options["batch_size"]:
+                index_dreams(batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            index_dreams(batch)
+            total += len(batch)
+        self.stdout.write(f"Indexed {total} dream(s)")
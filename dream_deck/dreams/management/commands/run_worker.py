@@ -0,0 +1,59 @@
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from dreams import jobs
+
+
+class Command(BaseCommand):
+    help = "Process queued background jobs (e.g. dream insight generation)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once", action="store_true", help="Drain the queue once and exit."
+        )
+        parser.add_argument(
+            "--threads", type=int, default=1, help="Number of worker threads."
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=1.0,
+            help="Seconds to wait when the queue is empty.",
+        )
+        parser.add_argument(
+            "--kind", action="append", dest="kinds", help="Only run jobs of this kind."
+        )
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        threads = [
+            threading.Thread(target=self._loop, args=(options, stop), daemon=True)
+            for _ in range(options["threads"])
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            stop.set()
+            self.stdout.write("Stopping workers...")
+            for thread in threads:
+                thread.join()
+
+    def _loop(self, options, stop):
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                processed = jobs.run_pending(limit=1, kinds=options["kinds"])
+                if processed:
+                    self.stdout.write(f"Processed {processed} job(s)")
+                    continue
+                if options["once"]:
+                    break
+                stop.wait(options["sleep"])
+        finally:
+            close_old_connections()
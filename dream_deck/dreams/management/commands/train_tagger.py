@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from dreams import tagger
+from dreams.models import TaggerModel
+
+
+class Command(BaseCommand):
+    help = "Train the local theme and emotion suggesters from the tags users gave their dreams."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--kind", choices=[TaggerModel.THEMES, TaggerModel.EMOTIONS])
+        parser.add_argument(
+            "--evaluate",
+            action="store_true",
+            help="Also report coverage and precision on a 10%% holdout at the configured confidence.",
+        )
+
+    def handle(self, *args, **options):
+        kinds = [options["kind"]] if options["kind"] else list(tagger.SOURCES)
+        for kind in kinds:
+            if options["evaluate"]:
+                result = tagger.evaluate(kind)
+                self.stdout.write(
+                    f"{kind}: {result['tested']} held-out dream(s), answered locally "
+                    f"{result['coverage']:.1%}, precision {result['precision']:.1%}"
+                )
+            model = tagger.train(kind)
+            if model is None:
+                self.stdout.write(f"{kind}: no tagged dreams to train on")
+                continue
+            self.stdout.write(
+                f"{kind}: trained on {model.document_count} dream(s), "
+                f"{len(model.vocabulary)} terms, {len(model.label_ids)} labels"
+            )
@@ -0,0 +1,259 @@
+import io
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import wave
+from contextlib import contextmanager
+
+import numpy as np
+from django.apps import apps
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from PIL import ExifTags, Image, ImageOps
+
+from . import jobs, versions
+
+logger = logging.getLogger(__name__)
+
+AUDIO = "audio"
+IMAGE = "image"
+
+# Uploaded file field per model and what is made from it by the process_media
+# job. The first rendition field is the file it writes; the second stays null
+# until the upload has been processed.
+SOURCES = {
+    "dreams.dream": ("audio_recording", AUDIO),
+    "dreams.soundtrackgeneration": ("audio_file", AUDIO),
+    "dreams.dreammeditation": ("audio_file", AUDIO),
+    "dreams.artworkgeneration": ("image", IMAGE),
+}
+RENDITION_FIELDS = {
+    AUDIO: ("audio_preview", "audio_duration", "audio_peaks"),
+    IMAGE: ("thumbnail", "width", "height"),
+}
+
+# Waveform peaks are first taken per 100 ms window while decoding, so long
+# recordings never have to be held in memory as samples.
+WINDOWS_PER_SECOND = 10
+PEAK_SAMPLE_RATE = 8000
+READ_SIZE = 64 * 1024
+
+
+class MediaError(Exception):
+    pass
+
+
+def rendition_fields(label):
+    return RENDITION_FIELDS[SOURCES[label][1]]
+
+
+class PeakCollector:
+    # Absolute maximum per window of the mono samples fed in, in [-1, 1].
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.window = max(sample_rate // WINDOWS_PER_SECOND, 1)
+        self.maxima = []
+        self.samples = 0
+        self._rest = np.empty(0, dtype=np.float32)
+
+    def feed(self, samples):
+        self.samples += len(samples)
+        samples = np.abs(np.concatenate([self._rest, samples]))
+        full = len(samples) - len(samples) % self.window
+        if full:
+            self.maxima.extend(samples[:full].reshape(-1, self.window).max(axis=1).tolist())
+        self._rest = samples[full:]
+
+    def duration(self):
+        return self.samples / self.sample_rate
+
+    def peaks(self, count):
+        maxima = self.maxima + ([float(self._rest.max())] if len(self._rest) else [])
+        if not maxima:
+            return []
+        if len(maxima) > count:
+            maxima = [float(bucket.max()) for bucket in np.array_split(np.array(maxima), count)]
+        return [round(min(value, 1.0), 3) for value in maxima]
+
+
+def _ffmpeg():
+    return shutil.which(settings.MEDIA_PROCESSING["FFMPEG"])
+
+
+def analyze_audio(path, preview_path=None):
+    """Return (duration, peaks) and write a compressed preview if asked.
+
+    With ffmpeg the file is decoded once for both; without it only WAV files
+    can be measured and no preview is written (duration and peaks are None
+    for anything else).
+    """
+    config = settings.MEDIA_PROCESSING
+    ffmpeg = _ffmpeg()
+    if ffmpeg is None:
+        return _analyze_wav(path, config["WAVEFORM_PEAKS"])
+
+    command = [ffmpeg, "-v", "error", "-nostdin", "-y", "-i", path]
+    if preview_path is not None:
+        command += [
+            "-map", "0:a:0", "-vn", "-ac", "1",
+            "-c:a", "aac", "-b:a", config["AUDIO_BITRATE"],
+            "-movflags", "+faststart", preview_path,
+        ]
+    command += ["-map", "0:a:0", "-ac", "1", "-ar", str(PEAK_SAMPLE_RATE), "-f", "s16le", "pipe:1"]
+
+    collector = PeakCollector(PEAK_SAMPLE_RATE)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Read stderr alongside stdout so neither pipe can fill up and stall ffmpeg.
+    errors = []
+    reader = threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True)
+    reader.start()
+    killer = threading.Timer(config["TIMEOUT"], process.kill)
+    killer.start()
+    try:
+        pending = b""
+        while chunk := process.stdout.read(READ_SIZE):
+            chunk = pending + chunk
+            usable = len(chunk) - len(chunk) % 2
+            pending = chunk[usable:]
+            collector.feed(np.frombuffer(chunk[:usable], dtype="<i2").astype(np.float32) / 32768)
+        returncode = process.wait()
+    finally:
+        killer.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    reader.join()
+    if returncode != 0:
+        message = (errors[0] if errors else b"").decode(errors="replace").strip()
+        raise MediaError(f"ffmpeg exited with {returncode}: {message[-500:]}")
+    return collector.duration(), collector.peaks(config["WAVEFORM_PEAKS"])
+
+
+def _analyze_wav(path, count):
+    try:
+        recording = wave.open(path, "rb")
+    except (wave.Error, EOFError):
+        logger.info("No ffmpeg available to analyze %s", path)
+        return None, None
+    with recording:
+        channels = recording.getnchannels()
+        width = recording.getsampwidth()
+        if width not in (1, 2, 4):
+            return None, None
+        collector = PeakCollector(recording.getframerate())
+        while frames := recording.readframes(READ_SIZE // (width * channels) or 1):
+            if width == 1:
+                samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+            else:
+                dtype = "<i2" if width == 2 else "<i4"
+                samples = np.frombuffer(frames, dtype=dtype).astype(np.float32) / 2 ** (8 * width - 1)
+            samples = samples[: len(samples) - len(samples) % channels]
+            collector.feed(np.abs(samples.reshape(-1, channels)).max(axis=1))
+    return collector.duration(), collector.peaks(count)
+
+
+def make_thumbnail(path):
+    """Return (width, height, WebP bytes) for the image at path."""
+    config = settings.MEDIA_PROCESSING
+    size = config["THUMBNAIL_SIZE"]
+    with Image.open(path) as image:
+        width, height = image.size
+        if image.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+            width, height = height, width
+        # Lets JPEG decode straight at a fraction of the full resolution.
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        output = io.BytesIO()
+        image.save(output, "WEBP", quality=config["THUMBNAIL_QUALITY"])
+    return width, height, output.getvalue()
+
+
+@contextmanager
+def local_copy(storage, name):
+    # A filesystem path to the stored file; remote storages are copied to a
+    # temporary file chunk by chunk.
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        path = None
+    if path is not None:
+        yield path
+    else:
+        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(name)[1]) as copy:
+            with storage.open(name, "rb") as source:
+                for chunk in source.chunks():
+                    copy.write(chunk)
+            copy.flush()
+            yield copy.name
+
+
+def _rendition_name(name, extension):
+    return os.path.splitext(os.path.basename(name))[0] + extension
+
+
+def _render(model, kind, storage, name):
+    # Returns the rendition field values, saving the rendition file.
+    file_field, first, second = RENDITION_FIELDS[kind]
+    target = model._meta.get_field(file_field)
+    with local_copy(storage, name) as path:
+        if kind == IMAGE:
+            width, height, data = make_thumbnail(path)
+            thumbnail = target.generate_filename(None, _rendition_name(name, ".webp"))
+            return {
+                file_field: target.storage.save(thumbnail, ContentFile(data)),
+                first: width,
+                second: height,
+            }
+        preview = None
+        with tempfile.TemporaryDirectory() as directory:
+            preview_path = os.path.join(directory, "preview.m4a")
+            duration, peaks = analyze_audio(path, preview_path)
+            if os.path.exists(preview_path):
+                with open(preview_path, "rb") as output:
+                    preview = target.storage.save(
+                        target.generate_filename(None, _rendition_name(name, ".m4a")), File(output)
+                    )
+        return {file_field: preview, first: duration, second: peaks}
+
+
+def process(label, pk):
+    model = apps.get_model(label)
+    source, kind = SOURCES[label]
+    file_field, marker, _ = RENDITION_FIELDS[kind]
+    storage = model._meta.get_field(source).storage
+    rendition_storage = model._meta.get_field(file_field).storage
+    while True:
+        row = model.objects.filter(pk=pk).values_list(source, marker, file_field).first()
+        if row is None or not row[0] or row[1] is not None:
+            # Deleted, no upload, or already processed (e.g. by a duplicate job).
+            return False
+        name, _, previous = row
+        values = _render(model, kind, storage, name)
+        if values[marker] is None and values[file_field] is None:
+            return False
+        updated = model.objects.filter(pk=pk, **{source: name, f"{marker}__isnull": True}).update(**values)
+        if updated:
+            if previous and previous != values[file_field]:
+                rendition_storage.delete(previous)
+            if label == "dreams.dream":
+                versions.record_dreams([pk])
+            return True
+        # Replaced or processed while we worked: drop ours and look again.
+        if values[file_field]:
+            rendition_storage.delete(values[file_field])
+
+
+def run_media_job(payload):
+    process(payload["model"], payload["pk"])
+
+
+def enqueue(instance):
+    label = instance._meta.label_lower
+    return jobs.enqueue("process_media", {"model": label, "pk": instance.pk})
@@ -0,0 +1,282 @@
+import bisect
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from rest_framework.renderers import JSONRenderer
+
+# Request and Gemini metrics, kept in memory and served at /metrics in the
+# Prometheus text format. MetricsMiddleware times each request; the queries
+# it makes are counted by a wrapper on every database connection and the time
+# spent rendering its body by TimedJSONRenderer. Values are per process: with
+# several worker processes, each of them has to be scraped.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+GEMINI_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self.values.items())
+        for labels, value in sorted(values):
+            yield f"{self.name}{_labels(self.labels, labels)} {_number(value)}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket (last one +Inf)..., sum]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self.values.items()]
+        for labels, counts in sorted(values):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.labels, labels, [('le', _number(bound))])} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {_number(counts[-1])}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time to produce the response (streamed bodies excluded).",
+    ("method", "view", "status"),
+    LATENCY_BUCKETS,
+)
+REQUEST_QUERIES = Histogram(
+    "http_request_db_queries", "Database queries per request.", ("method", "view"), QUERY_BUCKETS
+)
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_duration_seconds",
+    "Time per request spent in database queries.",
+    ("method", "view"),
+    LATENCY_BUCKETS,
+)
+RENDER_SECONDS = Histogram(
+    "http_response_render_duration_seconds",
+    "Time per request spent serializing the response body.",
+    ("method", "view"),
+    LATENCY_BUCKETS,
+)
+GEMINI_SECONDS = Histogram(
+    "gemini_request_duration_seconds",
+    "Duration of Gemini calls, without the wait for a concurrency slot.",
+    ("model", "endpoint", "outcome"),
+    GEMINI_BUCKETS,
+)
+GEMINI_TOKENS = Counter(
+    "gemini_tokens_total", "Gemini tokens used (estimated when not reported).", ("model", "endpoint", "kind")
+)
+
+REGISTRY = [
+    REQUEST_SECONDS,
+    REQUEST_QUERIES,
+    REQUEST_DB_SECONDS,
+    RENDER_SECONDS,
+    GEMINI_SECONDS,
+    GEMINI_TOKENS,
+]
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds", "render_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = None
+
+
+# Also seen by code run through sync_to_async/async_to_sync, which copy the
+# context.
+_current = ContextVar("request_stats", default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_seconds += time.perf_counter() - started
+
+
+def install_query_hook(connection):
+    if record_query not in connection.execute_wrappers:
+        # In front, so that connection.execute_wrapper() blocks, which pop
+        # the last wrapper on exit, still remove their own.
+        connection.execute_wrappers.insert(0, record_query)
+
+
+class TimedJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        stats = _current.get()
+        if stats is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        started = time.perf_counter()
+        try:
+            return super().render(data, accepted_media_type, renderer_context)
+        finally:
+            stats.render_seconds = (stats.render_seconds or 0.0) + time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._record(request, response, stats, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._record(request, response, stats, time.perf_counter() - started)
+        return response
+
+    def _record(self, request, response, stats, seconds):
+        # View names rather than paths keep the number of series bounded.
+        match = request.resolver_match
+        view = match.view_name if match is not None else "unmatched"
+        method = request.method if request.method in METHODS else "other"
+        REQUEST_SECONDS.observe((method, view, str(response.status_code)), seconds)
+        REQUEST_QUERIES.observe((method, view), stats.queries)
+        REQUEST_DB_SECONDS.observe((method, view), stats.db_seconds)
+        if stats.render_seconds is not None:
+            RENDER_SECONDS.observe((method, view), stats.render_seconds)
+
+
+@contextmanager
+def gemini_call(model, endpoint):
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        GEMINI_SECONDS.observe((model, endpoint, outcome), time.perf_counter() - started)
+
+
+def count_gemini_tokens(model, endpoint, prompt_tokens, response_tokens):
+    GEMINI_TOKENS.inc((model, endpoint, "prompt"), prompt_tokens or 0)
+    GEMINI_TOKENS.inc((model, endpoint, "response"), response_tokens or 0)
+
+
+def _circuit_lines():
+    from . import llm
+
+    states = llm.breaker_states()
+    for name, field, kind, help in (
+        ("gemini_circuit_state", "state_value", "gauge", "Circuit state (0 closed, 1 half-open, 2 open)."),
+        ("gemini_circuit_opened_total", "opened_total", "counter", "Times the circuit opened."),
+        ("gemini_circuit_rejected_total", "rejected_total", "counter", "Calls rejected while open."),
+    ):
+        yield f"# HELP {name} {help}"
+        yield f"# TYPE {name} {kind}"
+        for model, snapshot in sorted(states.items()):
+            yield f"{name}{_labels(('model',), (model,))} {snapshot[field]}"
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    lines.extend(_circuit_lines())
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    token = settings.METRICS["TOKEN"]
+    if not token:
+        # Without a token, metrics are only served in development.
+        if not settings.DEBUG:
+            return HttpResponseForbidden()
+    elif not hmac.compare_digest(
+        request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()
+    ):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
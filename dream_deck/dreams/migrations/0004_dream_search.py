@@ -0,0 +1,57 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:12
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+SEARCH_CONFIG = 'simple'
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX dream_search_vector_gin ON dreams_dream USING GIN (search_vector)'
+        )
+        schema_editor.execute(
+            "UPDATE dreams_dream d SET search_vector = "
+            "setweight(to_tsvector(%s, coalesce(d.title, '')), 'A') || "
+            "setweight(to_tsvector(%s, coalesce(d.content, '')), 'B') || "
+            "setweight(to_tsvector(%s, coalesce(("
+            "SELECT i.analysis FROM dreams_dreaminsight i WHERE i.dream_id = d.id"
+            "), '')), 'C')",
+            [SEARCH_CONFIG] * 3,
+        )
+    elif connection.vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE dreams_dream_fts USING fts5('
+            "title, content, analysis, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        schema_editor.execute(
+            'INSERT INTO dreams_dream_fts (rowid, title, content, analysis) '
+            "SELECT d.id, d.title, d.content, COALESCE(i.analysis, '') "
+            'FROM dreams_dream d LEFT JOIN dreams_dreaminsight i ON i.dream_id = d.id'
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS dream_search_vector_gin')
+    elif connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS dreams_dream_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreams', '0003_backgroundjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dream',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
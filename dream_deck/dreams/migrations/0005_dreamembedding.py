@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreams', '0004_dream_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DreamEmbedding',
+            fields=[
+                ('dream', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='embedding', serialize=False, to='dreams.dream')),
+                ('embedder', models.CharField(max_length=100)),
+                ('vector', models.BinaryField()),
+                ('updated_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreams', '0005_dreamembedding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DreamStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='dream_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('dream_count', models.IntegerField(default=0)),
+                ('lucid_count', models.IntegerField(default=0)),
+                ('daily_counts', models.JSONField(default=dict)),
+                ('emotion_counts', models.JSONField(default=dict)),
+                ('theme_counts', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreams', '0006_dreamstats'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='dream',
+            options={'ordering': ['-date', '-id']},
+        ),
+        migrations.AlterField(
+            model_name='collaborativedream',
+            name='prompt',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='collaborative_dreams', to='dreams.dreamprompt'),
+        ),
+        migrations.AlterField(
+            model_name='dream',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='dreams', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='dreamemotion',
+            name='dream',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='emotions', to='dreams.dream'),
+        ),
+        migrations.AlterField(
+            model_name='dreamemotion',
+            name='emotion',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='dreams.emotion'),
+        ),
+        migrations.AlterField(
+            model_name='dreamtheme',
+            name='dream',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='themes', to='dreams.dream'),
+        ),
+        migrations.AlterField(
+            model_name='dreamtheme',
+            name='theme',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='dreams.theme'),
+        ),
+        migrations.AddIndex(
+            model_name='collaborativedream',
+            index=models.Index(fields=['prompt', '-created_at'], name='collabdream_prompt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dream',
+            index=models.Index(fields=['user', '-date', '-id'], name='dream_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dream',
+            index=models.Index(fields=['-date', '-id'], name='dream_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dreamchallenge',
+            index=models.Index(fields=['start_date', 'end_date'], name='challenge_dates_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dreamemotion',
+            index=models.Index(fields=['emotion', 'dream', 'intensity'], name='dreamemotion_emotion_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dreamtheme',
+            index=models.Index(fields=['theme', 'dream'], name='dreamtheme_theme_idx'),
+        ),
+    ]
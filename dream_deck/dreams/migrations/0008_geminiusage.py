@@ -0,0 +1,31 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:23
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreams', '0007_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeminiUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('endpoint', models.CharField(max_length=50)),
+                ('requests', models.PositiveIntegerField(default=0)),
+                ('prompt_tokens', models.PositiveBigIntegerField(default=0)),
+                ('response_tokens', models.PositiveBigIntegerField(default=0)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='gemini_usage', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='geminiusage',
+            constraint=models.UniqueConstraint(fields=('user', 'day', 'endpoint'), name='unique_usage_per_user_day_endpoint'),
+        ),
+    ]
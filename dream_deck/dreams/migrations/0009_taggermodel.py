@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreams', '0008_geminiusage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaggerModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('themes', 'Themes'), ('emotions', 'Emotions')], max_length=20, unique=True)),
+                ('dream_count', models.IntegerField()),
+                ('data', models.BinaryField()),
+                ('trained_at', models.DateTimeField()),
+            ],
+        ),
+    ]
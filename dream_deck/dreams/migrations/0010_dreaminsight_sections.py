@@ -0,0 +1,64 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:33
+
+import re
+
+from django.db import migrations, models
+
+# A frozen copy of dreams.prompts.parse_insight as of this migration, so
+# later changes to the live parser do not change the backfill.
+SECTIONS = [
+    'dream_summary',
+    'emotional_landscape',
+    'symbolic_analysis',
+    'narrative_interpretation',
+    'personal_growth_insights',
+    'cultural_perspective',
+    'recurring_themes',
+    'lucid_dreaming_potential',
+    'artistic_inspiration',
+    'daily_affirmation',
+]
+
+SCRATCHPAD = re.compile(r'<scratchpad>.*?(?:</scratchpad>|$)', re.DOTALL)
+
+
+def parse_insight(text):
+    analysis = SCRATCHPAD.sub('', text).strip()
+    sections = {}
+    for name in SECTIONS:
+        match = re.search(rf'<{name}>(.*?)</{name}>', analysis, re.DOTALL)
+        body = match.group(1).strip() if match else ''
+        if body:
+            sections[name] = body
+    return analysis, sections
+
+
+def parse_existing_insights(apps, schema_editor):
+    # Strip the scratchpad from stored analyses and split them into sections.
+    DreamInsight = apps.get_model('dreams', 'DreamInsight')
+    batch = []
+    for insight in DreamInsight.objects.only('id', 'summary', 'analysis').iterator(chunk_size=500):
+        insight.analysis, insight.sections = parse_insight(insight.analysis)
+        insight.summary = insight.sections.get('dream_summary', insight.analysis[:1000])
+        batch.append(insight)
+        if len(batch) == 500:
+            DreamInsight.objects.bulk_update(batch, ['summary', 'analysis', 'sections'])
+            batch = []
+    if batch:
+        DreamInsight.objects.bulk_update(batch, ['summary', 'analysis', 'sections'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreams', '0009_taggermodel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dreaminsight',
+            name='sections',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.RunPython(parse_existing_insights, migrations.RunPython.noop),
+    ]
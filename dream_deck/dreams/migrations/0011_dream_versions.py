@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:35
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreams', '0010_dreaminsight_sections'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DreamVersion',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='dream_version', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('version', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='dream',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
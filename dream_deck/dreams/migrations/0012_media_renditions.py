@@ -0,0 +1,73 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreams', '0011_dream_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='artworkgeneration',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='artworkgeneration',
+            name='thumbnail',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='dream_artworks/thumbnails/'),
+        ),
+        migrations.AddField(
+            model_name='artworkgeneration',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='dream',
+            name='audio_duration',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='dream',
+            name='audio_peaks',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='dream',
+            name='audio_preview',
+            field=models.FileField(blank=True, editable=False, null=True, upload_to='dream_recordings/previews/'),
+        ),
+        migrations.AddField(
+            model_name='dreammeditation',
+            name='audio_duration',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='dreammeditation',
+            name='audio_peaks',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='dreammeditation',
+            name='audio_preview',
+            field=models.FileField(blank=True, editable=False, null=True, upload_to='dream_meditations/previews/'),
+        ),
+        migrations.AddField(
+            model_name='soundtrackgeneration',
+            name='audio_duration',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='soundtrackgeneration',
+            name='audio_peaks',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='soundtrackgeneration',
+            name='audio_preview',
+            field=models.FileField(blank=True, editable=False, null=True, upload_to='dream_soundtracks/previews/'),
+        ),
+    ]
@@ -1,4 +1,8 @@
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import MinValueValidator, MaxValueValidator
 
@@ -21,17 +25,56 @@ class User(AbstractUser):
     bio = models.TextField(blank=True)
     date_of_birth = models.DateField(null=True, blank=True)
     is_premium = models.BooleanField(default=False)
+    # Embedded in JWTs (dreams/authentication.py); bumped on password change
+    # to revoke every token issued before.
+    token_version = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Case-insensitive login by email or username
+            # (auth_views.find_login_user).
+            models.Index(Lower('email'), name='user_email_lower_idx'),
+            models.Index(Lower('username'), name='user_username_lower_idx'),
+        ]
     
     def __str__(self):
         return self.username
 
+class DreamManager(models.Manager):
+    def get_queryset(self):
+        # The search document is only ever read by the database itself.
+        return super().get_queryset().defer('search_vector')
+
 class Dream(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='dreams')
+    # Indexed through dream_user_date_idx below.
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='dreams', db_index=False)
     title = models.CharField(max_length=255)
     content = models.TextField()
     date = models.DateField(auto_now_add=True)
+    # Also moved forward when the dream's emotions, themes or insight change
+    # (dreams/versions.py), so it covers everything DreamSerializer renders.
+    updated_at = models.DateTimeField(auto_now=True)
     is_lucid = models.BooleanField(default=False)
     audio_recording = models.FileField(upload_to='dream_recordings/', null=True, blank=True)
+    # Compressed rendition, duration and waveform of the recording, filled in
+    # by the process_media job (dreams/media.py).
+    audio_preview = models.FileField(upload_to='dream_recordings/previews/', null=True, blank=True, editable=False)
+    audio_duration = models.FloatField(null=True, blank=True, editable=False)
+    audio_peaks = models.JSONField(null=True, blank=True, editable=False)
+    # Weighted title/content/insight document maintained by dreams/search.py
+    # (PostgreSQL only; SQLite uses the dreams_dream_fts table instead).
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = DreamManager()
+
+    class Meta:
+        ordering = ['-date', '-id']
+        indexes = [
+            # A user's journal, newest first (DreamCursorPagination order).
+            models.Index(fields=['user', '-date', '-id'], name='dream_user_date_idx'),
+            # all_dreams and the staff listing.
+            models.Index(fields=['-date', '-id'], name='dream_date_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username}'s dream: {self.title}"
@@ -43,12 +86,17 @@ class Emotion(models.Model):
         return self.name
 
 class DreamEmotion(models.Model):
-    dream = models.ForeignKey(Dream, on_delete=models.CASCADE, related_name='emotions')
-    emotion = models.ForeignKey(Emotion, on_delete=models.CASCADE)
+    # Both foreign keys are covered by unique_together and the index below.
+    dream = models.ForeignKey(Dream, on_delete=models.CASCADE, related_name='emotions', db_index=False)
+    emotion = models.ForeignKey(Emotion, on_delete=models.CASCADE, db_index=False)
     intensity = models.IntegerField(validators=[MinValueValidator(1), MaxValueValidator(10)])
 
     class Meta:
         unique_together = ('dream', 'emotion')
+        indexes = [
+            # Dreams by emotion, answered from the index alone.
+            models.Index(fields=['emotion', 'dream', 'intensity'], name='dreamemotion_emotion_idx'),
+        ]
 
 class Theme(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -57,20 +105,32 @@ class Theme(models.Model):
         return self.name
 
 class DreamTheme(models.Model):
-    dream = models.ForeignKey(Dream, on_delete=models.CASCADE, related_name='themes')
-    theme = models.ForeignKey(Theme, on_delete=models.CASCADE)
+    # Both foreign keys are covered by unique_together and the index below.
+    dream = models.ForeignKey(Dream, on_delete=models.CASCADE, related_name='themes', db_index=False)
+    theme = models.ForeignKey(Theme, on_delete=models.CASCADE, db_index=False)
 
     class Meta:
         unique_together = ('dream', 'theme')
+        indexes = [
+            models.Index(fields=['theme', 'dream'], name='dreamtheme_theme_idx'),
+        ]
 
 class ArtworkGeneration(models.Model):
     dream = models.ForeignKey(Dream, on_delete=models.CASCADE, related_name='artworks')
     image = models.ImageField(upload_to='dream_artworks/')
+    # Filled in by the process_media job (dreams/media.py).
+    thumbnail = models.ImageField(upload_to='dream_artworks/thumbnails/', null=True, blank=True, editable=False)
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
 class SoundtrackGeneration(models.Model):
     dream = models.ForeignKey(Dream, on_delete=models.CASCADE, related_name='soundtracks')
     audio_file = models.FileField(upload_to='dream_soundtracks/')
+    # Filled in by the process_media job (dreams/media.py).
+    audio_preview = models.FileField(upload_to='dream_soundtracks/previews/', null=True, blank=True, editable=False)
+    audio_duration = models.FloatField(null=True, blank=True, editable=False)
+    audio_peaks = models.JSONField(null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
 class DreamChallenge(models.Model):
@@ -79,6 +139,11 @@ class DreamChallenge(models.Model):
     start_date = models.DateField()
     end_date = models.DateField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['start_date', 'end_date'], name='challenge_dates_idx'),
+        ]
+
     def __str__(self):
         return self.title
 
@@ -109,6 +174,10 @@ class DreamMeditation(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='meditations')
     title = models.CharField(max_length=255)
     audio_file = models.FileField(upload_to='dream_meditations/')
+    # Filled in by the process_media job (dreams/media.py).
+    audio_preview = models.FileField(upload_to='dream_meditations/previews/', null=True, blank=True, editable=False)
+    audio_duration = models.FloatField(null=True, blank=True, editable=False)
+    audio_peaks = models.JSONField(null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
 class DreamPrompt(models.Model):
@@ -120,20 +189,147 @@ class DreamPrompt(models.Model):
         return f"{self.user.username}'s prompt: {self.prompt_text[:50]}..."
 
 class CollaborativeDream(models.Model):
-    prompt = models.ForeignKey(DreamPrompt, on_delete=models.CASCADE, related_name='collaborative_dreams')
+    # Indexed through collabdream_prompt_idx below.
+    prompt = models.ForeignKey(DreamPrompt, on_delete=models.CASCADE, related_name='collaborative_dreams', db_index=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     dream_content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['prompt', '-created_at'], name='collabdream_prompt_idx'),
+        ]
+
     def __str__(self):
         return f"Collaborative dream by {self.user.username} for prompt: {self.prompt.prompt_text[:50]}..."
 
 class DreamInsight(models.Model):
     dream = models.OneToOneField(Dream, on_delete=models.CASCADE, related_name='insight')
     summary = models.TextField()
+    # Full answer without the model's scratchpad.
     analysis = models.TextField()
+    # {"dream_summary": "...", "daily_affirmation": "...", ...}, see
+    # prompts.INSIGHT_SECTIONS.
+    sections = models.JSONField(default=dict)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"Insight for {self.dream.title}"
+
+class DreamEmbedding(models.Model):
+    dream = models.OneToOneField(Dream, on_delete=models.CASCADE, primary_key=True, related_name='embedding')
+    # Name of the embedder that produced the vector, e.g. "hashing-256".
+    embedder = models.CharField(max_length=100)
+    # Little-endian float32 array, see dreams/embeddings.py.
+    vector = models.BinaryField()
+    updated_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"Embedding for dream #{self.dream_id} ({self.embedder})"
+
+class DreamStats(models.Model):
+    # Per-user aggregates maintained incrementally by dreams/stats.py.
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='dream_stats')
+    dream_count = models.IntegerField(default=0)
+    lucid_count = models.IntegerField(default=0)
+    # {"YYYY-MM-DD": number of dreams}
+    daily_counts = models.JSONField(default=dict)
+    # {"<emotion id>": [number of dreams, summed intensity]}
+    emotion_counts = models.JSONField(default=dict)
+    # {"<theme id>": number of dreams}
+    theme_counts = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Dream stats for user #{self.user_id}"
+
+class TaggerModel(models.Model):
+    # Serialized local theme/emotion classifier (dreams/tagger.py), written by
+    # the train_tagger command.
+    THEMES = 'themes'
+    EMOTIONS = 'emotions'
+    KIND_CHOICES = [
+        (THEMES, 'Themes'),
+        (EMOTIONS, 'Emotions'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, unique=True)
+    dream_count = models.IntegerField()
+    # numpy .npz archive, see NaiveBayesTagger.to_bytes().
+    data = models.BinaryField()
+    trained_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.kind} tagger ({self.dream_count} dreams)"
+
+class DreamVersion(models.Model):
+    # Bumped whenever any of the user's dreams (or their tags or insights)
+    # change; drives the ETag of the user's dream listings. Kept off the User
+    # row so that saving a stale User instance cannot roll it back.
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='dream_version')
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Dream version {self.version} for user #{self.user_id}"
+
+class GeminiUsage(models.Model):
+    # Daily per-user, per-endpoint roll-up of Gemini calls (dreams/usage.py).
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='gemini_usage', db_index=False)
+    day = models.DateField()
+    endpoint = models.CharField(max_length=50)
+    requests = models.PositiveIntegerField(default=0)
+    prompt_tokens = models.PositiveBigIntegerField(default=0)
+    response_tokens = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also the index behind the daily quota check on (user, day).
+            models.UniqueConstraint(fields=['user', 'day', 'endpoint'], name='unique_usage_per_user_day_endpoint'),
+        ]
+
+    def __str__(self):
+        return f"{self.endpoint} usage of user #{self.user_id} on {self.day}"
+
+class BackgroundJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    ACTIVE_STATUSES = (PENDING, RUNNING)
+
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    # Only one pending/running job may exist per dedupe key.
+    dedupe_key = models.CharField(max_length=255, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='job_status_run_after_idx'),
+            models.Index(fields=['dedupe_key', '-created_at'], name='job_dedupe_key_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['dedupe_key'],
+                condition=Q(status__in=['pending', 'running']),
+                name='unique_active_job_per_dedupe_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} job #{self.pk} ({self.status})"
@@ -0,0 +1,79 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import hashers
+
+# Password hashing (PBKDF2 by default) is deliberately slow and CPU bound.
+# It runs on a small pool per process. The pool does not make logins any
+# faster: it caps how many hashes a process computes at once, so a burst of
+# logins or signups can't take every core, and once its queue is full
+# further attempts are turned away at once with HashingBusy (a 503).
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class TunablePBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    # Iterations from PASSWORD_HASHING["ITERATIONS"]; hashes made with a
+    # different count are upgraded on the user's next login.
+    @property
+    def iterations(self):
+        return settings.PASSWORD_HASHING["ITERATIONS"] or hashers.PBKDF2PasswordHasher.iterations
+
+
+_executor = None
+_slots = None
+_lock = threading.Lock()
+
+
+def _pool():
+    global _executor, _slots
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                config = settings.PASSWORD_HASHING
+                _slots = threading.BoundedSemaphore(config["WORKERS"] + config["QUEUE"])
+                _executor = ThreadPoolExecutor(
+                    max_workers=config["WORKERS"], thread_name_prefix="password-hashing"
+                )
+    return _executor, _slots
+
+
+def _run(function, *args):
+    executor, slots = _pool()
+    if not slots.acquire(timeout=settings.PASSWORD_HASHING["QUEUE_TIMEOUT"]):
+        raise HashingBusy()
+    try:
+        return executor.submit(function, *args).result()
+    finally:
+        slots.release()
+
+
+def hash_password(raw_password):
+    return _run(hashers.make_password, raw_password)
+
+
+def _verify(raw_password, encoded):
+    # hashers.check_password without the setter: the pool threads never
+    # touch the database.
+    if encoded is None or not hashers.is_password_usable(encoded):
+        # Same cost as a real check, so unknown users can't be told apart
+        # by response time.
+        hashers.make_password(raw_password)
+        return False, False
+    matches = hashers.check_password(raw_password, encoded)
+    return matches, matches and hashers.identify_hasher(encoded).must_update(encoded)
+
+
+def check_password(user, raw_password):
+    """Check raw_password against user (None for an unknown user).
+
+    Upgrades the stored hash when the hasher or its iterations changed.
+    """
+    matches, must_update = _run(_verify, raw_password, user.password if user else None)
+    if must_update:
+        user.password = hash_password(raw_password)
+        user.save(update_fields=["password"])
+    return matches
@@ -0,0 +1,199 @@
+import re
+
+THEMES_PROMPT = """Based on the following dream content, suggest 3 relevant themes.
+    Please format your response as a numbered list, with each theme on a new line.
+    Each theme should be a single word.
+    Do not include any additional text or explanations.
+
+    Dream content:
+    {content}
+
+    Response format example:
+    1. Adventure
+    2. Mystery
+    3. Nature
+
+    Your theme suggestions:"""
+
+EMOTIONS_PROMPT = """Based on the following dream content, suggest 3 relevant emotions that the dreamer might have experienced.
+    Please format your response as a numbered list, with each emotion on a new line.
+    Do not include any additional text or explanations.
+
+    Dream content:
+    {content}
+
+    Response format example:
+    1. Joy
+    2. Anxiety
+    3. Curiosity
+
+    Your emotion suggestions:"""
+
+TITLE_PROMPT = """Based on the following dream content, suggest a creative and engaging title for the dream.
+    The title should be concise (no more than 10 words) and capture the essence or most striking element of the dream.
+    Please provide only the title, without any additional text or explanations.
+
+    Dream content:
+    {content}
+
+    ALWAYS USE USER'S LANGUAGE!!!
+
+    Your title suggestion:"""
+
+SUGGEST_ALL_PROMPT = """Based on the following dream content, suggest a title, 3 relevant themes and 3 relevant emotions that the dreamer might have experienced.
+    Wrap each part of your response in the XML tags shown in the example and do not include any additional text or explanations.
+    The title should be concise (no more than 10 words) and capture the essence or most striking element of the dream.
+    Each theme should be a single word. Format themes and emotions as numbered lists, one item per line.
+
+    Dream content:
+    {content}
+
+    ALWAYS USE USER'S LANGUAGE FOR THE TITLE!!!
+
+    Response format example:
+    <title>The Corridor That Kept Unfolding</title>
+    <themes>
+    1. Adventure
+    2. Mystery
+    3. Nature
+    </themes>
+    <emotions>
+    1. Joy
+    2. Anxiety
+    3. Curiosity
+    </emotions>
+
+    Your suggestions:"""
+
+INSIGHT_PROMPT = """You are an AI dream analyst for the Dream Deck app. Your task is to analyze user-submitted dream content and provide insightful, creative, and original interpretations based on a provided dream interpretation knowledge base. Your messages will be sent directly to user except the <scratchpad> and <dream_summary>. So talk directly to them. Always write in the Dream Content language.
+
+First, here are the entries of the dream interpretation knowledge base that are relevant to this dream:
+
+<knowledge_base>
+{knowledge_base}
+</knowledge_base>
+
+Next, you will receive the user's dream content:
+
+<dream_content>
+{content}
+</dream_content>
+
+These are earlier dreams of the same dreamer that closely resemble this one. If they share symbols, settings or themes with it, point out the recurring pattern in your analysis:
+
+<recurring_dreams>
+{recurring_dreams}
+</recurring_dreams>
+
+Analyze the dream content using the provided knowledge base. Be creative and original in your interpretations, going beyond simple symbol matching. Consider the overall narrative, emotions, and themes present in the dream.
+
+Before providing your final analysis, use a <scratchpad> to think through your interpretation process. Consider different aspects of the dream and how they might relate to the dreamer's subconscious mind, daily life, or emotional state.
+
+Your final analysis should be divided into the following sections, each wrapped in appropriate XML tags:
+
+1. <dream_summary>: Provide a brief summary of the key elements and narrative of the dream.
+
+2. <emotional_landscape>: Analyze the emotions present in the dream and what they might represent.
+
+3. <symbolic_analysis>: Interpret key symbols or objects in the dream, relating them to possible meanings in the dreamer's life.
+
+4. <narrative_interpretation>: Examine the overall story or sequence of events in the dream and what it might signify.
+
+5. <personal_growth_insights>: Offer suggestions on how the dreamer might use insights from the dream for personal development or problem-solving in their waking life.
+
+6. <cultural_perspective>: Provide an interpretation from a specific cultural viewpoint, if applicable.
+
+7. <recurring_themes>: Identify any common dream themes present and their potential significance.
+
+8. <lucid_dreaming_potential>: Suggest techniques the dreamer could use to achieve lucidity if they were to have a similar dream in the future.
+
+9. <artistic_inspiration>: Describe a potential piece of artwork or music that could be generated based on the dream's content and mood.
+
+10. <daily_affirmation>: Create a short, inspiring affirmation related to the dream's main theme or message.
+
+Remember to be creative and original in your interpretations, providing unique insights that go beyond conventional dream analysis. Your goal is to offer the user a rich, multifaceted understanding of their dream that they can reflect on and potentially apply to their waking life."""
+
+
+def _tag_body(text, tag):
+    match = re.search(rf"<{tag}>(.*?)</{tag}>", text, re.DOTALL)
+    return match.group(1) if match else ""
+
+
+def _list_body(text, tag):
+    # The numbered-list parsers look at the first character of each line.
+    return "\n".join(line.strip() for line in _tag_body(text, tag).split("\n"))
+
+
+def parse_themes(text):
+    return [
+        theme.strip().split(". ", 1)[-1]
+        for theme in text.split("\n")
+        if theme.strip() and theme[0].isdigit()
+    ]
+
+
+def parse_emotions(text):
+    emotions = []
+    for line in text.split("\n"):
+        if line.strip() and line[0].isdigit():
+            parts = line.split(".", 1)[-1].strip().split("(", 1)
+            if len(parts) >= 1:
+                emotion = parts[0].strip()
+                emotions.append({"name": emotion})
+    return emotions
+
+
+def parse_title(text):
+    suggested_title = text.strip()
+
+    # Ensure the title is not too long
+    if len(suggested_title.split()) > 10:
+        suggested_title = " ".join(suggested_title.split()[:10]) + "..."
+    return suggested_title
+
+
+def parse_suggest_all(text):
+    return {
+        "suggested_title": parse_title(_tag_body(text, "title")),
+        "suggested_themes": parse_themes(_list_body(text, "themes")),
+        "suggested_emotions": parse_emotions(_list_body(text, "emotions")),
+    }
+
+
+# Sections of INSIGHT_PROMPT's answer, in the order it asks for them.
+INSIGHT_SECTIONS = [
+    "dream_summary",
+    "emotional_landscape",
+    "symbolic_analysis",
+    "narrative_interpretation",
+    "personal_growth_insights",
+    "cultural_perspective",
+    "recurring_themes",
+    "lucid_dreaming_potential",
+    "artistic_inspiration",
+    "daily_affirmation",
+]
+
+SCRATCHPAD_OPEN = "<scratchpad>"
+SCRATCHPAD_CLOSE = "</scratchpad>"
+
+_scratchpad = re.compile(
+    rf"{SCRATCHPAD_OPEN}.*?(?:{re.escape(SCRATCHPAD_CLOSE)}|$)", re.DOTALL
+)
+
+
+def strip_scratchpad(text):
+    # An unterminated scratchpad hides everything after it.
+    return _scratchpad.sub("", text).strip()
+
+
+def parse_insight(text):
+    # -> (analysis without the scratchpad, {section: text} for the sections
+    # present in the answer)
+    analysis = strip_scratchpad(text)
+    sections = {}
+    for name in INSIGHT_SECTIONS:
+        body = _tag_body(analysis, name).strip()
+        if body:
+            sections[name] = body
+    return analysis, sections
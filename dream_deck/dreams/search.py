@@ -0,0 +1,155 @@
+from django.conf import settings
+from django.contrib.postgres.search import (
+    SearchHeadline,
+    SearchQuery,
+    SearchRank,
+    SearchVector,
+)
+from django.db import connection
+from django.db.models import F, OuterRef, Q, Subquery
+
+from .models import Dream, DreamInsight
+
+# Full-text search over dream title, content and insight analysis.
+#
+# PostgreSQL keeps a weighted tsvector in Dream.search_vector behind a GIN
+# index; SQLite (local development and tests) mirrors the same documents in
+# the FTS5 table below. Both are refreshed by index_dreams() whenever a dream
+# or its insight is written (see dreams/signals.py).
+
+FTS_TABLE = "dreams_dream_fts"
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_STOP = "</mark>"
+HEADLINE_OPTIONS = "MaxFragments=2, MaxWords=24, MinWords=8"
+
+
+def _vendor():
+    return connection.vendor
+
+
+def _postgres_document():
+    config = settings.DREAM_SEARCH_CONFIG
+    analysis = Subquery(
+        DreamInsight.objects.filter(dream=OuterRef("pk")).values("analysis")[:1]
+    )
+    return (
+        SearchVector("title", weight="A", config=config)
+        + SearchVector("content", weight="B", config=config)
+        + SearchVector(analysis, weight="C", config=config)
+    )
+
+
+def index_dreams(dream_ids):
+    dream_ids = list(dream_ids)
+    if not dream_ids:
+        return
+    vendor = _vendor()
+    if vendor == "postgresql":
+        Dream.objects.filter(pk__in=dream_ids).update(search_vector=_postgres_document())
+    elif vendor == "sqlite":
+        placeholders = ", ".join(["%s"] * len(dream_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", dream_ids
+            )
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, title, content, analysis) "
+                f"SELECT d.id, d.title, d.content, COALESCE(i.analysis, '') "
+                f"FROM dreams_dream d LEFT JOIN dreams_dreaminsight i ON i.dream_id = d.id "
+                f"WHERE d.id IN ({placeholders})",
+                dream_ids,
+            )
+
+
+def unindex_dreams(dream_ids):
+    # PostgreSQL needs nothing: the tsvector is deleted with its row.
+    dream_ids = list(dream_ids)
+    if dream_ids and _vendor() == "sqlite":
+        placeholders = ", ".join(["%s"] * len(dream_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", dream_ids
+            )
+
+
+def _postgres_search(queryset, query, limit, offset):
+    config = settings.DREAM_SEARCH_CONFIG
+    search_query = SearchQuery(query, search_type="websearch", config=config)
+    headline = {
+        "query": search_query,
+        "config": config,
+        "start_sel": HIGHLIGHT_START,
+        "stop_sel": HIGHLIGHT_STOP,
+    }
+    results = (
+        queryset.filter(search_vector=search_query)
+        .annotate(rank=SearchRank(F("search_vector"), search_query))
+        .order_by("-rank", "-id")
+        .annotate(
+            title_highlight=SearchHeadline("title", highlight_all=True, **headline),
+            content_highlight=SearchHeadline(
+                "content", options=HEADLINE_OPTIONS, **headline
+            ),
+            analysis_highlight=SearchHeadline(
+                "insight__analysis", options=HEADLINE_OPTIONS, **headline
+            ),
+        )
+        .values(
+            "id", "title", "date", "rank",
+            "title_highlight", "content_highlight", "analysis_highlight",
+        )[offset:offset + limit]
+    )
+    return list(results)
+
+
+def _fts5_query(query):
+    # Quote every term so user input cannot use FTS5 query syntax.
+    terms = ['"{}"'.format(term.replace('"', '""')) for term in query.split()]
+    return " ".join(terms)
+
+
+def _sqlite_search(queryset, query, limit, offset):
+    inner_sql, inner_params = queryset.order_by().values("id").query.sql_with_params()
+    # bm25() ranks lower-is-better; weights mirror the A/B/C PostgreSQL ones.
+    sql = (
+        f"SELECT f.rowid, d.title, d.date, -bm25({FTS_TABLE}, 10.0, 4.0, 1.0), "
+        f"highlight({FTS_TABLE}, 0, %s, %s), "
+        f"snippet({FTS_TABLE}, 1, %s, %s, '…', 24), "
+        f"snippet({FTS_TABLE}, 2, %s, %s, '…', 24) "
+        f"FROM {FTS_TABLE} f JOIN dreams_dream d ON d.id = f.rowid "
+        f"WHERE {FTS_TABLE} MATCH %s AND d.id IN ({inner_sql}) "
+        f"ORDER BY bm25({FTS_TABLE}, 10.0, 4.0, 1.0), d.id DESC LIMIT %s OFFSET %s"
+    )
+    markers = [HIGHLIGHT_START, HIGHLIGHT_STOP] * 3
+    params = [*markers, _fts5_query(query), *inner_params, limit, offset]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    keys = (
+        "id", "title", "date", "rank",
+        "title_highlight", "content_highlight", "analysis_highlight",
+    )
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def _fallback_search(queryset, query, limit, offset):
+    results = (
+        queryset.filter(Q(title__icontains=query) | Q(content__icontains=query))
+        .order_by("-date", "-id")
+        .values("id", "title", "date")[offset:offset + limit]
+    )
+    empty = dict.fromkeys(
+        ("rank", "title_highlight", "content_highlight", "analysis_highlight")
+    )
+    return [{**row, **empty} for row in results]
+
+
+def search_dreams(queryset, query, limit, offset=0):
+    if not _fts5_query(query):
+        return []
+    vendor = _vendor()
+    if vendor == "postgresql":
+        return _postgres_search(queryset, query, limit, offset)
+    if vendor == "sqlite":
+        return _sqlite_search(queryset, query, limit, offset)
+    return _fallback_search(queryset, query, limit, offset)
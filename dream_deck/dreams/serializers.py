@@ -1,7 +1,46 @@
 from rest_framework import serializers
 from .models import Dream, Emotion, Theme, DreamEmotion, DreamTheme, DreamInsight
 from django.contrib.auth import get_user_model
-from django.contrib.auth.password_validation import validate_password
+from django.db import transaction
+
+from . import passwords, stats, versions
+
+
+def parse_fields_param(value):
+    # "id,title,insight.summary" -> {"id": None, "title": None, "insight": {"summary": None}}
+    requested = {}
+    for path in filter(None, (part.strip() for part in value.split(","))):
+        node = requested
+        *parents, leaf = path.split(".")
+        for name in parents:
+            node = node.setdefault(name, {}) or {}
+        node.setdefault(leaf, None)
+    return requested
+
+
+class SparseFieldsetMixin:
+    # `?fields=` on GET requests limits the representation to the listed
+    # fields; dotted names select fields of nested serializers.
+    fields_query_param = "fields"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        if request is None or request.method != "GET":
+            return
+        value = request.query_params.get(self.fields_query_param)
+        if value:
+            self._prune_fields(self, parse_fields_param(value))
+
+    @classmethod
+    def _prune_fields(cls, serializer, requested):
+        for name in list(serializer.fields):
+            if name not in requested:
+                serializer.fields.pop(name)
+            elif requested[name] and isinstance(
+                serializer.fields[name], serializers.Serializer
+            ):
+                cls._prune_fields(serializer.fields[name], requested[name])
 
 
 class DreamInsightSerializer(serializers.ModelSerializer):
@@ -9,13 +48,37 @@ class DreamInsightSerializer(serializers.ModelSerializer):
         model = DreamInsight
         fields = ['summary', 'analysis']
         
-class DreamSerializer(serializers.ModelSerializer):
-    emotions = serializers.ListField(
-        child=serializers.DictField(), write_only=True, required=False
-    )
-    themes = serializers.ListField(
-        child=serializers.CharField(), write_only=True, required=False
-    )
+def _related_rows(manager, cache_name, related):
+    # Reuse rows prefetched by the viewset; otherwise (e.g. right after a
+    # write) load them together with the tag in one query.
+    if cache_name in getattr(manager.instance, "_prefetched_objects_cache", {}):
+        return manager.all()
+    return manager.select_related(related).order_by("id")
+
+
+class DreamEmotionsField(serializers.ListField):
+    child = serializers.DictField()
+
+    def to_representation(self, manager):
+        return [
+            {"name": dream_emotion.emotion.name, "intensity": dream_emotion.intensity}
+            for dream_emotion in _related_rows(manager, self.source, "emotion")
+        ]
+
+
+class DreamThemesField(serializers.ListField):
+    child = serializers.CharField()
+
+    def to_representation(self, manager):
+        return [
+            dream_theme.theme.name
+            for dream_theme in _related_rows(manager, self.source, "theme")
+        ]
+
+
+class DreamSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    emotions = DreamEmotionsField(required=False)
+    themes = DreamThemesField(required=False)
     insight = DreamInsightSerializer(read_only=True)
 
     class Meta:
@@ -27,30 +90,132 @@ class DreamSerializer(serializers.ModelSerializer):
             "date",
             "is_lucid",
             "audio_recording",
+            "audio_preview",
+            "audio_duration",
+            "audio_peaks",
             "emotions",
             "themes",
             "insight",
         ]
         read_only_fields = ["id", "date"]
 
+    def validate_emotions(self, value):
+        for emotion_data in value:
+            if not emotion_data.get("name"):
+                raise serializers.ValidationError("Each emotion needs a name.")
+            intensity = emotion_data.get("intensity")
+            if not isinstance(intensity, int) or not 1 <= intensity <= 10:
+                raise serializers.ValidationError(
+                    "Each emotion needs an integer intensity between 1 and 10."
+                )
+        return value
+
     def create(self, validated_data):
         emotions_data = validated_data.pop("emotions", [])
         themes_data = validated_data.pop("themes", [])
 
-        dream = Dream.objects.create(**validated_data)
+        with transaction.atomic():
+            dream = Dream.objects.create(**validated_data)
+            set_dream_emotions(dream, emotions_data, existing={})
+            set_dream_themes(dream, themes_data, existing={})
 
-        for emotion_data in emotions_data:
-            emotion, _ = Emotion.objects.get_or_create(name=emotion_data["name"])
-            DreamEmotion.objects.create(
-                dream=dream, emotion=emotion, intensity=emotion_data["intensity"]
-            )
+        return dream
 
-        for theme_name in themes_data:
-            theme, _ = Theme.objects.get_or_create(name=theme_name)
-            DreamTheme.objects.create(dream=dream, theme=theme)
+    def update(self, instance, validated_data):
+        emotions_data = validated_data.pop("emotions", None)
+        themes_data = validated_data.pop("themes", None)
+
+        with transaction.atomic():
+            dream = super().update(instance, validated_data)
+            # Tags are only touched when the request sends them.
+            if emotions_data is not None:
+                set_dream_emotions(dream, emotions_data)
+            if themes_data is not None:
+                set_dream_themes(dream, themes_data)
 
         return dream
-    
+
+
+def resolve_names(model, names):
+    """Map names to primary keys, creating missing rows in one INSERT."""
+    names = list(dict.fromkeys(names))
+    if not names:
+        return {}
+    ids = dict(model.objects.filter(name__in=names).values_list("name", "id"))
+    missing = [name for name in names if name not in ids]
+    if missing:
+        # ignore_conflicts tolerates a concurrent request creating the same
+        # name; the rows are read back since no primary keys are returned.
+        model.objects.bulk_create(
+            [model(name=name) for name in missing], ignore_conflicts=True
+        )
+        ids.update(model.objects.filter(name__in=missing).values_list("name", "id"))
+    return ids
+
+
+def set_dream_emotions(dream, emotions_data, existing=None):
+    # Later entries win when the same emotion is listed twice.
+    intensities = {data["name"]: data["intensity"] for data in emotions_data}
+    emotion_ids = resolve_names(Emotion, intensities)
+    wanted = {emotion_ids[name]: intensity for name, intensity in intensities.items()}
+
+    if existing is None:
+        existing = {
+            row.emotion_id: row
+            for row in DreamEmotion.objects.filter(dream=dream)
+        }
+    removed = [row.pk for emotion_id, row in existing.items() if emotion_id not in wanted]
+    if removed:
+        DreamEmotion.objects.filter(pk__in=removed).delete()
+
+    # bulk_update() and bulk_create() send no signals, so the stats are
+    # updated here; deleted rows are counted by the post_delete signal.
+    stats_changes = []
+    changed = []
+    for emotion_id, row in existing.items():
+        if emotion_id in wanted and row.intensity != wanted[emotion_id]:
+            stats_changes.append((dream.pk, emotion_id, 0, wanted[emotion_id] - row.intensity))
+            row.intensity = wanted[emotion_id]
+            changed.append(row)
+    if changed:
+        DreamEmotion.objects.bulk_update(changed, ["intensity"])
+
+    created = DreamEmotion.objects.bulk_create(
+        [
+            DreamEmotion(dream=dream, emotion_id=emotion_id, intensity=intensity)
+            for emotion_id, intensity in wanted.items()
+            if emotion_id not in existing
+        ]
+    )
+    stats_changes.extend((dream.pk, row.emotion_id, 1, row.intensity) for row in created)
+    if stats_changes:
+        stats.record_emotions(stats_changes)
+        versions.record_dreams([dream.pk])
+
+
+def set_dream_themes(dream, theme_names, existing=None):
+    ids = resolve_names(Theme, theme_names)
+    theme_ids = list(dict.fromkeys(ids[name] for name in theme_names))
+
+    if existing is None:
+        existing = dict(
+            DreamTheme.objects.filter(dream=dream).values_list("theme_id", "id")
+        )
+    removed = [pk for theme_id, pk in existing.items() if theme_id not in theme_ids]
+    if removed:
+        DreamTheme.objects.filter(pk__in=removed).delete()
+
+    created = DreamTheme.objects.bulk_create(
+        [
+            DreamTheme(dream=dream, theme_id=theme_id)
+            for theme_id in theme_ids
+            if theme_id not in existing
+        ]
+    )
+    if created:
+        stats.record_themes([(dream.pk, row.theme_id, 1) for row in created])
+        versions.record_dreams([dream.pk])
+
 
 class EmotionSerializer(serializers.ModelSerializer):
     class Meta:
@@ -67,9 +232,8 @@ User = get_user_model()
 
 
 class UserSerializer(serializers.ModelSerializer):
-    password = serializers.CharField(
-        write_only=True, required=True, validators=[validate_password]
-    )
+    # Strength is checked once, by SignUpView.
+    password = serializers.CharField(write_only=True, required=True)
     confirm_password = serializers.CharField(write_only=True, required=True)
     name = serializers.CharField(write_only=True, required=False)
     
@@ -97,9 +261,20 @@ class UserSerializer(serializers.ModelSerializer):
         validated_data.pop("confirm_password")
         name = validated_data.pop("name", "")
         first_name, last_name = name.split(" ", 1) if " " in name else (name, "")
-        user = User.objects.create_user(
-            first_name=first_name, last_name=last_name, **validated_data
+        password = validated_data.pop("password")
+        # What UserManager.create_user does, with the hashing done on the
+        # shared password hashing pool.
+        user = User(
+            first_name=first_name,
+            last_name=last_name,
+            **{
+                **validated_data,
+                "username": User.normalize_username(validated_data["username"]),
+                "email": User.objects.normalize_email(validated_data["email"]),
+            },
         )
+        user.password = passwords.hash_password(password)
+        user.save()
         return user
 
 
@@ -0,0 +1,200 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import authentication, embeddings, media, metrics, search, stats, versions
+from .models import (
+    ArtworkGeneration,
+    Dream,
+    DreamEmotion,
+    DreamInsight,
+    DreamMeditation,
+    DreamTheme,
+    SoundtrackGeneration,
+    User,
+)
+
+
+@receiver(post_save, sender=Dream)
+def index_saved_dream(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_dreams([instance.pk])
+        transaction.on_commit(lambda: embeddings.embed_dreams([instance]))
+
+
+@receiver(post_delete, sender=Dream)
+def unindex_deleted_dream(sender, instance, **kwargs):
+    search.unindex_dreams([instance.pk])
+    dream_id = instance.pk
+    transaction.on_commit(lambda: embeddings.unindex_dreams([dream_id]))
+
+
+@receiver(post_save, sender=DreamInsight)
+@receiver(post_delete, sender=DreamInsight)
+def reindex_insight_dream(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    dream_id = instance.dream_id
+    # Run after commit so a dream deleted in the same transaction (cascading
+    # to its insight) is not re-indexed.
+    transaction.on_commit(lambda: search.index_dreams([dream_id]))
+
+
+@receiver(pre_save, sender=Dream)
+@receiver(pre_save, sender=DreamEmotion)
+@receiver(pre_save, sender=DreamTheme)
+def remember_previous_row(sender, instance, raw=False, **kwargs):
+    # Stats need the values being replaced, which post_save no longer sees.
+    if raw or instance._state.adding:
+        return
+    instance._stats_previous = sender.objects.filter(pk=instance.pk).first()
+
+
+@receiver(post_save, sender=Dream)
+def update_stats_for_saved_dream(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, "_stats_previous", None)
+    if created:
+        stats.record_dreams([instance])
+    elif previous is not None:
+        stats.record_dream_change(instance, previous.date, previous.is_lucid)
+
+
+@receiver(pre_delete, sender=Dream)
+def remember_deleted_dream_owner(sender, instance, **kwargs):
+    stats.remember_owner(instance)
+
+
+@receiver(post_delete, sender=Dream)
+def update_stats_for_deleted_dream(sender, instance, **kwargs):
+    stats.record_dreams([instance], sign=-1)
+
+
+@receiver(post_save, sender=DreamEmotion)
+def update_stats_for_saved_emotion(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    changes = [(instance.dream_id, instance.emotion_id, 1, instance.intensity)]
+    previous = getattr(instance, "_stats_previous", None)
+    if previous is not None:
+        changes.append((previous.dream_id, previous.emotion_id, -1, -previous.intensity))
+    stats.record_emotions(changes)
+
+
+@receiver(post_delete, sender=DreamEmotion)
+def update_stats_for_deleted_emotion(sender, instance, **kwargs):
+    stats.record_emotions([(instance.dream_id, instance.emotion_id, -1, -instance.intensity)])
+
+
+@receiver(post_save, sender=DreamTheme)
+def update_stats_for_saved_theme(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    changes = [(instance.dream_id, instance.theme_id, 1)]
+    previous = getattr(instance, "_stats_previous", None)
+    if previous is not None:
+        changes.append((previous.dream_id, previous.theme_id, -1))
+    stats.record_themes(changes)
+
+
+@receiver(post_delete, sender=DreamTheme)
+def update_stats_for_deleted_theme(sender, instance, **kwargs):
+    stats.record_themes([(instance.dream_id, instance.theme_id, -1)])
+
+
+@receiver(post_save, sender=Dream)
+@receiver(post_delete, sender=Dream)
+def bump_dream_version(sender, instance, raw=False, **kwargs):
+    if not raw:
+        versions.record_users([instance.user_id])
+
+
+@receiver(post_save, sender=DreamEmotion)
+@receiver(post_delete, sender=DreamEmotion)
+@receiver(post_save, sender=DreamTheme)
+@receiver(post_delete, sender=DreamTheme)
+@receiver(post_save, sender=DreamInsight)
+@receiver(post_delete, sender=DreamInsight)
+def touch_tagged_dream(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    dream_ids = [instance.dream_id]
+    previous = getattr(instance, "_stats_previous", None)
+    if previous is not None and previous.dream_id != instance.dream_id:
+        dream_ids.append(previous.dream_id)
+    versions.record_dreams(dream_ids)
+
+
+@receiver(pre_save, sender=Dream)
+@receiver(pre_save, sender=SoundtrackGeneration)
+@receiver(pre_save, sender=DreamMeditation)
+@receiver(pre_save, sender=ArtworkGeneration)
+def reset_media_renditions(sender, instance, raw=False, **kwargs):
+    # A new upload, or removing the old one, makes the renditions stale; they
+    # are cleared in the same save and the file is deleted after commit.
+    if raw:
+        return
+    label = sender._meta.label_lower
+    source, _ = media.SOURCES[label]
+    fields = media.rendition_fields(label)
+    if instance.get_deferred_fields().intersection(fields):
+        return
+    uploaded = getattr(instance, source)
+    if uploaded:
+        changed = not uploaded._committed
+    else:
+        changed = bool(getattr(instance, fields[0])) or getattr(instance, fields[1]) is not None
+    if not changed:
+        return
+    instance._media_stale_rendition = getattr(instance, fields[0]).name or None
+    instance._media_changed = True
+    for field in fields:
+        setattr(instance, field, None)
+
+
+@receiver(post_save, sender=Dream)
+@receiver(post_save, sender=SoundtrackGeneration)
+@receiver(post_save, sender=DreamMeditation)
+@receiver(post_save, sender=ArtworkGeneration)
+def process_uploaded_media(sender, instance, raw=False, **kwargs):
+    if raw or not instance.__dict__.pop("_media_changed", False):
+        return
+    label = sender._meta.label_lower
+    source, _ = media.SOURCES[label]
+    stale = instance.__dict__.pop("_media_stale_rendition", None)
+    storage = sender._meta.get_field(media.rendition_fields(label)[0]).storage
+    uploaded = bool(getattr(instance, source))
+
+    def after_commit():
+        if stale:
+            storage.delete(stale)
+        if uploaded and settings.MEDIA_PROCESSING["ENABLED"]:
+            media.enqueue(instance)
+
+    transaction.on_commit(after_commit)
+
+
+@receiver(post_save, sender=User)
+def revoke_user_tokens(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    # set_password() leaves the new password in _password until save() ends.
+    if not created and instance._password is not None:
+        User.objects.filter(pk=instance.pk).update(token_version=F("token_version") + 1)
+        instance.refresh_from_db(fields=["token_version"])
+    authentication.user_changed(instance)
+
+
+@receiver(post_delete, sender=User)
+def forget_deleted_user(sender, instance, **kwargs):
+    authentication.user_changed(instance)
+
+
+@receiver(connection_created)
+def count_request_queries(sender, connection, **kwargs):
+    if settings.METRICS["ENABLED"]:
+        metrics.install_query_hook(connection)
@@ -0,0 +1,246 @@
+import datetime
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from .models import Dream, DreamEmotion, DreamStats, DreamTheme, Emotion, Theme
+
+# Per-user dream statistics kept in one DreamStats row.
+#
+# Writes record deltas which are applied once per user when the surrounding
+# transaction commits, so a dream saved together with its emotions and themes
+# costs one stats update and rolled back writes never reach the stats. Users
+# without a row yet get one built from scratch on first read.
+
+
+class StatsDelta:
+    def __init__(self):
+        self.dreams = 0
+        self.lucid = 0
+        self.days = Counter()
+        self.emotions = defaultdict(lambda: [0, 0])
+        self.themes = Counter()
+
+    def apply(self, stats):
+        stats.dream_count += self.dreams
+        stats.lucid_count += self.lucid
+        _merge(stats.daily_counts, self.days)
+        for emotion_id, (count, intensity) in self.emotions.items():
+            key = str(emotion_id)
+            current = stats.emotion_counts.get(key, [0, 0])
+            merged = [current[0] + count, current[1] + intensity]
+            if merged[0] > 0:
+                stats.emotion_counts[key] = merged
+            else:
+                stats.emotion_counts.pop(key, None)
+        _merge(stats.theme_counts, self.themes)
+
+
+def _merge(counts, changes):
+    for key, change in changes.items():
+        key = str(key)
+        value = counts.get(key, 0) + change
+        if value > 0:
+            counts[key] = value
+        else:
+            counts.pop(key, None)
+
+
+class _PendingStats:
+    def __init__(self):
+        self.deltas = defaultdict(StatsDelta)
+        # dream id -> user id, so tag rows deleted along with their dream
+        # need no query to find their owner.
+        self.owners = {}
+
+    def __call__(self):
+        for user_id, delta in self.deltas.items():
+            with transaction.atomic():
+                stats = DreamStats.objects.select_for_update().filter(user_id=user_id).first()
+                if stats is None:
+                    # Built from the committed rows on first read.
+                    continue
+                delta.apply(stats)
+                stats.save()
+
+
+def _pending():
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return _PendingStats()
+    # One per savepoint: Django drops the callbacks of a savepoint that is
+    # rolled back, and with it the deltas recorded inside it.
+    savepoints = set(connection.savepoint_ids)
+    for sids, func, _ in connection.run_on_commit:
+        if isinstance(func, _PendingStats) and sids == savepoints:
+            return func
+    pending = _PendingStats()
+    transaction.on_commit(pending)
+    return pending
+
+
+def _flush(pending):
+    if not transaction.get_connection().in_atomic_block:
+        pending()
+
+
+def _owner(pending, dream_id):
+    if dream_id not in pending.owners:
+        pending.owners[dream_id] = (
+            Dream.objects.filter(pk=dream_id).values_list("user_id", flat=True).first()
+        )
+    return pending.owners[dream_id]
+
+
+def record_dreams(dreams, sign=1):
+    pending = _pending()
+    for dream in dreams:
+        pending.owners[dream.pk] = dream.user_id
+        delta = pending.deltas[dream.user_id]
+        delta.dreams += sign
+        delta.lucid += sign * dream.is_lucid
+        delta.days[dream.date.isoformat()] += sign
+    _flush(pending)
+
+
+def record_dream_change(dream, previous_date, previous_is_lucid):
+    pending = _pending()
+    pending.owners[dream.pk] = dream.user_id
+    if dream.date == previous_date and dream.is_lucid == previous_is_lucid:
+        return
+    delta = pending.deltas[dream.user_id]
+    delta.lucid += dream.is_lucid - previous_is_lucid
+    delta.days[previous_date.isoformat()] -= 1
+    delta.days[dream.date.isoformat()] += 1
+    _flush(pending)
+
+
+def remember_owner(dream):
+    # Called before a dream is deleted, ahead of its cascaded tag rows.
+    _pending().owners[dream.pk] = dream.user_id
+
+
+def record_emotions(changes):
+    # changes: (dream_id, emotion_id, count change, intensity change)
+    pending = _pending()
+    for dream_id, emotion_id, count, intensity in changes:
+        user_id = _owner(pending, dream_id)
+        if user_id is not None:
+            totals = pending.deltas[user_id].emotions[emotion_id]
+            totals[0] += count
+            totals[1] += intensity
+    _flush(pending)
+
+
+def record_themes(changes):
+    # changes: (dream_id, theme_id, count change)
+    pending = _pending()
+    for dream_id, theme_id, count in changes:
+        user_id = _owner(pending, dream_id)
+        if user_id is not None:
+            pending.deltas[user_id].themes[theme_id] += count
+    _flush(pending)
+
+
+def rebuild_user_stats(user_id):
+    dreams = Dream.objects.filter(user_id=user_id)
+    totals = dreams.aggregate(
+        dream_count=Count("id"), lucid_count=Count("id", filter=Q(is_lucid=True))
+    )
+    daily = dreams.values_list("date").annotate(count=Count("id")).order_by()
+    emotions = (
+        DreamEmotion.objects.filter(dream__user_id=user_id)
+        .values_list("emotion_id")
+        .annotate(count=Count("id"), intensity=Sum("intensity"))
+        .order_by()
+    )
+    themes = (
+        DreamTheme.objects.filter(dream__user_id=user_id)
+        .values_list("theme_id")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    stats, _ = DreamStats.objects.update_or_create(
+        user_id=user_id,
+        defaults={
+            **totals,
+            "daily_counts": {date.isoformat(): count for date, count in daily},
+            "emotion_counts": {
+                str(emotion_id): [count, intensity] for emotion_id, count, intensity in emotions
+            },
+            "theme_counts": {str(theme_id): count for theme_id, count in themes},
+        },
+    )
+    return stats
+
+
+def get_user_stats(user_id):
+    stats = DreamStats.objects.filter(user_id=user_id).first()
+    if stats is None:
+        stats = rebuild_user_stats(user_id)
+    return stats
+
+
+def _streaks(days, today):
+    longest = current = run = 0
+    previous = None
+    for day in sorted(days):
+        run = run + 1 if previous and day - previous == datetime.timedelta(days=1) else 1
+        longest = max(longest, run)
+        previous = day
+    if previous and today - previous <= datetime.timedelta(days=1):
+        current = run
+    return current, longest
+
+
+def serialize_stats(stats, today=None):
+    today = today or timezone.localdate()
+    days = {datetime.date.fromisoformat(day): count for day, count in stats.daily_counts.items()}
+    weekly = Counter()
+    for day, count in days.items():
+        year, week, _ = day.isocalendar()
+        weekly[f"{year}-W{week:02d}"] += count
+    current_streak, longest_streak = _streaks(days, today)
+
+    emotion_names = dict(
+        Emotion.objects.filter(pk__in=stats.emotion_counts).values_list("id", "name")
+    )
+    theme_names = dict(
+        Theme.objects.filter(pk__in=stats.theme_counts).values_list("id", "name")
+    )
+    emotions = sorted(
+        (
+            {
+                "id": int(key),
+                "name": emotion_names.get(int(key)),
+                "count": count,
+                "average_intensity": round(intensity / count, 2),
+            }
+            for key, (count, intensity) in stats.emotion_counts.items()
+        ),
+        key=lambda item: (-item["count"], item["id"]),
+    )
+    themes = sorted(
+        (
+            {"id": int(key), "name": theme_names.get(int(key)), "count": count}
+            for key, count in stats.theme_counts.items()
+        ),
+        key=lambda item: (-item["count"], item["id"]),
+    )
+    tagged = sum(count for count, _ in stats.emotion_counts.values())
+    intensity = sum(total for _, total in stats.emotion_counts.values())
+    return {
+        "dream_count": stats.dream_count,
+        "lucid_count": stats.lucid_count,
+        "lucid_ratio": round(stats.lucid_count / stats.dream_count, 4) if stats.dream_count else 0.0,
+        "average_intensity": round(intensity / tagged, 2) if tagged else None,
+        "current_streak": current_streak,
+        "longest_streak": longest_streak,
+        "daily": dict(sorted(stats.daily_counts.items())),
+        "weekly": dict(sorted(weekly.items())),
+        "emotions": emotions,
+        "themes": themes,
+        "updated_at": stats.updated_at,
+    }
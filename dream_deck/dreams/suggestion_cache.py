@@ -0,0 +1,96 @@
+import hashlib
+import re
+import unicodedata
+
+from django.conf import settings
+from django.core.cache import caches
+
+STATS_PREFIX = "suggest-stats"
+
+_whitespace = re.compile(r"\s+")
+
+
+def _cache():
+    return caches[settings.SUGGESTION_CACHE_ALIAS]
+
+
+def _stats():
+    return caches[settings.SUGGESTION_STATS_CACHE_ALIAS]
+
+
+def normalize_content(content):
+    return _whitespace.sub(" ", unicodedata.normalize("NFC", content)).strip()
+
+
+def make_key(endpoint, version, model, content):
+    # The template version is part of the key, so bumping one endpoint's
+    # prompt leaves the entries of the other endpoints untouched.
+    digest = hashlib.sha256(normalize_content(content).encode("utf-8")).hexdigest()
+    return f"suggest:{endpoint}:v{version}:{model}:{digest}"
+
+
+def _count(endpoint, outcome):
+    key = f"{STATS_PREFIX}:{endpoint}:{outcome}"
+    stats = _stats()
+    stats.add(key, 0, timeout=None)
+    try:
+        stats.incr(key)
+    except ValueError:
+        # The counter was evicted between add() and incr().
+        stats.set(key, 1, timeout=None)
+
+
+async def _acount(endpoint, outcome):
+    key = f"{STATS_PREFIX}:{endpoint}:{outcome}"
+    stats = _stats()
+    await stats.aadd(key, 0, timeout=None)
+    try:
+        await stats.aincr(key)
+    except ValueError:
+        await stats.aset(key, 1, timeout=None)
+
+
+def get(endpoint, key):
+    value = _cache().get(key)
+    _count(endpoint, "misses" if value is None else "hits")
+    return value
+
+
+def set(key, value):
+    _cache().set(key, value, timeout=settings.SUGGESTION_CACHE_TIMEOUT)
+
+
+async def aget(endpoint, key):
+    value = await _cache().aget(key)
+    await _acount(endpoint, "misses" if value is None else "hits")
+    return value
+
+
+async def aset(key, value):
+    await _cache().aset(key, value, timeout=settings.SUGGESTION_CACHE_TIMEOUT)
+
+
+def count_local(endpoint):
+    # Answered by the local tagger without looking at the cache.
+    _count(endpoint, "local")
+
+
+def get_stats(endpoints):
+    keys = [
+        f"{STATS_PREFIX}:{endpoint}:{outcome}"
+        for endpoint in endpoints
+        for outcome in ("hits", "misses", "local")
+    ]
+    values = _stats().get_many(keys)
+    stats = {}
+    for endpoint in endpoints:
+        hits = values.get(f"{STATS_PREFIX}:{endpoint}:hits", 0)
+        misses = values.get(f"{STATS_PREFIX}:{endpoint}:misses", 0)
+        total = hits + misses
+        stats[endpoint] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "local": values.get(f"{STATS_PREFIX}:{endpoint}:local", 0),
+        }
+    return stats
@@ -0,0 +1,232 @@
+import logging
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import llm, prompts, suggestion_cache, tagger
+from .knowledge import tokenize
+from .models import Emotion, TaggerModel, Theme
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Suggestion:
+    template: str
+    parse: Callable
+    # None when parse() already returns the full response body.
+    response_key: Optional[str]
+    # Bump when the template or parser changes to invalidate cached results.
+    version: int = 1
+    model: str = llm.FLASH_MODEL
+
+    def build_prompt(self, content):
+        return self.template.format(content=content)
+
+    def to_data(self, text):
+        parsed = self.parse(text)
+        if self.response_key is None:
+            return parsed
+        return {self.response_key: parsed}
+
+
+SUGGESTIONS = {
+    "suggest_themes": Suggestion(
+        prompts.THEMES_PROMPT, prompts.parse_themes, "suggested_themes"
+    ),
+    "suggest_emotions": Suggestion(
+        prompts.EMOTIONS_PROMPT, prompts.parse_emotions, "suggested_emotions"
+    ),
+    "suggest_title": Suggestion(
+        prompts.TITLE_PROMPT, prompts.parse_title, "suggested_title"
+    ),
+}
+
+# Endpoints the local tagger can answer before Gemini is asked.
+LOCAL_TAGGERS = {
+    "suggest_themes": TaggerModel.THEMES,
+    "suggest_emotions": TaggerModel.EMOTIONS,
+}
+
+COMBINED_ENDPOINT = "suggest_all"
+COMBINED = Suggestion(prompts.SUGGEST_ALL_PROMPT, prompts.parse_suggest_all, None)
+
+
+def _cache_key(endpoint, suggestion, content):
+    return suggestion_cache.make_key(
+        endpoint, suggestion.version, suggestion.model, content
+    )
+
+
+def _log_combined_savings(content):
+    # What the three single-purpose prompts would have cost for this content,
+    # against the combined one, both estimated the same way.
+    separate_tokens = sum(
+        llm.estimate_tokens(suggestion.build_prompt(content))
+        for suggestion in SUGGESTIONS.values()
+    )
+    saved_tokens = separate_tokens - llm.estimate_tokens(COMBINED.build_prompt(content))
+    saved_calls = len(SUGGESTIONS) - 1
+    llm.gemini_logger.info(
+        f"{COMBINED_ENDPOINT}, Saved prompt tokens: {saved_tokens}, Saved calls: {saved_calls}",
+        extra={
+            "fields": {
+                "endpoint": COMBINED_ENDPOINT,
+                "saved_prompt_tokens": saved_tokens,
+                "saved_calls": saved_calls,
+            }
+        },
+    )
+
+
+def _generate(endpoint, suggestion, content, user):
+    result = llm.generate(
+        suggestion.build_prompt(content),
+        model=suggestion.model,
+        endpoint=endpoint,
+        user=user,
+    )
+    if endpoint == COMBINED_ENDPOINT:
+        _log_combined_savings(content)
+    return suggestion.to_data(result.text)
+
+
+async def _agenerate(endpoint, suggestion, content, user):
+    result = await llm.agenerate(
+        suggestion.build_prompt(content),
+        model=suggestion.model,
+        endpoint=endpoint,
+        user=user,
+    )
+    if endpoint == COMBINED_ENDPOINT:
+        _log_combined_savings(content)
+    return suggestion.to_data(result.text)
+
+
+def _matching_names(model, content, limit=3):
+    # Names from the shared Theme/Emotion tables whose words all occur in the
+    # dream, most mentioned first.
+    counts = {}
+    for token in tokenize(content):
+        counts[token] = counts.get(token, 0) + 1
+    matches = []
+    for name in model.objects.order_by("name").values_list("name", flat=True):
+        words = tokenize(name)
+        if words and all(word in counts for word in words):
+            matches.append((-min(counts[word] for word in words), name))
+    return [name for _, name in sorted(matches)[:limit]]
+
+
+def _fallback_title(content):
+    first = content.strip().split("\n", 1)[0].split(". ", 1)[0].rstrip(".!?")
+    return prompts.parse_title(" ".join(first.split()[:6]))
+
+
+def fallback(endpoint, content):
+    # Cheap answers without Gemini, served while it is failing. They are not
+    # cached, so the next successful call replaces them.
+    data = {
+        "suggested_title": _fallback_title(content),
+        "suggested_themes": _matching_names(Theme, content),
+        "suggested_emotions": [
+            {"name": name} for name in _matching_names(Emotion, content)
+        ],
+    }
+    if endpoint != COMBINED_ENDPOINT:
+        key = SUGGESTIONS[endpoint].response_key
+        data = {key: data[key]}
+    return {**data, "fallback": True}
+
+
+def _use_fallback(endpoint, exc):
+    if not isinstance(exc, llm.LLMError) and not llm.is_transient(exc):
+        return False
+    logger.warning(
+        f"{endpoint}: serving fallback suggestions ({type(exc).__name__}: {exc})"
+    )
+    return True
+
+
+def _cached(endpoint, suggestion, content, user):
+    key = _cache_key(endpoint, suggestion, content)
+    data = suggestion_cache.get(endpoint, key)
+    if data is None:
+        try:
+            data = _generate(endpoint, suggestion, content, user)
+        except Exception as exc:
+            if not _use_fallback(endpoint, exc):
+                raise
+            return fallback(endpoint, content)
+        suggestion_cache.set(key, data)
+    return data
+
+
+async def _acached(endpoint, suggestion, content, user):
+    key = _cache_key(endpoint, suggestion, content)
+    data = await suggestion_cache.aget(endpoint, key)
+    if data is None:
+        try:
+            data = await _agenerate(endpoint, suggestion, content, user)
+        except Exception as exc:
+            if not _use_fallback(endpoint, exc):
+                raise
+            return await sync_to_async(fallback)(endpoint, content)
+        await suggestion_cache.aset(key, data)
+    return data
+
+
+# user is charged for the call (dreams/usage.py); cache hits and local
+# tagger answers are free.
+
+
+def suggest_all(content, user=None):
+    return _cached(COMBINED_ENDPOINT, COMBINED, content, user)
+
+
+async def asuggest_all(content, user=None):
+    return await _acached(COMBINED_ENDPOINT, COMBINED, content, user)
+
+
+def _pick(key, data):
+    picked = {key: data[key]}
+    if data.get("fallback"):
+        picked["fallback"] = True
+    return picked
+
+
+def _local(endpoint, content):
+    kind = LOCAL_TAGGERS.get(endpoint)
+    names = tagger.suggest(kind, content) if kind else None
+    if names is None:
+        return None
+    suggestion_cache.count_local(endpoint)
+    if kind == TaggerModel.EMOTIONS:
+        return {"suggested_emotions": [{"name": name} for name in names]}
+    return {"suggested_themes": names}
+
+
+def suggest(endpoint, content, user=None):
+    suggestion = SUGGESTIONS[endpoint]
+    data = _local(endpoint, content)
+    if data is not None:
+        return data
+    if settings.SUGGEST_FROM_COMBINED:
+        # One combined call answers all three single-purpose endpoints.
+        return _pick(suggestion.response_key, suggest_all(content, user))
+    return _cached(endpoint, suggestion, content, user)
+
+
+async def asuggest(endpoint, content, user=None):
+    suggestion = SUGGESTIONS[endpoint]
+    data = await sync_to_async(_local)(endpoint, content)
+    if data is not None:
+        return data
+    if settings.SUGGEST_FROM_COMBINED:
+        return _pick(suggestion.response_key, await asuggest_all(content, user))
+    return await _acached(endpoint, suggestion, content, user)
+
+
+def cache_stats():
+    return suggestion_cache.get_stats([*SUGGESTIONS, COMBINED_ENDPOINT])
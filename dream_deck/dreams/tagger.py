@@ -0,0 +1,260 @@
+import io
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .knowledge import tokenize
+from .models import Dream, DreamEmotion, DreamTheme, Emotion, TaggerModel, Theme
+
+# First-tier theme and emotion suggestions without a Gemini call: one naive
+# Bayes classifier per vocabulary, trained from the tags users gave their
+# dreams (train_tagger command) and loaded once per process.
+
+SOURCES = {
+    TaggerModel.THEMES: (DreamTheme, "theme_id", Theme),
+    TaggerModel.EMOTIONS: (DreamEmotion, "emotion_id", Emotion),
+}
+
+
+class NaiveBayesTagger:
+    # One binary multinomial naive Bayes model per label (label vs. all other
+    # tagged dreams) over log-scaled, IDF weighted and L2 normalized term
+    # frequencies, so every label gets its own probability and a dream can
+    # carry several. All labels share one weight matrix; predicting is a
+    # gather and a small matrix-vector product.
+    def __init__(self, vocabulary, idf, label_ids, label_names, prior, weights):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.label_ids = label_ids
+        self.label_names = label_names
+        self.prior = prior
+        self.weights = weights
+
+    @staticmethod
+    def _counts(text):
+        return Counter(tokenize(text))
+
+    def vectorize(self, text):
+        pairs = [
+            (self.vocabulary[token], count)
+            for token, count in self._counts(text).items()
+            if token in self.vocabulary
+        ]
+        if not pairs:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        indices = np.fromiter((index for index, _ in pairs), dtype=np.int64, count=len(pairs))
+        counts = np.fromiter((count for _, count in pairs), dtype=np.float32, count=len(pairs))
+        values = np.log1p(counts) * self.idf[indices]
+        return indices, values / np.linalg.norm(values)
+
+    def predict(self, text):
+        # [(label id, name, probability)], most likely first.
+        indices, values = self.vectorize(text)
+        if not len(indices):
+            return []
+        log_odds = self.prior + self.weights[:, indices] @ values
+        probabilities = 1.0 / (1.0 + np.exp(-log_odds))
+        order = np.argsort(-probabilities)
+        return [
+            (int(self.label_ids[i]), str(self.label_names[i]), float(probabilities[i]))
+            for i in order
+        ]
+
+    @classmethod
+    def fit(cls, documents, min_df=2, max_features=50_000, alpha=1.0):
+        # documents: callable returning a fresh iterable of (text, label ids,
+        # label names); it is read twice so the corpus never sits in memory.
+        document_frequency = Counter()
+        count = 0
+        for text, _, _ in documents():
+            count += 1
+            document_frequency.update(cls._counts(text).keys())
+        terms = sorted(
+            term for term, df in document_frequency.most_common(max_features) if df >= min_df
+        )
+        if not terms:
+            return None
+        idf = np.array(
+            [math.log((1 + count) / (1 + document_frequency[term])) + 1 for term in terms],
+            dtype=np.float32,
+        )
+        tagger = cls({term: index for index, term in enumerate(terms)}, idf, None, None, None, None)
+
+        size = len(terms)
+        names = {}
+        label_docs = Counter()
+        rows = defaultdict(lambda: np.zeros(size, dtype=np.float64))
+        total = np.zeros(size, dtype=np.float64)
+        for text, labels, label_names in documents():
+            indices, values = tagger.vectorize(text)
+            total[indices] += values
+            for label, name in zip(labels, label_names):
+                names[label] = name
+                label_docs[label] += 1
+                rows[label][indices] += values
+
+        tagger.label_ids = np.array(sorted(rows), dtype=np.int64)
+        tagger.label_names = np.array([names[label] for label in tagger.label_ids])
+        positive = np.stack([rows[label] for label in tagger.label_ids])
+        negative = total - positive
+        positive_log = np.log(positive + alpha) - np.log(positive.sum(axis=1, keepdims=True) + alpha * size)
+        negative_log = np.log(negative + alpha) - np.log(negative.sum(axis=1, keepdims=True) + alpha * size)
+        tagger.weights = (positive_log - negative_log).astype(np.float32)
+        docs = np.array([label_docs[label] for label in tagger.label_ids], dtype=np.float64)
+        tagger.prior = (np.log(docs) - np.log(np.maximum(count - docs, 1))).astype(np.float32)
+        tagger.document_count = count
+        return tagger
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.savez_compressed(
+            buffer,
+            terms=np.array(terms),
+            idf=self.idf,
+            label_ids=self.label_ids,
+            label_names=self.label_names,
+            prior=self.prior,
+            weights=self.weights,
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            return cls(
+                {str(term): index for index, term in enumerate(arrays["terms"])},
+                arrays["idf"],
+                arrays["label_ids"],
+                arrays["label_names"],
+                arrays["prior"],
+                arrays["weights"],
+            )
+
+
+def training_documents(kind):
+    # Tagged dreams only: an untagged dream says nothing about its labels.
+    model, field, label_model = SOURCES[kind]
+    names = dict(label_model.objects.values_list("id", "name"))
+    labels = defaultdict(set)
+    for dream_id, label_id in model.objects.values_list("dream_id", field).iterator(chunk_size=10_000):
+        labels[dream_id].add(label_id)
+    dreams = (
+        Dream.objects.filter(pk__in=model.objects.values("dream_id"))
+        .order_by("id")
+        .values_list("id", "content")
+    )
+
+    def documents():
+        for dream_id, content in dreams.iterator(chunk_size=2000):
+            ids = sorted(labels[dream_id])
+            yield content, ids, [names[label_id] for label_id in ids]
+
+    return documents
+
+
+def train(kind):
+    config = settings.DREAM_TAGGER
+    tagger = NaiveBayesTagger.fit(
+        training_documents(kind), min_df=config["MIN_DF"], max_features=config["MAX_FEATURES"]
+    )
+    if tagger is None:
+        TaggerModel.objects.filter(kind=kind).delete()
+    else:
+        TaggerModel.objects.update_or_create(
+            kind=kind,
+            defaults={
+                "dream_count": tagger.document_count,
+                "data": tagger.to_bytes(),
+                "trained_at": timezone.now(),
+            },
+        )
+    reset_taggers()
+    return tagger
+
+
+def confident_labels(tagger, content):
+    config = settings.DREAM_TAGGER
+    return [
+        name
+        for _, name, probability in tagger.predict(content)[: config["MAX_LABELS"]]
+        if probability >= config["MIN_CONFIDENCE"]
+    ]
+
+
+def evaluate(kind, holdout=10):
+    # Trains on all but every holdout-th tagged dream and reports, for the
+    # rest, how often the model would answer without Gemini and how many of
+    # its labels the user actually picked.
+    config = settings.DREAM_TAGGER
+    documents = training_documents(kind)
+    tagger = NaiveBayesTagger.fit(
+        lambda: (doc for i, doc in enumerate(documents()) if i % holdout),
+        min_df=config["MIN_DF"],
+        max_features=config["MAX_FEATURES"],
+    )
+    tested = answered = suggested = correct = 0
+    for i, (text, _, names) in enumerate(documents()):
+        if i % holdout or tagger is None:
+            continue
+        tested += 1
+        labels = confident_labels(tagger, text)
+        if labels:
+            answered += 1
+            suggested += len(labels)
+            correct += len(set(labels) & set(names))
+    return {
+        "tested": tested,
+        "coverage": answered / tested if tested else 0.0,
+        "precision": correct / suggested if suggested else 0.0,
+    }
+
+
+_taggers = {}
+_checked_at = {}
+_lock = threading.Lock()
+
+
+def get_tagger(kind):
+    # Loaded on first use; other processes pick up a retrained model within
+    # REFRESH_INTERVAL seconds.
+    config = settings.DREAM_TAGGER
+    now = time.monotonic()
+    if kind in _taggers and now - _checked_at[kind] < config["REFRESH_INTERVAL"]:
+        return _taggers[kind][1]
+    with _lock:
+        trained_at = (
+            TaggerModel.objects.filter(kind=kind).values_list("trained_at", flat=True).first()
+        )
+        current = _taggers.get(kind)
+        if trained_at is None:
+            _taggers[kind] = (None, None)
+        elif current is None or current[0] != trained_at:
+            row = TaggerModel.objects.get(kind=kind)
+            if row.dream_count >= config["MIN_DREAMS"]:
+                _taggers[kind] = (trained_at, NaiveBayesTagger.from_bytes(bytes(row.data)))
+            else:
+                _taggers[kind] = (trained_at, None)
+        _checked_at[kind] = now
+        return _taggers[kind][1]
+
+
+def reset_taggers():
+    with _lock:
+        _taggers.clear()
+        _checked_at.clear()
+
+
+def suggest(kind, content):
+    # Label names the model is confident about, or None to ask Gemini.
+    if not settings.DREAM_TAGGER["ENABLED"]:
+        return None
+    tagger = get_tagger(kind)
+    if tagger is None:
+        return None
+    return confident_labels(tagger, content) or None
@@ -1,3 +1,933 @@
-from django.test import TestCase
+import asyncio
+import dataclasses
+import importlib
+import io
+import json
+import re
+import shutil
+import tempfile
+import threading
+import wave
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DataError, IntegrityError, connection, transaction
+from django.test import AsyncClient, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+import numpy as np
+from rest_framework.test import APIClient
+
+from . import (
+    benchmarks,
+    embeddings,
+    jobs,
+    llm,
+    metrics,
+    prompts,
+    search,
+    stats,
+    suggestions,
+    tagger,
+    throttling,
+    transfer,
+)
+from .authentication import ClaimsRefreshToken
+from .models import (
+    BackgroundJob,
+    Dream,
+    DreamEmotion,
+    DreamInsight,
+    DreamTheme,
+    Emotion,
+    TaggerModel,
+    Theme,
+    User,
+)
+from .throttling import SuggestThrottle
+
+
+class DreamListQueryCountTests(TestCase):
+    # Listing dreams must not issue per-dream queries for insight, emotions
+    # or themes.
+    EXPECTED_QUERIES = 3  # dreams (+ insight join), emotions, themes
+
+    def setUp(self):
+        # Ids and versions repeat between tests, cached responses must not.
+        caches[settings.RESPONSE_CACHE_ALIAS].clear()
+        self.user = User.objects.create_user(username="sleeper", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.emotions = [Emotion.objects.create(name=f"emotion-{i}") for i in range(3)]
+        self.themes = [Theme.objects.create(name=f"theme-{i}") for i in range(3)]
+
+    def create_dreams(self, count):
+        for i in range(count):
+            dream = Dream.objects.create(user=self.user, title=f"Dream {i}", content="...")
+            DreamInsight.objects.create(dream=dream, summary="summary", analysis="analysis")
+            for emotion in self.emotions:
+                DreamEmotion.objects.create(dream=dream, emotion=emotion, intensity=5)
+            for theme in self.themes:
+                DreamTheme.objects.create(dream=dream, theme=theme)
+
+    def assert_constant_queries(self, url, extra_queries=0):
+        for count in (1, 10):
+            # Dream versions are bumped on commit.
+            with self.captureOnCommitCallbacks(execute=True):
+                Dream.objects.all().delete()
+                self.create_dreams(count)
+            with self.assertNumQueries(self.EXPECTED_QUERIES + extra_queries):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            results = response.data["results"]
+            self.assertEqual(len(results), count)
+            self.assertEqual(len(results[0]["emotions"]), 3)
+            self.assertEqual(len(results[0]["themes"]), 3)
+            self.assertEqual(results[0]["insight"]["summary"], "summary")
+
+    # The user's own listings also read their dream version for the ETag.
+    def test_list(self):
+        self.assert_constant_queries(reverse("dream-list"), extra_queries=1)
+
+    def test_my_dreams(self):
+        self.assert_constant_queries(reverse("dream-my-dreams"), extra_queries=1)
+
+    def test_all_dreams(self):
+        self.user.is_premium = True
+        self.user.save()
+        self.assert_constant_queries(reverse("dream-all-dreams"))
+
+
+class DreamQueryPlanTests(TestCase):
+    # The main dream endpoints must be served from indexes, not full table
+    # scans, on a seeded journal.
+    USERS = 5
+    DREAMS_PER_USER = 60
+
+    @classmethod
+    def setUpTestData(cls):
+        emotions = [Emotion.objects.create(name=f"emotion-{i}") for i in range(10)]
+        themes = [Theme.objects.create(name=f"theme-{i}") for i in range(10)]
+        cls.users = [
+            User.objects.create_user(username=f"sleeper-{i}", password="pw")
+            for i in range(cls.USERS)
+        ]
+        dreams = Dream.objects.bulk_create(
+            Dream(user=user, title=f"Dream {i}", content="...")
+            for user in cls.users
+            for i in range(cls.DREAMS_PER_USER)
+        )
+        DreamInsight.objects.bulk_create(
+            DreamInsight(dream=dream, summary="summary", analysis="analysis")
+            for dream in dreams[::3]
+        )
+        DreamEmotion.objects.bulk_create(
+            DreamEmotion(dream=dream, emotion=emotions[(dream.pk + i) % 10], intensity=5)
+            for dream in dreams
+            for i in range(3)
+        )
+        DreamTheme.objects.bulk_create(
+            DreamTheme(dream=dream, theme=themes[(dream.pk + i) % 10])
+            for dream in dreams
+            for i in range(2)
+        )
+
+    def setUp(self):
+        caches[settings.RESPONSE_CACHE_ALIAS].clear()
+        self.user = self.users[0]
+        self.user.is_premium = True
+        self.user.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        if connection.vendor == "postgresql":
+            # The seeded tables are small enough that the planner would
+            # rightly prefer sequential scans; only fail if no index applies.
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def full_scans(self, sql, allow_index_walk):
+        with connection.cursor() as cursor:
+            cursor.execute(connection.ops.explain_query_prefix() + " " + sql)
+            plan = [" ".join(map(str, row)) for row in cursor.fetchall()]
+        if connection.vendor == "postgresql":
+            return [line for line in plan if "Seq Scan" in line]
+        # SQLite reports "SEARCH" for index lookups and "SCAN" for reading a
+        # whole table or index. Walking an ordered index is only fine for an
+        # unfiltered listing, which stops at its LIMIT; sorting rows before a
+        # LIMIT means every candidate row was read.
+        limited = " LIMIT " in sql
+        return [
+            line for line in plan
+            if (re.search(r"\bSCAN\b", line) and not (allow_index_walk and limited and "INDEX" in line))
+            or (limited and "TEMP B-TREE FOR ORDER BY" in line)
+        ]
+
+    def assert_indexed(self, url, allow_index_walk=False):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        for query in queries:
+            if not query["sql"].startswith("SELECT"):
+                continue
+            self.assertEqual(
+                self.full_scans(query["sql"], allow_index_walk), [], query["sql"]
+            )
+        return response
+
+    def test_list(self):
+        response = self.assert_indexed(reverse("dream-list"))
+        self.assert_indexed(response.data["next"])
+
+    def test_my_dreams(self):
+        self.assert_indexed(reverse("dream-my-dreams"))
+
+    def test_all_dreams(self):
+        response = self.assert_indexed(reverse("dream-all-dreams"), allow_index_walk=True)
+        self.assert_indexed(response.data["next"], allow_index_walk=True)
+
+    def test_retrieve(self):
+        dream = Dream.objects.filter(user=self.user).first()
+        self.assert_indexed(reverse("dream-detail", args=[dream.pk]))
+
+    def test_stats(self):
+        self.assert_indexed(reverse("dream_stats"))
+
+
+class GeminiCircuitTests(TestCase):
+    # Runs against the fake backend with injected failures and latency.
+    CONTENT = "I was flying over dark water and felt fear."
+
+    def setUp(self):
+        Theme.objects.create(name="Water")
+        Theme.objects.create(name="Desert")
+        Emotion.objects.create(name="Fear")
+        self.user = User.objects.create_user(username="sleeper", password="pw")
+
+    def fake_client(self, **config):
+        override = override_settings(
+            GEMINI_CLIENT={
+                **settings.GEMINI_CLIENT,
+                "BACKEND": "fake",
+                "BREAKER_FAILURE_THRESHOLD": 2,
+                "BREAKER_RESET_TIMEOUT": 60,
+                **config,
+            }
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        return llm.get_client()
+
+    def test_opens_after_consecutive_failures(self):
+        self.fake_client(FAKE_ERROR_RATE=1.0)
+        breaker = llm.get_client().get_breaker(llm.FLASH_MODEL)
+        for _ in range(2):
+            with self.assertRaises(llm.google_exceptions.ServiceUnavailable):
+                llm.generate("prompt", model=llm.FLASH_MODEL, endpoint="suggest_title")
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(llm.CircuitOpen):
+            llm.generate("prompt", model=llm.FLASH_MODEL, endpoint="suggest_title")
+        # Circuits are per model.
+        self.assertEqual(llm.get_client().get_breaker(llm.PRO_MODEL).state, "closed")
+
+    def test_fallback_while_failing(self):
+        self.fake_client(FAKE_ERROR_RATE=1.0)
+        data = suggestions.suggest_all(self.CONTENT, self.user)
+        self.assertEqual(
+            data,
+            {
+                "suggested_title": "I was flying over dark water",
+                "suggested_themes": ["Water"],
+                "suggested_emotions": [{"name": "Fear"}],
+                "fallback": True,
+            },
+        )
+        self.assertEqual(
+            suggestions.suggest("suggest_themes", self.CONTENT, self.user),
+            {"suggested_themes": ["Water"], "fallback": True},
+        )
+
+    def test_errors_without_fallback_are_not_leaked(self):
+        error = llm.google_exceptions.PermissionDenied("API key sk-secret is invalid")
+        self.enterContext(mock.patch.object(suggestions, "_generate", side_effect=error))
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with self.assertLogs("dreams.views", "ERROR"):
+            response = client.post(reverse("suggest_dreams"), {"content": self.CONTENT}, format="json")
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json(), {"error": "aiUnavailable"})
+
+    def test_half_open_trial_closes_circuit(self):
+        client = self.fake_client(FAKE_ERROR_RATE=1.0, BREAKER_RESET_TIMEOUT=0)
+        breaker = client.get_breaker(llm.FLASH_MODEL)
+        for _ in range(2):
+            with self.assertRaises(llm.google_exceptions.ServiceUnavailable):
+                llm.generate("prompt", model=llm.FLASH_MODEL, endpoint="suggest_title")
+        client.backend.config = {**client.config, "FAKE_ERROR_RATE": 0.0}
+        llm.generate("prompt", model=llm.FLASH_MODEL, endpoint="suggest_title")
+        self.assertEqual(breaker.state, "closed")
+
+    def test_deadline(self):
+        self.fake_client(FAKE_LATENCY=0.2, TIMEOUT=0.05)
+        with self.assertRaises(llm.google_exceptions.DeadlineExceeded):
+            llm.generate("prompt", model=llm.PRO_MODEL, endpoint="suggest_title")
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(
+                llm.agenerate("prompt", model=llm.PRO_MODEL, endpoint="suggest_title")
+            )
+        self.assertEqual(llm.get_client().get_breaker(llm.PRO_MODEL).state, "open")
+
+
+class MediaProcessingTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        self.enterContext(
+            override_settings(MEDIA_PROCESSING={**settings.MEDIA_PROCESSING, "FFMPEG": "missing-ffmpeg"})
+        )
+        self.user = User.objects.create_user(username="sleeper", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def recording(self, seconds, rate=8000):
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as output:
+            output.setnchannels(1)
+            output.setsampwidth(2)
+            output.setframerate(rate)
+            output.writeframes(b"\xff\x7f" * int(seconds * rate))
+        return SimpleUploadedFile("dream.wav", buffer.getvalue(), content_type="audio/wav")
+
+    def upload(self, method, url, seconds):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = getattr(self.client, method)(
+                url, {"title": "Dream", "content": "...", "audio_recording": self.recording(seconds)},
+                format="multipart",
+            )
+        jobs.run_pending()
+        return self.client.get(f"/api/v1/dreams/{response.json()['id']}/").json()
+
+    def test_recording_is_measured_in_the_background(self):
+        dream = self.upload("post", "/api/v1/dreams/", 12)
+        self.assertEqual(dream["audio_duration"], 12.0)
+        self.assertEqual(len(dream["audio_peaks"]), settings.MEDIA_PROCESSING["WAVEFORM_PEAKS"])
+        self.assertEqual(max(dream["audio_peaks"]), 1.0)
+
+        dream = self.upload("patch", f"/api/v1/dreams/{dream['id']}/", 2)
+        self.assertEqual(dream["audio_duration"], 2.0)
+        self.assertEqual(len(dream["audio_peaks"]), 20)
+
+
+class ClaimsAuthenticationTests(TestCase):
+    def setUp(self):
+        caches[settings.AUTH_TOKENS["CACHE_ALIAS"]].clear()
+        self.user = User.objects.create_user(username="sleeper", password="pw-12345678")
+        self.client = APIClient()
+        response = self.client.post(
+            "/api/v1/token/", {"username": "sleeper", "password": "pw-12345678"}, format="json"
+        )
+        self.tokens = response.json()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.tokens['access']}")
+
+    def test_no_user_query_once_state_is_cached(self):
+        self.client.get("/api/v1/usage/")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get("/api/v1/usage/").status_code, 200)
+        self.assertFalse(any('"dreams_user"' in query["sql"] for query in queries))
+
+    def test_user_built_from_claims(self):
+        other = User.objects.create_user(username="other", password="pw")
+        Dream.objects.create(user=other, title="Not mine", content="...")
+        response = self.client.get("/api/v1/dreams/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"], [])
+        self.assertEqual(self.client.get("/api/v1/ai/health/").status_code, 403)
+
+    def test_changed_claims_need_a_refresh(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_premium = True
+            self.user.save()
+        self.assertEqual(self.client.get("/api/v1/usage/").status_code, 401)
+        response = APIClient().post("/api/v1/token/refresh/", {"refresh": self.tokens["refresh"]}, format="json")
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.json()['access']}")
+        self.assertEqual(self.client.get("/api/v1/usage/").status_code, 200)
+
+    def test_password_change_revokes_tokens(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.set_password("pw-87654321")
+            self.user.save()
+        self.assertEqual(self.client.get("/api/v1/usage/").status_code, 401)
+        response = APIClient().post("/api/v1/token/refresh/", {"refresh": self.tokens["refresh"]}, format="json")
+        self.assertEqual(response.status_code, 401)
+
+
+class LoginTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="sleeper", email="sleeper@example.com", password="pw-12345678"
+        )
+        self.client = APIClient()
+
+    def login(self, username_or_email, password="pw-12345678"):
+        return self.client.post(
+            "/api/v1/login/", {"usernameOrEmail": username_or_email, "password": password}, format="json"
+        )
+
+    def test_login_by_username_or_email(self):
+        self.assertEqual(self.login("sleeper").status_code, 200)
+        response = self.login("Sleeper@Example.com")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("access", response.json())
+        self.assertNotIn("sessionid", response.cookies)
+        self.assertEqual(self.login("sleeper", "wrong-password").status_code, 401)
+        self.assertEqual(self.login("nobody@example.com").status_code, 401)
+
+    def test_username_is_case_insensitive(self):
+        self.assertEqual(self.login("SLEEPER").json()["user"]["username"], "sleeper")
+        # An exact match wins over one that differs only in case.
+        User.objects.create_user(username="Sleeper", email="other@example.com", password="pw-other-123")
+        self.assertEqual(self.login("Sleeper", "pw-other-123").json()["user"]["username"], "Sleeper")
+        self.assertEqual(self.login("sleeper").json()["user"]["username"], "sleeper")
+
+    def test_weak_signup_password(self):
+        response = self.client.post(
+            "/api/v1/signup/",
+            {"username": "new", "email": "new@example.com", "password": "123", "confirm_password": "123"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "weakPassword")
+
+
+class MetricsTests(TestCase):
+    def sample(self, text, line):
+        for row in text.splitlines():
+            if row.startswith(line + " "):
+                return float(row.rsplit(" ", 1)[1])
+        return 0.0
+
+    @override_settings(METRICS={"ENABLED": True, "TOKEN": "scrape"})
+    def test_request_and_gemini_metrics(self):
+        user = User.objects.create_user(username="sleeper", password="pw")
+        client = APIClient()
+        client.force_authenticate(user)
+        count = 'http_request_duration_seconds_count{method="GET",view="dream-list",status="200"}'
+        queries = 'http_request_db_queries_count{method="GET",view="dream-list"}'
+        before = metrics.render()
+        self.assertEqual(client.get("/api/v1/dreams/").status_code, 200)
+        with override_settings(GEMINI_CLIENT={**settings.GEMINI_CLIENT, "BACKEND": "fake"}):
+            llm.generate("prompt", model=llm.FLASH_MODEL, endpoint="suggest_title")
+
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        text = response.content.decode()
+        self.assertEqual(self.sample(text, count), self.sample(before, count) + 1)
+        self.assertEqual(self.sample(text, queries), self.sample(before, queries) + 1)
+        self.assertIn('http_response_render_duration_seconds_count{method="GET",view="dream-list"}', text)
+        self.assertIn(
+            f'gemini_request_duration_seconds_count{{model="{llm.FLASH_MODEL}",endpoint="suggest_title",outcome="ok"}}',
+            text,
+        )
+        self.assertIn(f'gemini_tokens_total{{model="{llm.FLASH_MODEL}",endpoint="suggest_title",kind="prompt"}}', text)
+        self.assertIn(f'gemini_circuit_state{{model="{llm.FLASH_MODEL}"}} 0', text)
+
+    @override_settings(METRICS={"ENABLED": True, "TOKEN": "scrape"})
+    def test_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape").status_code, 200)
+
+    @override_settings(METRICS={"ENABLED": True, "TOKEN": ""})
+    def test_no_token_outside_debug(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        with override_settings(DEBUG=True):
+            self.assertEqual(self.client.get("/metrics").status_code, 200)
+
+
+class BenchmarkTests(TestCase):
+    def tearDown(self):
+        # Rolled back ids are reused by later tests.
+        for alias in (settings.RESPONSE_CACHE_ALIAS, settings.AUTH_TOKENS["CACHE_ALIAS"]):
+            caches[alias].clear()
+        embeddings.reset_index()
+
+    def test_scenarios_succeed(self):
+        names = {"dreams.list", "dreams.list.not_modified", "dreams.create", "stats", "suggest", "token.refresh"}
+        scenarios = [s for s in benchmarks.SCENARIOS if s.name in names]
+        with override_settings(**benchmarks.settings_overrides()):
+            context = benchmarks.seed(users=2, dreams_per_user=5, emotions=4, themes=4)
+            report = benchmarks.run(context, scenarios, iterations=2, warmup=1)
+        self.assertEqual(set(report["results"]), names)
+        for name, result in report["results"].items():
+            self.assertTrue(all(code < "400" for code in result["statuses"]), (name, result["statuses"]))
+        self.assertEqual(report["results"]["dreams.list.not_modified"]["statuses"], {"304": 2})
+        regressions = benchmarks.compare(report, report)
+        self.assertFalse(any(row[-1] for row in regressions))
+
+
+@override_settings(SUGGEST_FROM_COMBINED=False)
+class SuggestionCacheTests(TestCase):
+    CONTENT = "I was flying over dark water."
+
+    def setUp(self):
+        for alias in (settings.SUGGESTION_CACHE_ALIAS, settings.SUGGESTION_STATS_CACHE_ALIAS):
+            caches[alias].clear()
+        self.enterContext(override_settings(GEMINI_CLIENT={**settings.GEMINI_CLIENT, "BACKEND": "fake"}))
+
+    def counts(self):
+        stats = suggestions.cache_stats()["suggest_title"]
+        return stats["hits"], stats["misses"]
+
+    def test_hit_miss_and_version_invalidation(self):
+        first = suggestions.suggest("suggest_title", self.CONTENT)
+        self.assertEqual(self.counts(), (0, 1))
+        # Whitespace differences share an entry.
+        self.assertEqual(suggestions.suggest("suggest_title", "  I was flying\nover dark water. "), first)
+        self.assertEqual(self.counts(), (1, 1))
+
+        bumped = dataclasses.replace(suggestions.SUGGESTIONS["suggest_title"], version=2)
+        self.enterContext(mock.patch.dict(suggestions.SUGGESTIONS, {"suggest_title": bumped}))
+        suggestions.suggest("suggest_title", self.CONTENT)
+        self.assertEqual(self.counts(), (1, 2))
+        # Other endpoints keep their entries.
+        suggestions.suggest("suggest_emotions", self.CONTENT)
+        suggestions.suggest("suggest_emotions", self.CONTENT)
+        self.assertEqual(suggestions.cache_stats()["suggest_emotions"]["hits"], 1)
+
+
+class CombinedSuggestionTests(TestCase):
+    def test_savings_logged_in_estimated_tokens(self):
+        caches[settings.SUGGESTION_CACHE_ALIAS].clear()
+        content = "I was flying over dark water."
+        with override_settings(GEMINI_CLIENT={**settings.GEMINI_CLIENT, "BACKEND": "fake"}):
+            with self.assertLogs("gemini_usage", "INFO") as logs:
+                suggestions.suggest_all(content)
+        fields = [r.fields for r in logs.records if "saved_prompt_tokens" in getattr(r, "fields", {})]
+        separate = sum(llm.estimate_tokens(s.build_prompt(content)) for s in suggestions.SUGGESTIONS.values())
+        combined = llm.estimate_tokens(suggestions.COMBINED.build_prompt(content))
+        self.assertEqual(fields[0]["saved_prompt_tokens"], separate - combined)
+        self.assertGreater(fields[0]["saved_prompt_tokens"], 0)
+
+
+def failing_job(payload):
+    raise llm.google_exceptions.ServiceUnavailable("overloaded")
+
+
+@mock.patch.dict(jobs.JOB_HANDLERS, {"flaky": "dreams.tests.failing_job"})
+class BackgroundJobTests(TestCase):
+    def test_dedupe_and_claim(self):
+        job, created = jobs.enqueue("flaky", {}, dedupe_key="flaky:1")
+        self.assertTrue(created)
+        self.assertEqual(jobs.enqueue("flaky", {}, dedupe_key="flaky:1"), (job, False))
+        claimed = jobs.claim_next()
+        self.assertEqual((claimed.pk, claimed.status, claimed.attempts), (job.pk, BackgroundJob.RUNNING, 1))
+        self.assertIsNone(jobs.claim_next())
+        # Still active while running.
+        self.assertEqual(jobs.enqueue("flaky", {}, dedupe_key="flaky:1"), (claimed, False))
+
+    @override_settings(BACKGROUND_JOBS={**settings.BACKGROUND_JOBS, "MAX_ATTEMPTS": 2, "RETRY_BASE_DELAY": 60})
+    def test_transient_errors_are_retried_until_max_attempts(self):
+        job, _ = jobs.enqueue("flaky", {})
+        with self.assertLogs("dreams.jobs", "WARNING"):
+            jobs.run_job(jobs.claim_next())
+        job.refresh_from_db()
+        self.assertEqual(job.status, BackgroundJob.PENDING)
+        self.assertIn("ServiceUnavailable", job.error)
+        # Backed off.
+        self.assertIsNone(jobs.claim_next())
+
+        BackgroundJob.objects.filter(pk=job.pk).update(run_after=job.created_at)
+        with self.assertLogs("dreams.jobs", "ERROR"):
+            jobs.run_job(jobs.claim_next())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (BackgroundJob.FAILED, 2))
+
+
+class DreamPaginationTests(TestCase):
+    def test_cursor_walks_tied_dates_once(self):
+        caches[settings.RESPONSE_CACHE_ALIAS].clear()
+        user = User.objects.create_user(username="sleeper", password="pw")
+        client = APIClient()
+        client.force_authenticate(user)
+        dates = ["2024-05-01"] * 5 + ["2024-05-03", "2024-04-20"]
+        for i, date in enumerate(dates):
+            Dream.objects.create(user=user, title=f"Dream {i}", content="...", date=date)
+        expected = list(Dream.objects.order_by("-date", "-id").values_list("id", flat=True))
+
+        seen, url = [], reverse("dream-list") + "?page_size=2"
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen += [dream["id"] for dream in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(seen, expected)
+        self.assertEqual(client.get(reverse("dream-list") + "?cursor=garbage").status_code, 404)
+
+
+class DreamTagTests(TestCase):
+    def test_patch_applies_a_diff(self):
+        caches[settings.RESPONSE_CACHE_ALIAS].clear()
+        user = User.objects.create_user(username="sleeper", password="pw")
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post(
+            reverse("dream-list"),
+            {
+                "title": "Flood",
+                "content": "...",
+                "emotions": [{"name": "Fear", "intensity": 3}, {"name": "Joy", "intensity": 5}],
+                "themes": ["Water", "Fire"],
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        dream = Dream.objects.get(pk=response.data["id"])
+        fear = DreamEmotion.objects.get(dream=dream, emotion__name="Fear")
+        water = DreamTheme.objects.get(dream=dream, theme__name="Water")
+
+        response = client.patch(
+            reverse("dream-detail", args=[dream.pk]),
+            {"emotions": [{"name": "Fear", "intensity": 7}, {"name": "Awe", "intensity": 2}], "themes": ["Water", "Sky"]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        emotions = dict(DreamEmotion.objects.filter(dream=dream).values_list("emotion__name", "intensity"))
+        self.assertEqual(emotions, {"Fear": 7, "Awe": 2})
+        self.assertEqual(set(dream.themes.values_list("theme__name", flat=True)), {"Water", "Sky"})
+        # Kept tags are updated in place, not recreated.
+        self.assertTrue(DreamEmotion.objects.filter(pk=fear.pk, intensity=7).exists())
+        self.assertTrue(DreamTheme.objects.filter(pk=water.pk).exists())
+
+
+class DreamTransferTests(TestCase):
+    def setUp(self):
+        caches[settings.RESPONSE_CACHE_ALIAS].clear()
+        self.user = User.objects.create_user(username="sleeper", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_rolled_back_import_is_not_embedded(self):
+        embeddings.reset_index()
+        self.addCleanup(embeddings.reset_index)
+        index = embeddings.get_index()
+        rows = [{"title": "Flood", "content": "Water everywhere."}]
+        with mock.patch.object(transfer.versions, "record_users", side_effect=DataError("value too long")):
+            with self.captureOnCommitCallbacks(execute=True), self.assertRaises(DataError):
+                transfer._insert_batch(self.user, rows)
+        self.assertEqual(index.rows, {})
+        with self.captureOnCommitCallbacks(execute=True):
+            transfer._insert_batch(self.user, rows)
+        self.assertEqual(list(index.rows), [Dream.objects.get().pk])
+
+    def test_import_reports_bad_lines(self):
+        lines = [
+            json.dumps({"title": "Flood", "content": "...", "date": "2024-01-02", "themes": ["Water"]}),
+            "{not json",
+            json.dumps({"title": "No content"}),
+            "",
+            json.dumps(["not", "an", "object"]),
+            json.dumps({"title": "Exam", "content": "...", "emotions": [{"name": "Fear", "intensity": 4}]}),
+        ]
+        response = self.client.post(
+            reverse("dream-import-dreams"), "\n".join(lines), content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data["imported"], response.data["failed"]), (2, 3))
+        self.assertEqual([error["line"] for error in response.data["errors"]], [2, 3, 5])
+        self.assertIn("content", response.data["errors"][1]["errors"])
+        flood = Dream.objects.get(user=self.user, title="Flood")
+        self.assertEqual(str(flood.date), "2024-01-02")
+        self.assertEqual(list(flood.themes.values_list("theme__name", flat=True)), ["Water"])
+
+    @override_settings(DREAM_TRANSFER_BATCH_SIZE=2)
+    def test_export_streams_under_wsgi_and_asgi(self):
+        for i in range(5):
+            Dream.objects.create(user=self.user, title=f"Dream {i}", content="...")
+        response = self.client.get(reverse("dream-export"))
+        self.assertFalse(response.is_async)
+        exported = b"".join(response.streaming_content).decode()
+        self.assertEqual([json.loads(line)["title"] for line in exported.splitlines()], [f"Dream {i}" for i in range(5)])
+
+        access = ClaimsRefreshToken.for_user(self.user).access_token
+
+        async def export():
+            response = await AsyncClient().get(reverse("dream-export"), headers={"Authorization": f"Bearer {access}"})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_async)
+            return [chunk async for chunk in response.streaming_content]
+
+        chunks = async_to_sync(export)()
+        # Sent batch by batch.
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(b"".join(chunks).decode(), exported)
+
+
+class DreamSearchTests(TestCase):
+    def test_ranked_own_results(self):
+        user = User.objects.create_user(username="sleeper", password="pw")
+        other = User.objects.create_user(username="other", password="pw")
+        in_content = Dream.objects.create(user=user, title="Night walk", content="A lighthouse far away.")
+        in_title = Dream.objects.create(user=user, title="The lighthouse", content="Waves and wind.")
+        Dream.objects.create(user=user, title="Exam", content="Late again.")
+        Dream.objects.create(user=other, title="Lighthouse", content="Lighthouse keeper.")
+        client = APIClient()
+        client.force_authenticate(user)
+
+        results = client.get(reverse("dream-search"), {"q": "lighthouse"}).data["results"]
+        self.assertEqual([r["id"] for r in results], [in_title.pk, in_content.pk])
+        self.assertGreater(results[0]["rank"], results[1]["rank"])
+        self.assertIn(search.HIGHLIGHT_START + "lighthouse", results[0]["title_highlight"])
+        self.assertEqual(client.get(reverse("dream-search"), {"q": "submarine"}).data["results"], [])
+        self.assertEqual(client.get(reverse("dream-search")).status_code, 400)
+
+
+class SimilarDreamsTests(TestCase):
+    def setUp(self):
+        embeddings.reset_index()
+        self.addCleanup(embeddings.reset_index)
+
+    def test_vector_index(self):
+        index = embeddings.VectorIndex(2)
+        vectors = embeddings.normalize(np.array([[1, 0], [0.9, 0.1], [0, 1], [0.95, 0.05]], dtype=np.float32))
+        index.upsert([1, 2, 3, 4], [10, 10, 10, 20], vectors)
+        self.assertEqual([pk for pk, _ in index.search(vectors[0], 3, user_id=10, exclude=1)], [2, 3])
+        self.assertEqual([pk for pk, _ in index.search(vectors[0], 2, exclude=1)], [4, 2])
+        index.remove([4])
+        index.build_ann(2)
+        self.assertEqual([pk for pk, _ in index.search(vectors[0], 1, exclude=1, probes=2)], [2])
+
+    def test_similar_endpoint(self):
+        user = User.objects.create_user(username="sleeper", password="pw")
+        other = User.objects.create_user(username="other", password="pw")
+        with self.captureOnCommitCallbacks(execute=True):
+            dream = Dream.objects.create(user=user, title="Ocean", content="Swimming in a deep dark ocean with whales.")
+            close = Dream.objects.create(user=user, title="Sea", content="Swimming in the dark ocean again, whales singing.")
+            Dream.objects.create(user=user, title="Exam", content="Forgot my pencil at school.")
+            theirs = Dream.objects.create(user=other, title="Ocean", content="Swimming in a deep dark ocean with whales.")
+        client = APIClient()
+        client.force_authenticate(user)
+        url = reverse("dream-similar", args=[dream.pk])
+
+        results = client.get(url, {"limit": 1}).data["results"]
+        self.assertEqual([r["id"] for r in results], [close.pk])
+        # Only premium members search across users.
+        self.assertNotIn(theirs.pk, [r["id"] for r in client.get(url, {"scope": "all"}).data["results"]])
+        user.is_premium = True
+        user.save()
+        client.force_authenticate(user)
+        self.assertEqual(client.get(url, {"scope": "all", "limit": 1}).data["results"][0]["id"], theirs.pk)
+
+
+class DreamStatsTests(TestCase):
+    def test_rolled_back_writes_are_not_counted(self):
+        user = User.objects.create_user(username="sleeper", password="pw")
+        fear = Emotion.objects.create(name="Fear")
+        stats.get_user_stats(user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            dream = Dream.objects.create(user=user, title="Kept", content="...")
+            DreamEmotion.objects.create(dream=dream, emotion=fear, intensity=4)
+            with self.assertRaises(IntegrityError):
+                with transaction.atomic():
+                    lucid = Dream.objects.create(user=user, title="Rolled back", content="...", is_lucid=True)
+                    DreamEmotion.objects.create(dream=lucid, emotion=fear, intensity=9)
+                    Emotion.objects.create(name="Fear")
+        row = stats.get_user_stats(user.pk)
+        self.assertEqual((row.dream_count, row.lucid_count), (1, 0))
+        self.assertEqual(row.emotion_counts, {str(fear.pk): [1, 4]})
+        rebuilt = stats.rebuild_user_stats(user.pk)
+        self.assertEqual((rebuilt.dream_count, rebuilt.emotion_counts), (1, row.emotion_counts))
+
+
+@override_settings(SUGGEST_FROM_COMBINED=False)
+class GeminiQuotaTests(TestCase):
+    def setUp(self):
+        for alias in (settings.SUGGESTION_CACHE_ALIAS, settings.AI_THROTTLES["CACHE_ALIAS"]):
+            caches[alias].clear()
+        self.enterContext(override_settings(GEMINI_CLIENT={**settings.GEMINI_CLIENT, "BACKEND": "fake"}))
+        self.user = User.objects.create_user(username="sleeper", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @override_settings(GEMINI_QUOTAS={"FREE": {"REQUESTS": 2, "TOKENS": None}, "PREMIUM": {"REQUESTS": None, "TOKENS": None}})
+    def test_daily_requests_quota(self):
+        for i in range(2):
+            response = self.client.post(reverse("suggest_dreams"), {"content": f"Dream number {i}"}, format="json")
+            self.assertEqual(response.status_code, 200)
+        response = self.client.post(reverse("suggest_dreams"), {"content": "One more"}, format="json")
+        self.assertEqual(response.status_code, 429)
+        # Cached answers cost nothing.
+        response = self.client.post(reverse("suggest_dreams"), {"content": "Dream number 0"}, format="json")
+        self.assertEqual(response.status_code, 200)
+
+        usage = self.client.get(reverse("gemini_usage")).data
+        self.assertEqual((usage["requests"], usage["limits"]["requests"]), (2, 2))
+        self.assertEqual([row["endpoint"] for row in usage["endpoints"]], ["suggest_title"])
+        self.assertGreater(usage["tokens"], 0)
+
+    def test_usage_admin(self):
+        admin = User.objects.create_superuser(username="admin", password="pw")
+        self.client.force_login(admin)
+        self.assertEqual(self.client.get(reverse("admin:dreams_geminiusage_changelist")).status_code, 200)
+
+
+class ThrottleTests(TestCase):
+    def setUp(self):
+        caches[settings.AI_THROTTLES["CACHE_ALIAS"]].clear()
+        self.user = User.objects.create_user(username="sleeper", password="pw")
+
+    @override_settings(AI_THROTTLES={**settings.AI_THROTTLES, "RATES": {"suggest": {"FREE": "5/min"}}})
+    def test_concurrent_requests_share_the_bucket(self):
+        request = mock.Mock(user=self.user)
+        allowed = []
+
+        def attempt():
+            throttle = SuggestThrottle()
+            allowed.append(throttle.allow_request(request, None))
+
+        with mock.patch.object(SuggestThrottle, "timer", lambda self: 960.0):
+            threads = [threading.Thread(target=attempt) for _ in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(allowed.count(True), 5)
+            throttle = SuggestThrottle()
+            self.assertFalse(throttle.allow_request(request, None))
+            self.assertAlmostEqual(throttle.wait(), 12.0)
+        # One token back after period / capacity.
+        with mock.patch.object(SuggestThrottle, "timer", lambda self: 972.0):
+            self.assertTrue(SuggestThrottle().allow_request(request, None))
+            self.assertFalse(SuggestThrottle().allow_request(request, None))
+
+    @override_settings(
+        AI_THROTTLES={**settings.AI_THROTTLES, "RATES": {"suggest": {"FREE": "2/min"}}},
+        GEMINI_CLIENT={**settings.GEMINI_CLIENT, "BACKEND": "fake"},
+    )
+    def test_429_with_retry_after(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        for i in range(2):
+            response = client.post(reverse("suggest_dreams"), {"content": f"Dream {i}"}, format="json")
+            self.assertEqual(response.status_code, 200)
+        response = client.post(reverse("suggest_dreams"), {"content": "Dream 2"}, format="json")
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(0 < int(response["Retry-After"]) <= 30)
+
+    def test_in_flight_slot_lost_to_expiry_is_counted(self):
+        cache = throttling.get_cache()
+        incr = cache.incr
+
+        def expired_once(key, *args, **kwargs):
+            # The key expires, then another request re-creates it.
+            if not expired:
+                expired.append(key)
+                cache.set(key, 1)
+                raise ValueError(key)
+            return incr(key, *args, **kwargs)
+
+        expired = []
+        with mock.patch.object(cache, "incr", side_effect=expired_once):
+            self.assertFalse(throttling.acquire_in_flight("insight", self.user.pk, 1))
+        self.assertEqual(throttling.in_flight("insight", self.user.pk), 1)
+
+    def stream(self, dream, consume=True):
+        access = ClaimsRefreshToken.for_user(self.user).access_token
+
+        async def get():
+            response = await AsyncClient().get(
+                reverse("stream_dream_insight", args=[dream.pk]), headers={"Authorization": f"Bearer {access}"}
+            )
+            if response.status_code != 200 or not consume:
+                return response, None
+            return response, b"".join([chunk async for chunk in response.streaming_content]).decode()
+
+        return async_to_sync(get)()
+
+    @override_settings(GEMINI_CLIENT={**settings.GEMINI_CLIENT, "BACKEND": "fake"})
+    def test_stream_releases_its_slot(self):
+        dream = Dream.objects.create(user=self.user, title="Sea", content="I swam at night.")
+        response, body = self.stream(dream)
+        self.assertIn("event: done", body)
+        self.assertEqual(throttling.in_flight("insight", self.user.pk), 0)
+        # A stream closed before it was read (the client went away).
+        response, _ = self.stream(dream, consume=False)
+        self.assertEqual(throttling.in_flight("insight", self.user.pk), 1)
+        response.close()
+        self.assertEqual(throttling.in_flight("insight", self.user.pk), 0)
+
+    @override_settings(GEMINI_QUOTAS={"FREE": {"REQUESTS": 0, "TOKENS": None}, "PREMIUM": {"REQUESTS": None, "TOKENS": None}})
+    def test_stream_over_quota(self):
+        dream = Dream.objects.create(user=self.user, title="Sea", content="I swam at night.")
+        response, _ = self.stream(dream)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(throttling.in_flight("insight", self.user.pk), 0)
+
+
+@override_settings(DREAM_TAGGER={**settings.DREAM_TAGGER, "MIN_DREAMS": 10, "REFRESH_INTERVAL": 0})
+class TaggerTests(TestCase):
+    def setUp(self):
+        tagger.reset_taggers()
+        self.addCleanup(tagger.reset_taggers)
+        user = User.objects.create_user(username="sleeper", password="pw")
+        water, school = Theme.objects.create(name="Water"), Theme.objects.create(name="School")
+        for i in range(15):
+            for theme, words in ((water, "ocean waves swimming deep sea"), (school, "exam teacher classroom late test")):
+                dream = Dream.objects.create(user=user, title="...", content=f"{words} night {i}")
+                DreamTheme.objects.create(dream=dream, theme=theme)
+
+    def test_confident_local_answer(self):
+        tagger.train(TaggerModel.THEMES)
+        caches[settings.SUGGESTION_STATS_CACHE_ALIAS].clear()
+        self.assertEqual(tagger.suggest(TaggerModel.THEMES, "Swimming in a deep ocean"), ["Water"])
+        self.assertEqual(
+            suggestions.suggest("suggest_themes", "A late exam with my old teacher"),
+            {"suggested_themes": ["School"]},
+        )
+        self.assertEqual(suggestions.cache_stats()["suggest_themes"]["local"], 1)
+        # Unknown words: nothing confident, so Gemini is asked.
+        self.assertIsNone(tagger.suggest(TaggerModel.THEMES, "A purple giraffe"))
+
+    def test_small_models_are_ignored(self):
+        tagger.train(TaggerModel.THEMES)
+        with override_settings(DREAM_TAGGER={**settings.DREAM_TAGGER, "MIN_DREAMS": 1000}):
+            tagger.reset_taggers()
+            self.assertIsNone(tagger.suggest(TaggerModel.THEMES, "Swimming in a deep ocean"))
+        self.assertEqual(tagger.evaluate(TaggerModel.THEMES, holdout=5)["precision"], 1.0)
+
+
+class InsightSectionTests(TestCase):
+    ANSWER = (
+        "<scratchpad>thinking about water</scratchpad>"
+        "<dream_summary>A swim at night.</dream_summary>"
+        "<symbolic_analysis>Water is feeling.</symbolic_analysis>"
+        "<daily_affirmation>I can float.</daily_affirmation>"
+    )
+
+    def setUp(self):
+        user = User.objects.create_user(username="sleeper", password="pw")
+        self.dream = Dream.objects.create(user=user, title="Sea", content="...")
+        analysis, sections = prompts.parse_insight(self.ANSWER)
+        DreamInsight.objects.create(dream=self.dream, summary="...", analysis=analysis, sections=sections)
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        self.url = reverse("check_dream_insight", args=[self.dream.pk])
+
+    def test_selected_sections(self):
+        response = self.client.get(self.url, {"sections": "dream_summary, daily_affirmation"})
+        self.assertEqual(
+            response.json()["sections"],
+            {"dream_summary": "A swim at night.", "daily_affirmation": "I can float."},
+        )
+        self.assertNotIn("content", response.json())
+        response = self.client.get(self.url, {"sections": "all"})
+        self.assertEqual(len(response.json()["sections"]), 3)
+        response = self.client.get(self.url)
+        self.assertNotIn("scratchpad", response.json()["content"])
+        self.assertEqual(self.client.get(self.url, {"sections": "dream_summary,plot"}).status_code, 400)
+
+    def test_migration_parser_matches(self):
+        migration = importlib.import_module("dreams.migrations.0010_dreaminsight_sections")
+        self.assertEqual(migration.parse_insight(self.ANSWER), prompts.parse_insight(self.ANSWER))
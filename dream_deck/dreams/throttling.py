@@ -0,0 +1,122 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+# Per-user limits for the AI endpoints, kept in the cache named by
+# AI_THROTTLES["CACHE_ALIAS"]. Premium members get their own budgets.
+
+PERIODS = {
+    "s": 1, "sec": 1, "second": 1,
+    "m": 60, "min": 60, "minute": 60,
+    "h": 3600, "hour": 3600,
+    "d": 86400, "day": 86400,
+}
+
+
+def get_cache():
+    return caches[settings.AI_THROTTLES["CACHE_ALIAS"]]
+
+
+def tier(user):
+    return "PREMIUM" if user.is_premium else "FREE"
+
+
+def parse_rate(rate):
+    requests, period = rate.split("/")
+    return int(requests), PERIODS[period]
+
+
+class TokenBucketThrottle(BaseThrottle):
+    # GCRA: a bucket of `capacity` tokens refilling one per
+    # period / capacity seconds. Time is cut into slots of that length and
+    # every allowed request claims the first free slot after now with
+    # cache.add(), which is atomic, so concurrent requests (even in other
+    # workers sharing a Redis cache) never get the same one. A request is
+    # refused when that slot lies more than one period ahead, i.e. when the
+    # bucket is empty. The key itself only remembers the last claimed slot,
+    # so usually only one add() is needed.
+    scope = None
+    timer = time.time
+
+    def get_rate(self, request):
+        return parse_rate(settings.AI_THROTTLES["RATES"][self.scope][tier(request.user)])
+
+    def get_cache_key(self, request):
+        # Per tier, so upgrading to premium starts from a full bucket.
+        return f"throttle-slots:{self.scope}:{tier(request.user)}:{request.user.pk}"
+
+    def allow_request(self, request, view):
+        if not request.user or not request.user.is_authenticated:
+            return True
+        capacity, period = self.get_rate(request)
+        interval = period / capacity
+        cache = get_cache()
+        key = self.get_cache_key(request)
+        now = self.timer()
+        slot = max(cache.get(key, 0), int(now // interval)) + 1
+        while True:
+            ahead = slot * interval - now
+            if ahead > period:
+                self.retry_after = ahead - period
+                return False
+            if cache.add(f"{key}:{slot}", 1, timeout=int(ahead) + 1):
+                break
+            # Taken by a concurrent request.
+            slot += 1
+        cache.set(key, slot, timeout=int(ahead) + 1)
+        return True
+
+    def wait(self):
+        return self.retry_after
+
+
+class SuggestThrottle(TokenBucketThrottle):
+    scope = "suggest"
+
+
+class InsightThrottle(TokenBucketThrottle):
+    scope = "insight"
+
+
+def max_in_flight(user):
+    return settings.AI_THROTTLES["MAX_IN_FLIGHT"][tier(user)]
+
+
+def _in_flight_key(scope, user_id):
+    return f"in_flight:{scope}:{user_id}"
+
+
+def in_flight(scope, user_id):
+    return get_cache().get(_in_flight_key(scope, user_id), 0)
+
+
+def acquire_in_flight(scope, user_id, limit):
+    cache = get_cache()
+    key = _in_flight_key(scope, user_id)
+    # incr() is atomic in both LocMemCache and Redis; the timeout only
+    # matters if a worker dies without releasing its slot.
+    timeout = settings.AI_THROTTLES["IN_FLIGHT_TIMEOUT"]
+    while True:
+        cache.add(key, 0, timeout=timeout)
+        try:
+            count = cache.incr(key)
+            break
+        except ValueError:
+            # Expired between add() and incr(). If another request re-creates
+            # the key first, count this one with incr() on the next pass.
+            if cache.add(key, 1, timeout=timeout):
+                count = 1
+                break
+    if count > limit:
+        cache.decr(key)
+        return False
+    return True
+
+
+def release_in_flight(scope, user_id):
+    try:
+        get_cache().decr(_in_flight_key(scope, user_id))
+    except ValueError:
+        pass
@@ -0,0 +1,168 @@
+import json
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch
+from rest_framework import serializers
+
+from . import stats, versions
+from .embeddings import embed_dreams
+from .models import Dream, DreamEmotion, DreamTheme, Emotion, Theme
+from .search import index_dreams
+from .serializers import DreamSerializer, resolve_names
+
+# NDJSON import/export of a user's journal. Both directions work on bounded
+# batches so memory stays flat however many dreams are transferred.
+
+MAX_REPORTED_ERRORS = 100
+
+_date_field = serializers.DateField()
+
+
+def _parse_lines(stream):
+    for line_number, raw in enumerate(stream, start=1):
+        line = raw.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line), None
+        except (UnicodeDecodeError, ValueError) as e:
+            yield line_number, None, {"non_field_errors": [f"Invalid JSON: {e}"]}
+
+
+def _validate(obj, context):
+    if not isinstance(obj, dict):
+        return None, {"non_field_errors": ["Expected a JSON object."]}
+    serializer = DreamSerializer(data=obj, context=context)
+    if not serializer.is_valid():
+        return None, serializer.errors
+    data = dict(serializer.validated_data)
+    if obj.get("date"):
+        try:
+            data["date"] = _date_field.to_internal_value(obj["date"])
+        except serializers.ValidationError as e:
+            return None, {"date": e.detail}
+    return data, None
+
+
+def _insert_batch(user, rows):
+    dreams = [
+        Dream(
+            user=user,
+            title=row["title"],
+            content=row["content"],
+            is_lucid=row.get("is_lucid", False),
+        )
+        for row in rows
+    ]
+    with transaction.atomic():
+        Dream.objects.bulk_create(dreams)
+        # date is auto_now_add, so imported dates are applied afterwards.
+        dated = []
+        for dream, row in zip(dreams, rows):
+            if row.get("date"):
+                dream.date = row["date"]
+                dated.append(dream)
+        if dated:
+            Dream.objects.bulk_update(dated, ["date"])
+
+        emotion_ids = resolve_names(
+            Emotion, [e["name"] for row in rows for e in row.get("emotions", [])]
+        )
+        theme_ids = resolve_names(
+            Theme, [name for row in rows for name in row.get("themes", [])]
+        )
+        dream_emotions = []
+        dream_themes = []
+        for dream, row in zip(dreams, rows):
+            intensities = {e["name"]: e["intensity"] for e in row.get("emotions", [])}
+            dream_emotions.extend(
+                DreamEmotion(dream=dream, emotion_id=emotion_ids[name], intensity=intensity)
+                for name, intensity in intensities.items()
+            )
+            dream_themes.extend(
+                DreamTheme(dream=dream, theme_id=theme_ids[name])
+                for name in dict.fromkeys(row.get("themes", []))
+            )
+        DreamEmotion.objects.bulk_create(dream_emotions)
+        DreamTheme.objects.bulk_create(dream_themes)
+        # bulk_create() sends no post_save signals.
+        index_dreams(dream.pk for dream in dreams)
+        # The vector index is in memory, so only after the batch commits.
+        transaction.on_commit(lambda: embed_dreams(dreams))
+        stats.record_dreams(dreams)
+        stats.record_emotions(
+            (row.dream_id, row.emotion_id, 1, row.intensity) for row in dream_emotions
+        )
+        stats.record_themes((row.dream_id, row.theme_id, 1) for row in dream_themes)
+        versions.record_users([user.pk])
+    return len(dreams)
+
+
+def import_dreams(user, stream, context):
+    batch_size = settings.DREAM_TRANSFER_BATCH_SIZE
+    imported = 0
+    failed = 0
+    errors = []
+    lines = _parse_lines(stream)
+    while True:
+        chunk = list(islice(lines, batch_size))
+        if not chunk:
+            break
+        rows = []
+        for line_number, obj, error in chunk:
+            if error is None:
+                row, error = _validate(obj, context)
+            if error is not None:
+                failed += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({"line": line_number, "errors": error})
+                continue
+            rows.append(row)
+        if rows:
+            imported += _insert_batch(user, rows)
+    return {"imported": imported, "failed": failed, "errors": errors}
+
+
+def export_queryset(user):
+    return (
+        Dream.objects.filter(user=user)
+        .select_related("insight")
+        .defer("insight__sections")
+        .prefetch_related(
+            Prefetch("emotions", queryset=DreamEmotion.objects.select_related("emotion")),
+            Prefetch("themes", queryset=DreamTheme.objects.select_related("theme")),
+        )
+        .order_by("date", "id")
+    )
+
+
+def export_dreams(user, context):
+    # iterator() streams rows through a server-side cursor on PostgreSQL and
+    # prefetches emotions/themes per chunk.
+    dreams = export_queryset(user).iterator(
+        chunk_size=settings.DREAM_TRANSFER_BATCH_SIZE
+    )
+    # One serializer instance is reused so fields are only built once.
+    serializer = DreamSerializer(context=context)
+    for dream in dreams:
+        yield json.dumps(serializer.to_representation(dream), ensure_ascii=False) + "\n"
+
+
+async def aexport_dreams(user, context):
+    # For ASGI servers, which would read a sync iterator to the end
+    # (sync_to_async(list)) before sending anything. Each batch of lines is
+    # fetched and serialized in the request's sync thread.
+    lines = export_dreams(user, context)
+    batch_size = settings.DREAM_TRANSFER_BATCH_SIZE
+    next_batch = sync_to_async(lambda: list(islice(lines, batch_size)))
+    try:
+        while True:
+            batch = await next_batch()
+            if not batch:
+                break
+            yield "".join(batch)
+    finally:
+        await sync_to_async(lines.close)()
@@ -1,8 +1,9 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView, TokenVerifyView
 
-from . import views
+from . import async_views, views
 from .views import SignUpView, LoginView
 
 router = DefaultRouter()
@@ -10,16 +11,24 @@ router.register(r'dreams', views.DreamViewSet)
 router.register(r'emotions', views.EmotionViewSet)
 router.register(r'themes', views.ThemeViewSet)
 
+ai_views = async_views if settings.ASYNC_AI_VIEWS else views
+
 urlpatterns = [
     path('', include(router.urls)),
     # Add any additional custom routes here
     path('signup/', SignUpView.as_view(), name='signup'),
     path('login/', LoginView.as_view(), name='login'),
     
-    path('suggest-themes/', views.suggest_themes, name='suggest-themes'),
-    path('suggest-emotions/', views.suggest_emotions, name='suggest_emotions'),
-    path('suggest-title/', views.suggest_title, name='suggest_dreams'),
-    path('generate-dream-insight/', views.generate_dream_insight, name='dream_insights'),
+    path('stats/', views.dream_stats, name='dream_stats'),
+
+    path('suggest/', ai_views.suggest_all, name='suggest_all'),
+    path('suggest-themes/', ai_views.suggest_themes, name='suggest-themes'),
+    path('suggest-emotions/', ai_views.suggest_emotions, name='suggest_emotions'),
+    path('suggest-title/', ai_views.suggest_title, name='suggest_dreams'),
+    path('usage/', views.gemini_usage, name='gemini_usage'),
+    path('suggest-cache/stats/', views.suggestion_cache_stats, name='suggestion_cache_stats'),
+    path('ai/health/', views.ai_health, name='ai_health'),
+    path('generate-dream-insight/', ai_views.generate_dream_insight, name='dream_insights'),
 
     # Simple JWT token URLs
     path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
@@ -27,4 +36,5 @@ urlpatterns = [
     path('token/verify/', TokenVerifyView.as_view(), name='token_verify'),
     
     path('dreams/<int:dream_id>/check-insight/', views.check_dream_insight, name='check_dream_insight'),
+    path('dreams/<int:dream_id>/insight-stream/', async_views.stream_dream_insight, name='stream_dream_insight'),
 ]
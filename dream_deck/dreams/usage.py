@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import GeminiUsage
+
+# Per-user Gemini accounting: every metered call is added to a daily
+# GeminiUsage row, and the day's totals are checked against the user's quota
+# before the next call goes out.
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def get_limits(user):
+    quotas = settings.GEMINI_QUOTAS
+    return quotas["PREMIUM"] if user.is_premium else quotas["FREE"]
+
+
+def record_usage(user_id, endpoint, prompt_tokens, response_tokens):
+    filters = {"user_id": user_id, "day": timezone.localdate(), "endpoint": endpoint}
+    changes = {
+        "requests": F("requests") + 1,
+        "prompt_tokens": F("prompt_tokens") + prompt_tokens,
+        "response_tokens": F("response_tokens") + response_tokens,
+    }
+    if GeminiUsage.objects.filter(**filters).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            GeminiUsage.objects.create(
+                **filters,
+                requests=1,
+                prompt_tokens=prompt_tokens,
+                response_tokens=response_tokens,
+            )
+    except IntegrityError:
+        # Another request created today's row first.
+        GeminiUsage.objects.filter(**filters).update(**changes)
+
+
+def get_daily_usage(user_id, day=None):
+    totals = GeminiUsage.objects.filter(
+        user_id=user_id, day=day or timezone.localdate()
+    ).aggregate(
+        requests=Sum("requests"),
+        prompt_tokens=Sum("prompt_tokens"),
+        response_tokens=Sum("response_tokens"),
+    )
+    return {key: value or 0 for key, value in totals.items()}
+
+
+def check_quota(user):
+    limits = get_limits(user)
+    if limits["REQUESTS"] is None and limits["TOKENS"] is None:
+        return
+    used = get_daily_usage(user.pk)
+    if limits["REQUESTS"] is not None and used["requests"] >= limits["REQUESTS"]:
+        raise QuotaExceeded("Daily AI request limit reached")
+    tokens = used["prompt_tokens"] + used["response_tokens"]
+    if limits["TOKENS"] is not None and tokens >= limits["TOKENS"]:
+        raise QuotaExceeded("Daily AI token limit reached")
+
+
+def usage_summary(user):
+    day = timezone.localdate()
+    limits = get_limits(user)
+    used = get_daily_usage(user.pk, day)
+    endpoints = (
+        GeminiUsage.objects.filter(user=user, day=day)
+        .order_by("endpoint")
+        .values("endpoint", "requests", "prompt_tokens", "response_tokens")
+    )
+    return {
+        "day": day,
+        "requests": used["requests"],
+        "tokens": used["prompt_tokens"] + used["response_tokens"],
+        "limits": {"requests": limits["REQUESTS"], "tokens": limits["TOKENS"]},
+        "endpoints": list(endpoints),
+    }
@@ -0,0 +1,76 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Dream, DreamVersion
+
+# Change tracking for conditional GETs: Dream.updated_at for a single dream
+# and a per-user DreamVersion for listings. Changes are collected per
+# transaction and written once it commits, like dreams/stats.py.
+
+
+class _PendingChanges:
+    def __init__(self):
+        self.user_ids = set()
+        # Dreams whose tags or insight changed; their own row is untouched.
+        self.dream_ids = set()
+        self.flushed = False
+
+    def __call__(self):
+        self.flushed = True
+        now = timezone.now()
+        user_ids = set(self.user_ids)
+        if self.dream_ids:
+            dreams = Dream.objects.filter(pk__in=self.dream_ids)
+            dreams.update(updated_at=now)
+            user_ids.update(dreams.values_list("user_id", flat=True))
+        for user_id in user_ids:
+            bump(user_id, now)
+
+
+def _pending():
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return _PendingChanges()
+    for _, func, _ in connection.run_on_commit:
+        # Flushed ones are only still listed when a test ran them early.
+        if isinstance(func, _PendingChanges) and not func.flushed:
+            return func
+    pending = _PendingChanges()
+    transaction.on_commit(pending)
+    return pending
+
+
+def _flush(pending):
+    if not transaction.get_connection().in_atomic_block:
+        pending()
+
+
+def record_users(user_ids):
+    pending = _pending()
+    pending.user_ids.update(user_ids)
+    _flush(pending)
+
+
+def record_dreams(dream_ids):
+    pending = _pending()
+    pending.dream_ids.update(dream_ids)
+    _flush(pending)
+
+
+def bump(user_id, now=None):
+    now = now or timezone.now()
+    rows = DreamVersion.objects.filter(user_id=user_id)
+    if rows.update(version=F("version") + 1, updated_at=now):
+        return
+    try:
+        with transaction.atomic():
+            DreamVersion.objects.create(user_id=user_id, version=1, updated_at=now)
+    except IntegrityError:
+        rows.update(version=F("version") + 1, updated_at=now)
+
+
+def get_version(user_id):
+    # (version, updated_at); (0, None) before the user's first change.
+    row = DreamVersion.objects.filter(user_id=user_id).values_list("version", "updated_at").first()
+    return row or (0, None)
@@ -1,28 +1,38 @@
+import logging
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from rest_framework import viewsets, permissions
-from rest_framework.decorators import action, api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.decorators import action, api_view, permission_classes, throttle_classes
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
-import google.generativeai as genai
-import os
 from dotenv import load_dotenv
 
-from django.conf import settings
-
-from .serializers import DreamSerializer, EmotionSerializer, ThemeSerializer
-from .models import Dream, DreamInsight, Emotion, Theme, DreamEmotion, DreamTheme
+from . import llm, stats, suggestions, transfer, versions
+from .conditional import conditional_response
+from .embeddings import similar_dreams
+from .insights import enqueue_insight, insight_job_key, insight_slots_left
+from .jobs import active_job, latest_job
+from .llm import log_gemini_usage  # noqa: F401
+from .pagination import DreamCursorPagination
+from .prompts import INSIGHT_SECTIONS
+from .search import search_dreams
+from .throttling import InsightThrottle, SuggestThrottle
+from .serializers import (
+    DreamSerializer,
+    EmotionSerializer,
+    ThemeSerializer,
+    parse_fields_param,
+)
+from .usage import QuotaExceeded, check_quota, usage_summary
+from .models import BackgroundJob, Dream, DreamInsight, Emotion, Theme, DreamEmotion, DreamTheme
 from .auth_views import SignUpView, LoginView  # noqa: F401
 
-import logging
-
-gemini_logger = logging.getLogger("gemini_usage")
-
-
-def log_gemini_usage(function_name, prompt_tokens, response_tokens):
-    gemini_logger.info(
-        f"{function_name}, Prompt tokens: {prompt_tokens}, Response tokens: {response_tokens}"
-    )
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
@@ -35,11 +45,83 @@ class DreamViewSet(viewsets.ModelViewSet):
     queryset = Dream.objects.all()
     serializer_class = DreamSerializer
     permission_classes = [permissions.IsAuthenticated, IsAdminOrOwner]
+    pagination_class = DreamCursorPagination
 
     def get_queryset(self):
         if self.request.user.is_staff:
-            return Dream.objects.all()
-        return Dream.objects.filter(user=self.request.user)
+            return self._optimize_queryset(Dream.objects.all())
+        return self._optimize_queryset(Dream.objects.filter(user=self.request.user))
+
+    def _optimize_queryset(self, queryset):
+        # Load everything DreamSerializer renders up front so a page of N
+        # dreams costs a constant number of queries, and skip whatever a
+        # sparse fieldset leaves out.
+        fields = None
+        if self.request.method == "GET" and self.request.query_params.get("fields"):
+            fields = parse_fields_param(self.request.query_params["fields"])
+
+        if fields is None or "insight" in fields:
+            # Sections are only served by check-insight.
+            queryset = queryset.select_related("insight").defer("insight__sections")
+            insight_fields = (fields or {}).get("insight")
+            if insight_fields and "analysis" not in insight_fields:
+                queryset = queryset.defer("insight__analysis")
+        if fields is not None and "content" not in fields:
+            queryset = queryset.defer("content")
+        if fields is None or "emotions" in fields:
+            queryset = queryset.prefetch_related(
+                Prefetch(
+                    "emotions",
+                    queryset=DreamEmotion.objects.select_related("emotion").order_by("id"),
+                )
+            )
+        if fields is None or "themes" in fields:
+            queryset = queryset.prefetch_related(
+                Prefetch(
+                    "themes",
+                    queryset=DreamTheme.objects.select_related("theme").order_by("id"),
+                )
+            )
+        return queryset
+
+    def _paginated_response(self, queryset):
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def _user_dreams_response(self, queryset):
+        # One of the user's own listings: unchanged while their dream
+        # version stays the same.
+        version, updated_at = versions.get_version(self.request.user.pk)
+        return conditional_response(
+            self.request,
+            ("dreams", self.request.user.pk, version, updated_at),
+            updated_at,
+            lambda: self._paginated_response(queryset).data,
+        )
+
+    def list(self, request, *args, **kwargs):
+        if request.user.is_staff:
+            return super().list(request, *args, **kwargs)
+        return self._user_dreams_response(self.get_queryset())
+
+    def retrieve(self, request, *args, **kwargs):
+        dreams = Dream.objects.all()
+        if not request.user.is_staff:
+            dreams = dreams.filter(user=request.user)
+        try:
+            updated_at = dreams.filter(pk=kwargs["pk"]).values_list("updated_at", flat=True).first()
+        except (TypeError, ValueError):
+            updated_at = None
+        if updated_at is None:
+            # Let the regular lookup produce the 404.
+            return super().retrieve(request, *args, **kwargs)
+        return conditional_response(
+            request,
+            ("dream", updated_at),
+            updated_at,
+            lambda: self.get_serializer(self.get_object()).data,
+        )
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -57,9 +139,8 @@ class DreamViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=["get"])
     def my_dreams(self, request):
-        dreams = Dream.objects.filter(user=self.request.user)
-        serializer = self.get_serializer(dreams, many=True)
-        return Response(serializer.data)
+        dreams = self._optimize_queryset(Dream.objects.filter(user=self.request.user))
+        return self._user_dreams_response(dreams)
 
     @action(detail=False, methods=["get"])
     def all_dreams(self, request):
@@ -68,9 +149,78 @@ class DreamViewSet(viewsets.ModelViewSet):
                 {"detail": "You do not have permission to perform this action."},
                 status=403,
             )
-        dreams = Dream.objects.all()
-        serializer = self.get_serializer(dreams, many=True)
-        return Response(serializer.data)
+        dreams = self._optimize_queryset(Dream.objects.all())
+        return self._paginated_response(dreams)
+
+    @action(detail=False, methods=["get"])
+    def search(self, request):
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            return Response(
+                {"error": "No search query provided"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            limit = min(int(request.query_params.get("limit", 20)), 50)
+            offset = max(int(request.query_params.get("offset", 0)), 0)
+        except ValueError:
+            return Response(
+                {"error": "limit and offset must be integers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if self.request.user.is_staff:
+            dreams = Dream.objects.all()
+        else:
+            dreams = Dream.objects.filter(user=self.request.user)
+        return Response({"results": search_dreams(dreams, query, max(limit, 1), offset)})
+
+    @action(detail=True, methods=["get"])
+    def similar(self, request, pk=None):
+        dream = self.get_object()
+        try:
+            limit = max(1, min(int(request.query_params.get("limit", 5)), 50))
+        except ValueError:
+            return Response(
+                {"error": "limit must be an integer"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        # Premium members, who can browse all dreams, may search across users.
+        all_users = request.query_params.get("scope") == "all" and request.user.is_premium
+        matches = similar_dreams(dream, limit, all_users=all_users)
+        return Response(
+            {
+                "results": [
+                    {"id": match.id, "title": match.title, "date": match.date, "score": score}
+                    for match, score in matches
+                ]
+            }
+        )
+
+    @action(detail=False, methods=["post"], url_path="import")
+    def import_dreams(self, request):
+        # Body is NDJSON (one dream per line), read line by line from the
+        # request stream instead of being parsed into memory at once.
+        result = transfer.import_dreams(
+            request.user, request.stream or [], self.get_serializer_context()
+        )
+        if result["imported"]:
+            return Response(result, status=status.HTTP_201_CREATED)
+        return Response(result, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=False, methods=["get"])
+    def export(self, request):
+        # Each handler only streams an iterator of its own kind; the other
+        # kind is read into memory first.
+        if isinstance(request._request, ASGIRequest):
+            export_dreams = transfer.aexport_dreams
+        else:
+            export_dreams = transfer.export_dreams
+        response = StreamingHttpResponse(
+            export_dreams(request.user, self.get_serializer_context()),
+            content_type="application/x-ndjson",
+        )
+        response["Content-Disposition"] = 'attachment; filename="dreams.ndjson"'
+        return response
 
 
 class EmotionViewSet(viewsets.ModelViewSet):
@@ -91,154 +241,93 @@ class ThemeViewSet(viewsets.ModelViewSet):
         return Theme.objects.all()
 
 
-@api_view(["POST"])
-@permission_classes([IsAuthenticated])
-def suggest_themes(request):
+def _suggestion_response(request, endpoint):
     content = request.data.get("content")
     if not content:
         return Response(
             {"error": "No content provided"}, status=status.HTTP_400_BAD_REQUEST
         )
 
-    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-    model = genai.GenerativeModel("gemini-1.5-flash")
-
-    prompt = f"""Based on the following dream content, suggest 3 relevant themes.
-    Please format your response as a numbered list, with each theme on a new line.
-    Each theme should be a single word.
-    Do not include any additional text or explanations.
-
-    Dream content:
-    {content}
-
-    Response format example:
-    1. Adventure
-    2. Mystery
-    3. Nature
-
-    Your theme suggestions:"""
-
     try:
-        response = model.generate_content(prompt)
-
-        # Estimate token counts
-        prompt_tokens = len(prompt) // 4
-        response_tokens = len(response.text) // 4
+        return Response(suggestions.suggest(endpoint, content, request.user))
+    except QuotaExceeded as e:
+        return Response({"error": str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    except Exception:
+        # Errors without a fallback (a bad API key, a rejected request...).
+        logger.exception("%s failed", endpoint)
+        return Response({"error": "aiUnavailable"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        log_gemini_usage("suggest_themes", prompt_tokens, response_tokens)
 
-        # Process the response
-        themes = [
-            theme.strip().split(". ", 1)[-1]
-            for theme in response.text.split("\n")
-            if theme.strip() and theme[0].isdigit()
-        ]
-
-        return Response({"suggested_themes": themes})
-    except Exception as e:
-        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+@throttle_classes([SuggestThrottle])
+def suggest_themes(request):
+    return _suggestion_response(request, "suggest_themes")
 
 
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@throttle_classes([SuggestThrottle])
 def suggest_emotions(request):
-    content = request.data.get("content")
-    if not content:
-        return Response(
-            {"error": "No content provided"}, status=status.HTTP_400_BAD_REQUEST
-        )
+    return _suggestion_response(request, "suggest_emotions")
 
-    # Configure the Gemini model
-    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-    model = genai.GenerativeModel("gemini-1.5-flash")
 
-    # Generate emotion suggestions with a specific format
-    prompt = f"""Based on the following dream content, suggest 3 relevant emotions that the dreamer might have experienced.
-    Please format your response as a numbered list, with each emotion on a new line.
-    Do not include any additional text or explanations.
-
-    Dream content:
-    {content}
-
-    Response format example:
-    1. Joy
-    2. Anxiety
-    3. Curiosity
-    
-    Your emotion suggestions:"""
-
-    try:
-        response = model.generate_content(prompt)
-        print(response.text)
-
-        # Estimate token counts
-        prompt_tokens = len(prompt) // 4
-        response_tokens = len(response.text) // 4
-
-        log_gemini_usage("suggest_emotion", prompt_tokens, response_tokens)
-
-        # Process the response
-        emotions = []
-        for line in response.text.split("\n"):
-            if line.strip() and line[0].isdigit():
-                parts = line.split(".", 1)[-1].strip().split("(", 1)
-                if len(parts) >= 1:
-                    emotion = parts[0].strip()
-                    emotions.append({"name": emotion})
-
-        return Response({"suggested_emotions": emotions})
-    except Exception as e:
-        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+@throttle_classes([SuggestThrottle])
+def suggest_title(request):
+    return _suggestion_response(request, "suggest_title")
 
 
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
-def suggest_title(request):
+@throttle_classes([SuggestThrottle])
+def suggest_all(request):
     content = request.data.get("content")
     if not content:
         return Response(
             {"error": "No content provided"}, status=status.HTTP_400_BAD_REQUEST
         )
 
-    # Configure the Gemini model
-    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-    model = genai.GenerativeModel("gemini-1.5-flash")
-
-    # Generate title suggestion with a specific format
-    prompt = f"""Based on the following dream content, suggest a creative and engaging title for the dream.
-    The title should be concise (no more than 10 words) and capture the essence or most striking element of the dream.
-    Please provide only the title, without any additional text or explanations.
+    try:
+        return Response(suggestions.suggest_all(content, request.user))
+    except QuotaExceeded as e:
+        return Response({"error": str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    except Exception:
+        # Errors without a fallback (a bad API key, a rejected request...).
+        logger.exception("%s failed", suggestions.COMBINED_ENDPOINT)
+        return Response({"error": "aiUnavailable"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    Dream content:
-    {content}
-    
-    ALWAYS USE USER'S LANGUAGE!!!
 
-    Your title suggestion:"""
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def dream_stats(request):
+    return Response(stats.serialize_stats(stats.get_user_stats(request.user.id)))
 
-    try:
-        response = model.generate_content(prompt)
 
-        # Estimate token counts
-        prompt_tokens = len(prompt) // 4
-        response_tokens = len(response.text) // 4
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def gemini_usage(request):
+    return Response(usage_summary(request.user))
 
-        log_gemini_usage("suggest_title", prompt_tokens, response_tokens)
 
-        # Process the response
-        suggested_title = response.text.strip()
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def suggestion_cache_stats(request):
+    return Response(suggestions.cache_stats())
 
-        # Ensure the title is not too long
-        if len(suggested_title.split()) > 10:
-            suggested_title = " ".join(suggested_title.split()[:10]) + "..."
 
-        return Response({"suggested_title": suggested_title})
-    except Exception as e:
-        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def ai_health(request):
+    return Response(
+        {"backend": llm.get_config()["BACKEND"], "circuits": llm.breaker_states()}
+    )
 
 
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@throttle_classes([InsightThrottle])
 def generate_dream_insight(request):
     dream_id = request.data.get("dream_id")
     if not dream_id:
@@ -247,116 +336,68 @@ def generate_dream_insight(request):
         )
 
     dream = get_object_or_404(Dream, id=dream_id, user=request.user)
-    content = dream.content
-
-    # Load the dream interpretation knowledge base
-    knowledge_base_path = os.path.join(
-        settings.BASE_DIR, "dreams", "dream_interpretation_knowledge.txt"
-    )
-    with open(knowledge_base_path, "r") as file:
-        knowledge_base = file.read()
-
-    # Configure the Gemini model
-    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-    model = genai.GenerativeModel(
-        "gemini-1.5-pro"
-    )  # Using a more capable model for this task
-
-    # Generate dream insight with cultural interpretations
-    prompt = f"""Using the following dream interpretation knowledge base as a guideline, provide insights and cultural interpretations for the given dream content. Include perspectives from at least three different cultures.
-
-    Knowledge Base:
-    {knowledge_base}
-
-    Dream content:
-    {content}
-
-    Please structure your response as follows:
-    1. General Insight: Provide a brief general interpretation of the dream.
-    2. Cultural Interpretations:
-       - Culture 1: [Name of Culture]
-         [Interpretation from this cultural perspective]
-       - Culture 2: [Name of Culture]
-         [Interpretation from this cultural perspective]
-       - Culture 3: [Name of Culture]
-         [Interpretation from this cultural perspective]
-    3. Key Symbols: List and briefly explain 3-5 key symbols from the dream.
-    4. Emotional Analysis: Suggest the emotional state of the dreamer and its potential significance.
-    5. Actionable Advice: Provide 1-2 suggestions for the dreamer based on this interpretation."""
-
-    prompt2 = """You are an AI dream analyst for the Dream Deck app. Your task is to analyze user-submitted dream content and provide insightful, creative, and original interpretations based on a provided dream interpretation knowledge base. Your messages will be sent directly to user except the <scratchpad> and <dream_summary>. So talk directly to them. Always write in the Dream Content language.
-
-Next, you will receive the user's dream content:
-
-<dream_content>
-{content}
-</dream_content>
-
-Analyze the dream content using the provided knowledge base. Be creative and original in your interpretations, going beyond simple symbol matching. Consider the overall narrative, emotions, and themes present in the dream.
-
-Before providing your final analysis, use a <scratchpad> to think through your interpretation process. Consider different aspects of the dream and how they might relate to the dreamer's subconscious mind, daily life, or emotional state.
-
-Your final analysis should be divided into the following sections, each wrapped in appropriate XML tags:
-
-1. <dream_summary>: Provide a brief summary of the key elements and narrative of the dream.
-
-2. <emotional_landscape>: Analyze the emotions present in the dream and what they might represent.
-
-3. <symbolic_analysis>: Interpret key symbols or objects in the dream, relating them to possible meanings in the dreamer's life.
-
-4. <narrative_interpretation>: Examine the overall story or sequence of events in the dream and what it might signify.
-
-5. <personal_growth_insights>: Offer suggestions on how the dreamer might use insights from the dream for personal development or problem-solving in their waking life.
-
-6. <cultural_perspective>: Provide an interpretation from a specific cultural viewpoint, if applicable.
-
-7. <recurring_themes>: Identify any common dream themes present and their potential significance.
-
-8. <lucid_dreaming_potential>: Suggest techniques the dreamer could use to achieve lucidity if they were to have a similar dream in the future.
-
-9. <artistic_inspiration>: Describe a potential piece of artwork or music that could be generated based on the dream's content and mood.
-
-10. <daily_affirmation>: Create a short, inspiring affirmation related to the dream's main theme or message.
-
-Remember to be creative and original in your interpretations, providing unique insights that go beyond conventional dream analysis. Your goal is to offer the user a rich, multifaceted understanding of their dream that they can reflect on and potentially apply to their waking life."""
     try:
-        response = model.generate_content(prompt2)
-
-        # Estimate token counts
-        prompt_tokens = len(prompt2) // 4
-        response_tokens = len(response.text) // 4
-
-        log_gemini_usage("generate_insight", prompt_tokens, response_tokens)
-
-        # Process the response
-        insight = response.text.strip()
-
-        # Save the insight to the database
-        dream_insight, created = DreamInsight.objects.update_or_create(
-            dream=dream,
-            defaults={
-                "summary": insight[
-                    :1000
-                ],  # Assuming summary is the first 1000 characters
-                "analysis": insight,
-            },
+        check_quota(request.user)
+    except QuotaExceeded as e:
+        return Response({"error": str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    if active_job(insight_job_key(dream.id)) is None and insight_slots_left(request.user) <= 0:
+        return Response(
+            {"error": "Too many insights in progress"},
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            headers={"Retry-After": str(settings.AI_THROTTLES["IN_FLIGHT_RETRY_AFTER"])},
         )
 
-        return Response({"dream_insight": insight, "saved_to_database": True})
-    except Exception as e:
-        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    # The analysis runs in the background worker (manage.py run_worker);
+    # clients poll check-insight for the result.
+    job, created = enqueue_insight(dream)
+    return Response(
+        {"job_id": job.id, "status": job.status, "created": created},
+        status=status.HTTP_202_ACCEPTED,
+    )
 
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def check_dream_insight(request, dream_id):
+    # ?sections=dream_summary,daily_affirmation (or "all") returns just those
+    # parsed sections instead of the whole analysis.
+    sections = request.query_params.get("sections")
+    if sections:
+        sections = [name.strip() for name in sections.split(",") if name.strip()]
+        if sections == ["all"]:
+            sections = INSIGHT_SECTIONS
+        unknown = sorted(set(sections) - set(INSIGHT_SECTIONS))
+        if unknown:
+            return Response(
+                {"error": f"Unknown sections: {', '.join(unknown)}", "sections": INSIGHT_SECTIONS},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
     try:
-        dream = Dream.objects.get(id=dream_id, user=request.user)
-        insight = DreamInsight.objects.filter(dream=dream).first()
-
-        if insight:
-            return Response({"has_insight": True, "content": insight.analysis})
-        else:
-            return Response({"has_insight": False})
+        dream = Dream.objects.only("id").get(id=dream_id, user=request.user)
     except Dream.DoesNotExist:
         return Response({"error": "Dream not found"}, status=404)
+    insights = DreamInsight.objects.filter(dream=dream)
+    insight_updated_at = insights.values_list("updated_at", flat=True).first()
+    job = latest_job(insight_job_key(dream.id))
+
+    def build():
+        data = {"has_insight": insight_updated_at is not None}
+        if job is not None:
+            data.update({"job_id": job.id, "status": job.status})
+            if job.status == BackgroundJob.FAILED:
+                data["error"] = job.error
+        elif insight_updated_at is not None:
+            data["status"] = BackgroundJob.DONE
+        if insight_updated_at is None:
+            return data
+        if sections:
+            stored = insights.values_list("sections", flat=True).first() or {}
+            data["sections"] = {name: stored[name] for name in sections if name in stored}
+        else:
+            data["content"] = insights.values_list("analysis", flat=True).first()
+        return data
+
+    # Polling clients get a 304 until the job or the insight changes.
+    state = (insight_updated_at, job and job.id, job and job.status, job and job.updated_at)
+    changes = [at for at in (insight_updated_at, job and job.updated_at) if at]
+    return conditional_response(request, state, max(changes, default=None), build)